@@ -0,0 +1,224 @@
+""" Asynchronous wrappers for the pending queue and message store.
+
+Requires 'trollius' (the Python 2 port of 'asyncio');  coroutines here use
+its 'yield From(...)' style.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import sys
+import weakref
+
+import trollius as asyncio
+from trollius import From
+from trollius import Return
+
+class _ThreadProxy(object):
+    # Run the methods of an object in a dedicated thread, as coroutines.
+    # SQLite connections belong to the thread which opened them, so the
+    # object is created by 'factory' in that thread, and used only there.
+
+    def __init__(self, factory, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(1)
+        self.target = self.executor.submit(factory).result()
+
+    @asyncio.coroutine
+    def _call(self, name, *args):
+        result = yield From(self.loop.run_in_executor(
+                                self.executor,
+                                partial(_invoke, weakref.ref(self.target),
+                                        name, args)))
+        raise Return(result)
+
+    def close(self):
+        """ Release the wrapped object, and stop its thread.
+        """
+        holder = [self.target]
+        self.target = None
+        self.executor.submit(partial(_drop, holder)).result()
+        self.executor.shutdown()
+
+def _invoke(ref, name, args):
+    # Only weak references to the target may outlive the call:  others
+    # (e.g., from the traceback of an exception, which the executor keeps)
+    # might release it in the wrong thread.  So re-raise exceptions
+    # without their original tracebacks.
+    method = getattr(ref(), name)
+    try:
+        return method(*args)
+    except Exception:
+        error = sys.exc_info()[1]
+    del method
+    raise error
+
+def _drop(holder):
+    # Drop the last reference to the object in the thread which owns it.
+    holder.pop()
+
+class AsyncPendingQueue(_ThreadProxy):
+    """ Coroutine API for an IPendingQueue.
+
+    - 'factory' is called (with no arguments) to create the queue, e.g.
+      'functools.partial(PendingQueue, path)'.
+
+    - 'get' waits for the next message ID, claiming batches of up to
+      'batch_size' messages for 'lease_seconds'.  At most 'max_outstanding'
+      messages returned by 'get' may be awaiting 'ack' or 'nack' at once;
+      further calls wait (applying backpressure to the consumer).
+
+    - While the queue is empty, 'get' checks it again every
+      'poll_interval' seconds, or as soon as 'push' or 'notify' is called.
+    """
+    def __init__(self, factory, loop=None, poll_interval=1.0,
+                 batch_size=100, lease_seconds=300, max_outstanding=None):
+        super(AsyncPendingQueue, self).__init__(factory, loop)
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        if max_outstanding is None:
+            max_outstanding = batch_size
+        self._outstanding = asyncio.Semaphore(max_outstanding,
+                                              loop=self.loop)
+        self._claimed = []
+        self._gotten = set()
+        self._wakeup = asyncio.Event(loop=self.loop)
+
+    @asyncio.coroutine
+    def push(self, message_id):
+        """ See IPendingQueue.
+        """
+        yield From(self._call('push', message_id))
+        self.notify()
+
+    @asyncio.coroutine
+    def pop(self, how_many=1):
+        """ See IPendingQueue.
+        """
+        result = yield From(self._call('pop', how_many))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def claim(self, how_many=1, lease_seconds=300):
+        """ See IPendingQueue.
+        """
+        result = yield From(self._call('claim', how_many, lease_seconds))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def ack(self, message_id):
+        """ See IPendingQueue.
+        """
+        try:
+            yield From(self._call('ack', message_id))
+        finally:
+            self._done(message_id)
+
+    @asyncio.coroutine
+    def nack(self, message_id):
+        """ See IPendingQueue.
+        """
+        try:
+            yield From(self._call('nack', message_id))
+        finally:
+            self._done(message_id)
+
+    @asyncio.coroutine
+    def quarantine(self, message_id, error_msg=None):
+        """ See IPendingQueue.
+
+        - Like 'ack' and 'nack', releases a message returned by 'get'.
+        """
+        try:
+            yield From(self._call('quarantine', message_id, error_msg))
+        finally:
+            self._done(message_id)
+
+    @asyncio.coroutine
+    def remove(self, message_id):
+        """ See IPendingQueue.
+        """
+        yield From(self._call('remove', message_id))
+
+    @asyncio.coroutine
+    def length(self):
+        """ Return the number of messages in the queue.
+        """
+        result = yield From(self._call('__len__'))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def depth(self):
+        """ See IPendingQueue.
+        """
+        result = yield From(self._call('depth'))
+        raise Return(result)
+
+    def _done(self, message_id):
+        if message_id in self._gotten:
+            self._gotten.remove(message_id)
+            self._outstanding.release()
+
+    def notify(self):
+        """ Wake any 'get' waiting for messages to be queued.
+        """
+        self._wakeup.set()
+
+    @asyncio.coroutine
+    def get(self):
+        """ Wait for, claim, and return the next message ID.
+
+        - The caller must pass the ID to 'ack', 'nack' or 'quarantine' once
+          it is done with the message.
+        """
+        yield From(self._outstanding.acquire())
+        try:
+            while not self._claimed:
+                self._wakeup.clear()
+                claimed = yield From(self.claim(self.batch_size,
+                                                self.lease_seconds))
+                self._claimed.extend(claimed)
+                if not self._claimed:
+                    try:
+                        yield From(asyncio.wait_for(self._wakeup.wait(),
+                                                    self.poll_interval,
+                                                    loop=self.loop))
+                    except asyncio.TimeoutError:
+                        pass
+        except:
+            self._outstanding.release()
+            raise
+        message_id = self._claimed.pop(0)
+        self._gotten.add(message_id)
+        raise Return(message_id)
+
+class AsyncMaildirStore(_ThreadProxy):
+    """ Coroutine API for an IMessageStore.
+
+    - 'factory' is called (with no arguments) to create the store, e.g.
+      'functools.partial(MaildirStore, path)'.
+    """
+    @asyncio.coroutine
+    def get(self, message_id):
+        """ Return the message for 'message_id'.
+
+        - See IMessageStore.__getitem__.
+        """
+        result = yield From(self._call('__getitem__', message_id))
+        raise Return(result)
+
+    @asyncio.coroutine
+    def set(self, message_id, message):
+        """ Store 'message' as 'message_id'.
+
+        - See IMessageStore.__setitem__.
+        """
+        yield From(self._call('__setitem__', message_id, message))
+
+    @asyncio.coroutine
+    def knownMessageIds(self, message_ids):
+        """ See MaildirStore.knownMessageIds.
+        """
+        result = yield From(self._call('knownMessageIds', list(message_ids)))
+        raise Return(result)
@@ -0,0 +1,115 @@
+""" Benchmarks for the message store, the pending queue and the scripts.
+
+Run them with 'python -m repoze.mailin.benchmarks' (or 'mailin-benchmark');
+see 'repoze.mailin.benchmarks.runner' for the options.  Everything runs
+offline, against synthetic maildirs and an in-process fake IMAP server.
+"""
+import math
+import random
+import sys
+from timeit import default_timer as _now
+
+try:
+    import resource
+except ImportError: # pragma: no cover  (not on Windows)
+    resource = None
+
+def percentile(values, fraction):
+    """ Return the 'fraction' (0 to 1) percentile of 'values'.
+
+    - Uses the nearest-rank method;  returns None if 'values' is empty.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered))) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+def peakRSS():
+    """ Return the peak resident set size of this process, in kilobytes.
+
+    - Return None if the platform cannot report it.
+    """
+    if resource is None: # pragma: no cover
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # pragma: no cover  (reported in bytes)
+        peak //= 1024
+    return peak
+
+class Measurement:
+    """ Record the latencies of a run of operations.
+
+    - Call 'start' before the first operation, 'tick' after each one (or
+      after each group of 'count' operations), and 'stop' after the last.
+    """
+    seconds = None
+    peak_rss = None
+
+    def __init__(self, name, **params):
+        self.name = name
+        self.params = params
+        self.count = 0
+        self.latencies = []
+        self._started = self._last = None
+
+    def start(self):
+        self._started = self._last = _now()
+
+    def tick(self, count=1):
+        now = _now()
+        self.latencies.append((now - self._last) / count)
+        self.count += count
+        self._last = now
+
+    def stop(self):
+        self.seconds = _now() - self._started
+        self.peak_rss = peakRSS()
+
+    def summary(self):
+        """ Return a mapping of the results, suitable for JSON.
+
+        - Latencies are per operation, in milliseconds.
+        """
+        per_second = None
+        if self.seconds:
+            per_second = self.count / self.seconds
+        latency = {}
+        for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            value = percentile(self.latencies, fraction)
+            if value is not None:
+                value *= 1000
+            latency[label] = value
+        latency['max'] = self.latencies and max(self.latencies) * 1000 or None
+        return {'name': self.name,
+                'params': self.params,
+                'count': self.count,
+                'seconds': self.seconds,
+                'per_second': per_second,
+                'latency_ms': latency,
+                'peak_rss_kb': self.peak_rss,
+               }
+
+def makeMessageText(n, size=1024):
+    """ Return the text of a synthetic message, numbered 'n', with a body
+    of about 'size' bytes.
+    """
+    lines = ['Date: Thu, 01 Oct 2009 %02d:%02d:%02d -0000'
+                % (n // 3600 % 24, n // 60 % 60, n % 60),
+             'Message-Id: <%d.bench@example.com>' % n,
+             'From: sender%d@example.com' % (n % 97),
+             'To: recipient@example.com',
+             'Subject: Benchmark message %d' % n,
+             '',
+            ]
+    body = ('The quick brown fox jumps over the lazy dog %d. ' % n) * (
+                size // 48 + 1)
+    lines.append(body[:size])
+    return '\r\n'.join(lines)
+
+def shuffled(items, seed=0):
+    """ Return a copy of 'items' in a repeatable random order.
+    """
+    items = list(items)
+    random.Random(seed).shuffle(items)
+    return items
@@ -0,0 +1,3 @@
+from repoze.mailin.benchmarks.runner import main
+
+main()
@@ -0,0 +1,203 @@
+""" The benchmarks.
+
+Each is called with a scratch directory, the number of operations to time,
+and keyword arguments:  'size' (of synthetic message bodies, in bytes),
+'batch_size' (of drains and IMAP fetches), 'depth' (of the pending
+queue) and 'profile' (the SQLite tuning profile, see
+'repoze.mailin.database').  Each ignores the arguments which don't apply to
+it, and returns a Measurement.
+"""
+from email import message_from_string
+import os
+
+from repoze.mailin.benchmarks import Measurement
+from repoze.mailin.benchmarks import makeMessageText
+from repoze.mailin.benchmarks import shuffled
+from repoze.mailin.benchmarks.fakeimap import FakeIMAPServer
+from repoze.mailin.benchmarks.fakeimap import FakeMailbox
+from repoze.mailin.maildir import MaildirStore
+from repoze.mailin.maildir import SaneFilenameMaildir
+from repoze.mailin.pending import PendingQueue
+from repoze.mailin.scripts.pollster import Pollster
+
+def _messageId(n):
+    return '<%d.bench@example.com>' % n
+
+def _populateStore(store, count, size):
+    for n in range(count):
+        store[_messageId(n)] = message_from_string(makeMessageText(n, size))
+
+def _populateInbox(path, count, size):
+    md = SaneFilenameMaildir(os.path.join(path, 'Maildir'), factory=None,
+                             create=True)
+    for n in range(count):
+        md.add(makeMessageText(n, size))
+
+def _params(profile, **params):
+    # Record the SQLite profile among a Measurement's parameters, if any.
+    if profile is not None:
+        params['profile'] = profile
+    return params
+
+def _fillQueue(queue, first, count):
+    # Fill in one transaction:  filling isn't what we're timing.
+    queue.push_many([_messageId(n) for n in range(first, first + count)])
+
+def storeSet(path, count, size=1024, profile=None, **ignored):
+    """ MaildirStore.__setitem__:  store parsed messages.
+    """
+    store = MaildirStore(path, profile=profile)
+    messages = [(_messageId(n), message_from_string(makeMessageText(n, size)))
+                    for n in range(count)]
+    measurement = Measurement('store_set', **_params(profile, size=size))
+    measurement.start()
+    for message_id, message in messages:
+        store[message_id] = message
+        measurement.tick()
+    measurement.stop()
+    return measurement
+
+def storeGet(path, count, size=1024, profile=None, **ignored):
+    """ MaildirStore.__getitem__:  load stored messages, in random order,
+    through a freshly-opened store.
+    """
+    _populateStore(MaildirStore(path, profile=profile), count, size)
+    store = MaildirStore(path, profile=profile)
+    measurement = Measurement('store_get', **_params(profile, size=size))
+    measurement.start()
+    for n in shuffled(range(count)):
+        store[_messageId(n)]
+        measurement.tick()
+    measurement.stop()
+    return measurement
+
+def drainInbox(path, count, size=1024, batch_size=100, headers_only=False,
+               profile=None, **ignored):
+    """ MaildirStore.drainInbox:  drain an inbox into the store and a
+    pending queue.
+
+    - With batches, each batch's latency is spread across its messages.
+    """
+    _populateInbox(path, count, size)
+    store = MaildirStore(path, profile=profile)
+    queue = PendingQueue(path, profile=profile)
+    name = headers_only and 'drain_headers_only' or 'drain'
+    measurement = Measurement(name, **_params(profile, size=size,
+                                              batch_size=batch_size))
+    measurement.start()
+    pending = 0
+    for message_id in store.drainInbox(queue, batch_size=batch_size,
+                                       headers_only=headers_only):
+        # A batch is stored before any of its messages is yielded.
+        pending += 1
+        if pending == (batch_size or 1):
+            measurement.tick(pending)
+            pending = 0
+    if pending:
+        measurement.tick(pending)
+    measurement.stop()
+    return measurement
+
+def drainInboxHeadersOnly(path, count, size=1024, batch_size=100,
+                          profile=None, **ignored):
+    """ MaildirStore.drainInbox, parsing only headers and linking files.
+    """
+    return drainInbox(path, count, size, batch_size, headers_only=True,
+                      profile=profile)
+
+def queuePush(path, count, depth=0, profile=None, **ignored):
+    """ PendingQueue.push:  queue messages one at a time (each its own
+    transaction), behind 'depth' queued already.
+    """
+    queue = PendingQueue(path, profile=profile)
+    _fillQueue(queue, count, depth)
+    measurement = Measurement('queue_push', **_params(profile, depth=depth))
+    measurement.start()
+    for n in range(count):
+        queue.push(_messageId(n))
+        measurement.tick()
+    measurement.stop()
+    return measurement
+
+def queuePushGrouped(path, count, batch_size=100, depth=0, profile=None,
+                     **ignored):
+    """ PendingQueue.push, buffered:  queue messages one at a time, with a
+    group commit every 'batch_size', behind 'depth' queued already.
+    """
+    queue = PendingQueue(path, profile=profile, group_commit_size=batch_size)
+    _fillQueue(queue, count, depth)
+    measurement = Measurement('queue_push_grouped',
+                              **_params(profile, batch_size=batch_size,
+                                        depth=depth))
+    measurement.start()
+    for n in range(count):
+        queue.push(_messageId(n))
+        measurement.tick()
+    queue.flush()
+    measurement.stop()
+    return measurement
+
+def queuePop(path, count, depth=0, profile=None, **ignored):
+    """ PendingQueue.pop:  pop messages one at a time, leaving 'depth'
+    queued behind them.
+    """
+    queue = PendingQueue(path, profile=profile)
+    _fillQueue(queue, 0, count + depth)
+    measurement = Measurement('queue_pop', **_params(profile, depth=depth))
+    measurement.start()
+    for n in range(count):
+        queue.pop()
+        measurement.tick()
+    measurement.stop()
+    return measurement
+
+class _TimedPollster(Pollster):
+    # Time each message from the previous one's arrival through its
+    # storage:  'fetch_next' resumes only once the caller has stored it.
+    measurement = None
+
+    def fetch_next(self, *args, **kw):
+        for fetched in Pollster.fetch_next(self, *args, **kw):
+            yield fetched
+            self.measurement.tick()
+
+def pollster(path, count, size=1024, batch_size=100, profile=None,
+             **ignored):
+    """ The 'pollster' script, end to end:  poll a fake IMAP server on the
+    loopback interface into a maildir and pending queue.
+    """
+    mailbox = FakeMailbox()
+    for n in range(count):
+        mailbox.append(makeMessageText(n, size))
+    server = FakeIMAPServer({'INBOX': mailbox}, idle=False)
+    server.start()
+    argv = ['pollster', '--quiet',
+            '--pending-queue', path,
+            '--chunk-size', str(batch_size),
+           ]
+    if profile is not None:
+        argv.extend(['--sqlite-profile', profile])
+    try:
+        script = _TimedPollster(argv + [path, '127.0.0.1:%d' % server.port,
+                                        'bench:secret'])
+        measurement = script.measurement = Measurement(
+                        'pollster', **_params(profile, size=size,
+                                              batch_size=batch_size))
+        measurement.start()
+        script.run()
+        measurement.stop()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return measurement
+
+# (name, benchmark, whether it runs at each queue depth)
+BENCHMARKS = [('store_set', storeSet, False),
+              ('store_get', storeGet, False),
+              ('drain', drainInbox, False),
+              ('drain_headers_only', drainInboxHeadersOnly, False),
+              ('queue_push', queuePush, True),
+              ('queue_push_grouped', queuePushGrouped, True),
+              ('queue_pop', queuePop, True),
+              ('pollster', pollster, False),
+             ]
@@ -0,0 +1,249 @@
+""" Minimal in-process IMAP4rev1 server, for offline benchmarks and tests.
+
+Implements just enough of the protocol for 'pollster':  LOGIN, SELECT,
+UID SEARCH / FETCH / STORE, EXPUNGE, NOOP and IDLE, against mailboxes held
+in memory.
+"""
+import re
+import SocketServer
+import ssl
+import threading
+
+_FETCH_ITEM = re.compile(r'RFC822\.SIZE|RFC822|UID|FLAGS|'
+                         r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]|'
+                         r'BODY\.PEEK\[\](?:<(\d+)\.(\d+)>)?', re.I)
+
+class FakeMailbox:
+    """ An in-memory mailbox:  a list of [uid, text, deleted] entries.
+    """
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.lock = threading.Condition()
+
+    def append(self, text):
+        self.lock.acquire()
+        try:
+            self.messages.append([self.next_uid, text, False])
+            self.next_uid += 1
+            self.lock.notifyAll()
+        finally:
+            self.lock.release()
+
+class FakeIMAPHandler(SocketServer.StreamRequestHandler):
+
+    def send(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        self.mailbox = None
+        self.send('* OK fake IMAP4rev1 ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            server.bytes_in += len(line)
+            parts = line.rstrip('\r\n').split(' ', 2)
+            tag, command = parts[0], parts[1].upper()
+            args = len(parts) > 2 and parts[2] or ''
+            if command == 'UID':
+                sub = args.split(' ', 1)
+                command = 'UID ' + sub[0].upper()
+                args = len(sub) > 1 and sub[1] or ''
+            handler = getattr(self, 'do_' + command.replace(' ', '_'), None)
+            if handler is None:
+                self.send('%s BAD unknown command' % tag)
+                continue
+            if handler(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        caps = 'IMAP4rev1'
+        if self.server.idle:
+            caps += ' IDLE'
+        self.send('* CAPABILITY %s' % caps)
+        self.send('%s OK done' % tag)
+
+    def do_LOGIN(self, tag, args):
+        self.send('%s OK logged in' % tag)
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE')
+        self.send('%s OK bye' % tag)
+        return False
+
+    def do_NOOP(self, tag, args):
+        self._exists()
+        self.send('%s OK noop' % tag)
+
+    def do_SELECT(self, tag, args):
+        name = args.strip('"')
+        if name not in self.server.mailboxes:
+            self.send('%s NO [NONEXISTENT] no such mailbox' % tag)
+            return
+        self.mailbox = self.server.mailboxes[name]
+        self._exists()
+        self.send('* OK [UIDVALIDITY %d] ok' % self.mailbox.uidvalidity)
+        self.send('%s OK [READ-WRITE] selected' % tag)
+
+    do_EXAMINE = do_SELECT
+
+    def _exists(self):
+        self.send('* %d EXISTS' % len(self.mailbox.messages))
+
+    def _uidset(self, spec):
+        live = self.mailbox.messages
+        max_uid = live and live[-1][0] or 0
+        uids = set()
+        for part in spec.split(','):
+            if ':' in part:
+                lo, hi = part.split(':')
+                lo = max_uid if lo == '*' else int(lo)
+                hi = max_uid if hi == '*' else int(hi)
+                if lo > hi:
+                    lo, hi = hi, lo
+                uids.update(range(lo, hi + 1))
+            else:
+                uids.add(max_uid if part == '*' else int(part))
+        return [(i + 1, m) for i, m in enumerate(live) if m[0] in uids]
+
+    def do_SEARCH(self, tag, args):
+        self.send('* SEARCH %s' % ' '.join(
+                    [str(i + 1) for i in range(len(self.mailbox.messages))]))
+        self.send('%s OK search' % tag)
+
+    def do_UID_SEARCH(self, tag, args):
+        words = args.split()
+        if len(words) >= 2 and words[-2].upper() == 'UID':
+            found = self._uidset(words[-1])
+        else:
+            found = list(enumerate(self.mailbox.messages, 1))
+        self.send('* SEARCH %s' % ' '.join([str(m[0]) for i, m in found]))
+        self.send('%s OK search' % tag)
+
+    def do_UID_FETCH(self, tag, args):
+        spec, items = args.split(' ', 1)
+        items = items.strip()
+        if items.startswith('('):
+            items = items[1:-1]
+        for seq, (uid, text, deleted) in self._uidset(spec):
+            out = ['UID %d' % uid]
+            literals = []
+            for match in _FETCH_ITEM.finditer(items):
+                item = match.group(0).upper()
+                if item == 'UID':
+                    continue
+                if item == 'FLAGS':
+                    out.append('FLAGS (%s)' % (deleted and '\\Deleted' or ''))
+                elif item == 'RFC822.SIZE':
+                    out.append('RFC822.SIZE %d' % len(text))
+                elif item == 'RFC822':
+                    literals.append(('RFC822', text))
+                elif item.startswith('BODY.PEEK[HEADER.FIELDS'):
+                    wanted = [f.lower() for f in match.group(1).split()]
+                    header = text.split('\r\n\r\n', 1)[0].split('\r\n')
+                    lines = [l for l in header
+                             if l.split(':', 1)[0].lower() in wanted]
+                    literals.append(('BODY[HEADER.FIELDS (%s)]'
+                                        % match.group(1).upper(),
+                                     '\r\n'.join(lines) + '\r\n\r\n'))
+                else:
+                    if match.group(2) is not None:
+                        start = int(match.group(2))
+                        length = int(match.group(3))
+                        literals.append(('BODY[]<%d>' % start,
+                                         text[start:start + length]))
+                    else:
+                        literals.append(('BODY[]', text))
+            head = '* %d FETCH (%s' % (seq, ' '.join(out))
+            if not literals:
+                self.send(head + ')')
+                continue
+            for i, (name, data) in enumerate(literals):
+                head += ' %s {%d}' % (name, len(data))
+                self.wfile.write(head + '\r\n' + data)
+                self.server.bytes_out += len(data)
+                head = ''
+            self.send(')')
+        self.send('%s OK fetch' % tag)
+
+    def do_UID_STORE(self, tag, args):
+        spec, rest = args.split(' ', 1)
+        for seq, message in self._uidset(spec):
+            if 'Deleted' in rest:
+                message[2] = True
+        self.send('%s OK store' % tag)
+
+    def do_EXPUNGE(self, tag, args):
+        box = self.mailbox
+        kept = []
+        for i, message in enumerate(box.messages):
+            if message[2]:
+                # Sequence numbers shift down as earlier messages go.
+                self.send('* %d EXPUNGE' % (len(kept) + 1))
+            else:
+                kept.append(message)
+        box.messages[:] = kept
+        self.send('%s OK expunge' % tag)
+
+    def do_IDLE(self, tag, args):
+        box = self.mailbox
+        count = len(box.messages)
+        self.send('+ idling')
+        self.connection.settimeout(0.05)
+        try:
+            while True:
+                try:
+                    line = self.rfile.readline()
+                except Exception:
+                    line = None
+                if line:
+                    break
+                if len(box.messages) != count:
+                    count = len(box.messages)
+                    self._exists()
+        finally:
+            self.connection.settimeout(None)
+        self.send('%s OK idle done' % tag)
+
+class FakeIMAPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """ Serve 'mailboxes' (a mapping of names to FakeMailbox instances) on
+    an ephemeral port of the loopback interface.
+
+    - Advertises IDLE only if 'idle' is true.
+
+    - Speaks SSL, as for port 993, if 'certfile' (a PEM file holding the
+      key and certificate) is not None.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailboxes=None, idle=True, certfile=None):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        FakeIMAPHandler)
+        if mailboxes is None:
+            mailboxes = {'INBOX': FakeMailbox()}
+        self.mailboxes = mailboxes
+        self.idle = idle
+        self.certfile = certfile
+        self.bytes_in = self.bytes_out = 0
+
+    def get_request(self):
+        sock, address = SocketServer.TCPServer.get_request(self)
+        if self.certfile is not None:
+            sock = ssl.wrap_socket(sock, server_side=True,
+                                   certfile=self.certfile)
+        return sock, address
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
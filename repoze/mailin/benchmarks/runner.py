@@ -0,0 +1,250 @@
+""" mailin-benchmark [OPTIONS] [benchmark ...]
+
+Benchmark the message store, the pending queue and the 'pollster' script,
+offline, against synthetic maildirs and a fake IMAP server.  Run all of the
+benchmarks unless some are named:  %(names)s.
+
+Each benchmark runs in a fresh process, in a fresh scratch directory, and
+reports its throughput, percentiles of its per-message latencies, and the
+peak resident set size of its process.
+
+OPTIONS can include:
+
+ --count, -n            Time this many operations per benchmark:  default,
+                        1000.
+
+ --size, -s             Synthetic message bodies have about this many bytes:
+                        default, 1024.
+
+ --batch-size, -b       Batch size for drains, and chunk size for 'pollster':
+                        default, 100.
+
+ --depths, -d           Comma-separated pending queue depths at which to run
+                        the queue benchmarks:  default, '0,10000'.
+
+ --sqlite-profile, -P   Tune the SQLite databases according to this profile
+                        (see 'repoze.mailin.database'), e.g. 'wal':  default,
+                        SQLite's defaults.
+
+ --output, -o           Write the results as JSON to this file ('-' for
+                        standard output, instead of the table), for
+                        regression tracking.
+
+ --tempdir, -t          Create scratch directories here, rather than in the
+                        system's default location.
+
+ --in-process, -I       Run benchmarks in this process (peak RSS then covers
+                        all of those run so far).
+
+ --quiet, -q            Don't print the table of results.
+
+ --help, -h, -?         Print this message and exit.
+"""
+import getopt
+import json
+import multiprocessing
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from repoze.mailin.benchmarks.cases import BENCHMARKS
+from repoze.mailin.database import getProfile
+
+_NAMES = [name for name, benchmark, by_depth in BENCHMARKS]
+
+def runBenchmark(name, count, tempdir=None, **kw):
+    """ Run the benchmark called 'name' in a scratch directory, and return
+    its summary.
+    """
+    for b_name, benchmark, by_depth in BENCHMARKS:
+        if b_name == name:
+            break
+    else:
+        raise KeyError(name)
+    path = tempfile.mkdtemp(prefix='mailin-bench-', dir=tempdir)
+    try:
+        return benchmark(path, count, **kw).summary()
+    finally:
+        shutil.rmtree(path)
+
+def _runIsolated(args):
+    name, count, tempdir, kw = args
+    return runBenchmark(name, count, tempdir, **kw)
+
+class BenchmarkRunner:
+
+    count = 1000
+    size = 1024
+    batch_size = 100
+    depths = (0, 10000)
+    sqlite_profile = None
+    output = None
+    tempdir = None
+    in_process = False
+    verbose = 1
+
+    def __init__(self, argv):
+        self.parseOptions(argv)
+
+    def parseOptions(self, argv):
+        try:
+            options, arguments = getopt.gnu_getopt(argv[1:],
+                                                   'n:s:b:d:P:o:t:Iqh?',
+                                                   ['count=',
+                                                    'size=',
+                                                    'batch-size=',
+                                                    'depths=',
+                                                    'sqlite-profile=',
+                                                    'output=',
+                                                    'tempdir=',
+                                                    'in-process',
+                                                    'quiet',
+                                                    'help',
+                                                   ])
+        except getopt.GetoptError, e:
+            self.usage(str(e))
+
+        for k, v in options:
+
+            if k in ('-n', '--count'):
+                try:
+                    self.count = int(v)
+                except ValueError:
+                    self.usage('Count must be an integer: %s' % v)
+
+            elif k in ('-s', '--size'):
+                try:
+                    self.size = int(v)
+                except ValueError:
+                    self.usage('Size must be an integer: %s' % v)
+
+            elif k in ('-b', '--batch-size'):
+                try:
+                    self.batch_size = int(v)
+                except ValueError:
+                    self.usage('Batch size must be an integer: %s' % v)
+
+            elif k in ('-d', '--depths'):
+                try:
+                    self.depths = [int(x) for x in v.split(',')]
+                except ValueError:
+                    self.usage('Depths must be integers: %s' % v)
+
+            elif k in ('-P', '--sqlite-profile'):
+                try:
+                    getProfile(v)
+                except ValueError, e:
+                    self.usage(str(e))
+                self.sqlite_profile = v
+
+            elif k in ('-o', '--output'):
+                self.output = v
+
+            elif k in ('-t', '--tempdir'):
+                self.tempdir = v
+
+            elif k in ('-I', '--in-process'):
+                self.in_process = True
+
+            elif k in ('-q', '--quiet'):
+                self.verbose = 0
+
+            elif k in ('-h', '-?', '--help'):
+                self.usage(rc=2)
+
+            else:
+                self.usage('Unknown option: %s' % k)
+
+        if self.output == '-':
+            self.verbose = 0 # keep standard output valid JSON
+
+        for name in arguments:
+            if name not in _NAMES:
+                self.usage('Unknown benchmark: %s' % name)
+
+        self.names = arguments or _NAMES
+
+    def usage(self, message=None, rc=1):
+        print __doc__ % {'names': ', '.join(_NAMES)}
+        if message is not None:
+            print message
+            print
+        sys.exit(rc)
+
+    def plan(self):
+        # Return the arguments for each run of the selected benchmarks.
+        runs = []
+        for name, benchmark, by_depth in BENCHMARKS:
+            if name not in self.names:
+                continue
+            kw = {'size': self.size, 'batch_size': self.batch_size}
+            if self.sqlite_profile is not None:
+                kw['profile'] = self.sqlite_profile
+            if by_depth:
+                for depth in self.depths:
+                    runs.append((name, self.count, self.tempdir,
+                                 dict(kw, depth=depth)))
+            else:
+                runs.append((name, self.count, self.tempdir, kw))
+        return runs
+
+    def runAll(self):
+        results = []
+        for run in self.plan():
+            if self.in_process:
+                result = _runIsolated(run)
+            else:
+                # A fresh process for each, so that peak RSS is its own.
+                pool = multiprocessing.Pool(1)
+                try:
+                    result = pool.apply(_runIsolated, (run,))
+                finally:
+                    pool.close()
+                    pool.join()
+            if self.verbose:
+                self.report(result)
+            results.append(result)
+        return results
+
+    def report(self, result):
+        params = ', '.join(['%s=%s' % x
+                                for x in sorted(result['params'].items())])
+        latency = result['latency_ms']
+        print '%-20s %-28s %9.1f/s  p50 %7.3f  p99 %7.3f ms  %7s KB' % (
+                result['name'], params, result['per_second'] or 0,
+                latency['p50'] or 0, latency['p99'] or 0,
+                result['peak_rss_kb'])
+
+    def writeJSON(self, results):
+        document = {'timestamp': time.time(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'sqlite': sqlite3.sqlite_version,
+                    'count': self.count,
+                    'results': results,
+                   }
+        if self.output == '-':
+            json.dump(document, sys.stdout, indent=2, sort_keys=True)
+            print
+        else:
+            f = open(self.output, 'w')
+            try:
+                json.dump(document, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+
+    def run(self):
+        results = self.runAll()
+        if self.output is not None:
+            self.writeJSON(results)
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    BenchmarkRunner(argv).run()
+
+if __name__ == '__main__':
+    main()
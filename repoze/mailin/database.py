@@ -0,0 +1,115 @@
+""" Open the SQLite databases, applying a named tuning profile.
+"""
+import sqlite3
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS = ('off', 'normal', 'full', 'extra')
+
+# Settings for 'connect', by name.  'busy_timeout' is in milliseconds;
+# 'cache_size' is in pages, or in KiB if negative.
+PROFILES = {
+    # SQLite's defaults:  a rollback journal, synced on each commit;
+    # readers and the writer block each other.
+    'default': {'busy_timeout': 5000,
+               },
+    # A write-ahead log:  readers never block the writer, nor it them, and
+    # commits sync only at checkpoints.  Not for network filesystems.
+    'wal': {'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'busy_timeout': 30000,
+           },
+    # As 'wal', with memory-mapped reads and a 64 MB page cache.
+    'fast': {'journal_mode': 'wal',
+             'synchronous': 'normal',
+             'busy_timeout': 30000,
+             'mmap_size': 256 * 1024 * 1024,
+             'cache_size': -64 * 1024,
+            },
+}
+
+DEFAULT_PROFILE = 'default'
+
+
+def getProfile(profile=None):
+    """ Return a copy of the settings for 'profile'.
+
+    - 'profile' is the name of one of PROFILES, or a mapping of settings,
+      or None for DEFAULT_PROFILE.
+
+    - Raise ValueError for unknown names.
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if isinstance(profile, basestring):
+        try:
+            return dict(PROFILES[profile])
+        except KeyError:
+            raise ValueError('Unknown SQLite profile: %s' % profile)
+    return dict(profile)
+
+
+def connect(dbfile, profile=None, isolation_level=None, timeout=None,
+            **settings):
+    """ Return a connection to the database in 'dbfile', tuned according
+    to 'profile' (see 'getProfile').
+
+    - 'timeout', if passed, overrides the profile's 'busy_timeout', in
+      seconds:  how long to wait for another connection's lock.
+
+    - Other 'settings' (see 'setPragmas') override the profile's, unless
+      None.
+    """
+    settings = dict([(k, v) for k, v in settings.items() if v is not None])
+    settings = dict(getProfile(profile), **settings)
+    busy_timeout = settings.pop('busy_timeout', 5000)
+    if timeout is None:
+        timeout = busy_timeout / 1000.0
+    sql = sqlite3.connect(dbfile, isolation_level=isolation_level,
+                          timeout=timeout)
+    try:
+        setPragmas(sql, **settings)
+    except:
+        sql.close()
+        raise
+    return sql
+
+
+def setPragmas(sql, journal_mode=None, synchronous=None, mmap_size=None,
+               cache_size=None):
+    """ Set the SQLite pragmas of the database on 'sql', for those passed.
+
+    - 'journal_mode' is one of JOURNAL_MODES, e.g. 'wal', which lets
+      readers proceed alongside a writer, and makes commits cheaper.
+
+    - 'synchronous' is one of SYNCHRONOUS, or its number (0 - 3);  with
+      'wal', 'normal' syncs only at checkpoints, so a power loss may undo
+      the latest commits (but never corrupts the database).
+
+    - 'mmap_size' is the most bytes to read via memory-mapping;
+      'cache_size' the size of the page cache (see PROFILES).
+
+    - Raise ValueError for other values.
+    """
+    if journal_mode is not None:
+        journal_mode = str(journal_mode).lower()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError('Invalid journal mode: %s' % journal_mode)
+    if synchronous is not None:
+        synchronous = str(synchronous).lower()
+        if synchronous.isdigit() and int(synchronous) < len(SYNCHRONOUS):
+            synchronous = SYNCHRONOUS[int(synchronous)]
+        if synchronous not in SYNCHRONOUS:
+            raise ValueError('Invalid synchronous level: %s' % synchronous)
+    if mmap_size is not None:
+        mmap_size = int(mmap_size)
+    if cache_size is not None:
+        cache_size = int(cache_size)
+    if journal_mode is not None:
+        # In-memory databases keep to 'memory', whatever we ask.
+        sql.execute('pragma journal_mode=%s' % journal_mode).fetchall()
+    if synchronous is not None:
+        sql.execute('pragma synchronous=%s' % synchronous)
+    if mmap_size is not None:
+        sql.execute('pragma mmap_size=%d' % mmap_size).fetchall()
+    if cache_size is not None:
+        sql.execute('pragma cache_size=%d' % cache_size)
@@ -0,0 +1,286 @@
+""" Run chains of message filters over pending messages.
+"""
+from itertools import izip
+import logging
+import multiprocessing
+import sys
+import time
+import types
+
+from repoze.mailin.interfaces import CancelProcessing
+from repoze.mailin.interfaces import StopProcessing
+
+PROCESSED = 'processed'
+STOPPED = 'stopped'
+CANCELLED = 'cancelled'
+QUARANTINED = 'quarantined'
+
+def resolveDottedName(name):
+    """ Return the object named by 'name'.
+
+    - 'name' may be either 'package.module:attr' or 'package.module.attr'.
+    """
+    if ':' in name:
+        module_name, attr = name.split(':', 1)
+        obj = __import__(module_name, {}, {}, ['*'])
+        for part in attr.split('.'):
+            obj = getattr(obj, part)
+        return obj
+    parts = name.split('.')
+    used = parts.pop(0)
+    obj = __import__(used)
+    for part in parts:
+        used = '%s.%s' % (used, part)
+        try:
+            obj = getattr(obj, part)
+        except AttributeError:
+            __import__(used)
+            obj = getattr(obj, part)
+    return obj
+
+def _filterName(filter):
+    name = getattr(filter, '__name__', None)
+    if name is None:
+        name = filter.__class__.__name__
+    return name
+
+def makeFilter(name):
+    """ Resolve 'name' to an IMessageFilter, instantiating it if a class.
+    """
+    obj = resolveDottedName(name)
+    if isinstance(obj, (type, types.ClassType)):
+        obj = obj()
+    return obj
+
+def _noop():
+    pass
+
+class DispatchStats:
+    """ Record the outcomes and per-stage timings of a dispatcher's work.
+    """
+    def __init__(self):
+        self.outcomes = {}
+        self.stages = [] # in order of first use
+        self.timings = {} # stage -> [count, seconds]
+
+    def record(self, stage, seconds, count=1):
+        timing = self.timings.get(stage)
+        if timing is None:
+            timing = self.timings[stage] = [0, 0.0]
+            self.stages.append(stage)
+        timing[0] += count
+        timing[1] += seconds
+
+    def count(self, outcome):
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def report(self):
+        """ Return a list of lines summarizing throughput for each stage.
+        """
+        lines = []
+        for stage in self.stages:
+            count, seconds = self.timings[stage]
+            if seconds:
+                rate = '%.1f/sec' % (count / seconds)
+            else:
+                rate = 'n/a'
+            lines.append('%-24s %8d in %9.3f seconds (%s)'
+                            % (stage, count, seconds, rate))
+        for outcome in sorted(self.outcomes):
+            lines.append('%-24s %8d' % (outcome, self.outcomes[outcome]))
+        return lines
+
+class Dispatcher:
+    """ Process messages from an IPendingQueue through IMessageFilters.
+
+    - Messages are claimed from 'pending_queue' in batches of 'batch_size',
+      loaded from 'store' (an IMessageStore), and passed in turn to each
+      of 'filters', along with a blackboard created by 'blackboard_factory'
+      (an IBlackboardFactory;  by default, an empty dict).
+
+    - 'commit' and 'abort' are called with no arguments after each message
+      to end its transaction, e.g. 'transaction.commit'.  A filter which
+      raises 'StopProcessing' skips the rest of the chain, but the message's
+      transaction is still committed;  'CancelProcessing' aborts it.
+
+    - Messages are acknowledged once processed (or cancelled).  A message
+      which cannot be loaded, or for which a filter raises any other
+      exception, is quarantined with the error.
+    """
+    def __init__(self, store, pending_queue, filters,
+                 blackboard_factory=None, batch_size=100,
+                 commit=None, abort=None, lease_seconds=300, logger=None):
+        self.store = store
+        self.pending_queue = pending_queue
+        self.filters = list(filters)
+        self.filter_names = ['%d:%s' % (i, _filterName(x))
+                                for i, x in enumerate(self.filters)]
+        if blackboard_factory is None:
+            blackboard_factory = lambda message: {}
+        self.blackboard_factory = blackboard_factory
+        self.batch_size = batch_size
+        self.commit = commit or _noop
+        self.abort = abort or _noop
+        self.lease_seconds = lease_seconds
+        self.logger = logger
+        self.stats = DispatchStats()
+
+    def run(self, limit=None):
+        """ Process messages until the queue is empty, or until 'limit'
+        messages have been processed.
+
+        - Yield the message ID and outcome of each message.
+        """
+        for message_ids in self._claimBatches(limit):
+            for message_id in message_ids:
+                yield message_id, self.processMessage(message_id)
+
+    def _claimBatches(self, limit):
+        # Yield batches of claimed message IDs, until the queue is empty or
+        # 'limit' messages have been claimed.
+        done = 0
+        while limit is None or done < limit:
+            how_many = self.batch_size
+            if limit is not None:
+                how_many = min(how_many, limit - done)
+            started = time.time()
+            message_ids = self.pending_queue.claim(how_many,
+                                                   self.lease_seconds)
+            self.stats.record('claim', time.time() - started,
+                              len(message_ids))
+            if not message_ids:
+                break
+            yield message_ids
+            done += len(message_ids)
+
+    def processMessage(self, message_id):
+        """ Run the filter chain over the claimed message for 'message_id'.
+
+        - Return the outcome:  one of 'PROCESSED', 'STOPPED', 'CANCELLED',
+          or 'QUARANTINED'.
+        """
+        outcome, error_msg, timings = self.runChain(message_id)
+        return self._finish(message_id, outcome, error_msg, timings)
+
+    def runChain(self, message_id):
+        """ Run the filter chain over the message for 'message_id', without
+        updating the pending queue.
+
+        - Return the outcome, the error message (if quarantined, else None),
+          and a list of '(stage, seconds)' timings.
+        """
+        timings = []
+        started = time.time()
+        try:
+            message = self.store[message_id]
+            blackboard = self.blackboard_factory(message)
+        except Exception:
+            return QUARANTINED, _errorMessage(), timings
+        stage_started = time.time()
+        timings.append(('load', stage_started - started))
+
+        outcome = PROCESSED
+        for name, filter in zip(self.filter_names, self.filters):
+            try:
+                try:
+                    filter(message, blackboard)
+                except CancelProcessing:
+                    outcome = CANCELLED
+                except StopProcessing:
+                    outcome = STOPPED
+                except Exception:
+                    error_msg = _errorMessage()
+                    self.abort()
+                    return QUARANTINED, error_msg, timings
+            finally:
+                now = time.time()
+                timings.append((name, now - stage_started))
+                stage_started = now
+            if outcome != PROCESSED:
+                break
+
+        try:
+            if outcome == CANCELLED:
+                self.abort()
+            else:
+                self.commit()
+        except Exception:
+            error_msg = _errorMessage()
+            self.abort()
+            return QUARANTINED, error_msg, timings
+        now = time.time()
+        timings.append(('commit', now - stage_started))
+        timings.append(('total', now - started))
+        return outcome, None, timings
+
+    def _finish(self, message_id, outcome, error_msg, timings):
+        # Record the outcome of 'runChain' in the pending queue and stats.
+        for stage, seconds in timings:
+            self.stats.record(stage, seconds)
+        started = time.time()
+        if outcome == QUARANTINED:
+            self.pending_queue.quarantine(message_id, error_msg)
+            if self.logger is not None:
+                self.logger.log(logging.ERROR, 'Quarantined %s: %s'
+                                                  % (message_id, error_msg))
+        else:
+            self.pending_queue.ack(message_id)
+        self.stats.record('ack', time.time() - started)
+        self.stats.count(outcome)
+        return outcome
+
+class ParallelDispatcher(Dispatcher):
+    """ Dispatcher which runs filter chains in a pool of worker processes.
+
+    - Each worker calls 'store_factory' to open its own IMessageStore, and
+      runs the chain (including the 'commit' / 'abort' hooks) for the
+      messages it is sent.
+
+    - Only this process claims, acknowledges, or quarantines messages in
+      'pending_queue'.
+
+    - 'workers' defaults to the number of CPUs.
+    """
+    def __init__(self, store_factory, pending_queue, filters, workers=None,
+                 **kw):
+        Dispatcher.__init__(self, None, pending_queue, filters, **kw)
+        self.store_factory = store_factory
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+
+    def run(self, limit=None):
+        """ See Dispatcher.
+        """
+        pool = multiprocessing.Pool(self.workers, _initWorker,
+                                    (self.store_factory, self.filters,
+                                     self.blackboard_factory, self.commit,
+                                     self.abort))
+        try:
+            for message_ids in self._claimBatches(limit):
+                chunksize = max(1, len(message_ids) // (self.workers * 4))
+                results = pool.imap(_runChainInWorker, message_ids,
+                                    chunksize)
+                for message_id, result in izip(message_ids, results):
+                    yield message_id, self._finish(message_id, *result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        pool.join()
+
+# The dispatcher for this process, when it is a ParallelDispatcher's worker.
+_worker = None
+
+def _initWorker(store_factory, filters, blackboard_factory, commit, abort):
+    global _worker
+    _worker = Dispatcher(store_factory(), None, filters,
+                         blackboard_factory=blackboard_factory,
+                         commit=commit, abort=abort)
+
+def _runChainInWorker(message_id):
+    return _worker.runChain(message_id)
+
+def _errorMessage():
+    error = sys.exc_info()[1]
+    return '%s: %s' % (error.__class__.__name__, error)
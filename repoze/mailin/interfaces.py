@@ -40,6 +40,30 @@ class IPendingQueue(Interface):
         - Popped messages are no longer present in the queue.
         """
 
+    def claim(how_many=1, lease_seconds=300):
+        """ Lease the next 'how_many' message IDs to be processed.
+
+        - If 'how_many' is None, then lease all available message IDs.
+
+        - May return fewer than 'how_many' IDs, if the queue is emptied.
+
+        - Leased messages remain in the queue, but are not returned by
+          'pop' or 'claim' until 'lease_seconds' have passed, or until
+          released via 'nack'.  Processed messages should be 'ack'ed.
+        """
+
+    def ack(message_id):
+        """ Remove the leased 'message_id' from the queue after processing.
+
+        - Raise KeyError if not found.
+        """
+
+    def nack(message_id):
+        """ Release the lease on 'message_id', returning it to the queue.
+
+        - Raise KeyError if not found.
+        """
+
     def remove(message_id):
         """ Remove the given message ID from the queue.
 
@@ -69,6 +93,20 @@ class IPendingQueue(Interface):
         """ Return True if no message IDs are in the queue, else False.
         """
 
+    def __len__():
+        """ Return the number of message IDs in the queue.
+
+        - As for '__nonzero__' and '__iter__', quarantined message IDs and
+          those under an unexpired lease are not counted.
+        """
+
+    def depth():
+        """ Return the number of message IDs in the queue, including
+        those under a lease (i.e., claimed but not yet acked).
+
+        - Quarantined message IDs are not counted.
+        """
+
 class StopProcessing(Exception):
     """ Raised by IMessageFilter instances to halt procesing of a message.
 
@@ -106,3 +144,25 @@ class IMessageFilter(Interface):
 
         - Raise 'StopProcessing' to cancel further processing of 'message'.
         """
+
+class IMetrics(Interface):
+    """ Plugin interface for recording operational metrics.
+
+    - Names are dotted, e.g. 'store.write';  exporters may rewrite them to
+      suit their backends.
+    """
+    def increment(name, value=1):
+        """ Add 'value' to the counter 'name'.
+        """
+
+    def gauge(name, value):
+        """ Set the gauge 'name' to 'value'.
+        """
+
+    def timing(name, seconds):
+        """ Record a duration of 'seconds' for the timer 'name'.
+        """
+
+    def flush():
+        """ Export any metrics held back since the last export.
+        """
@@ -1,29 +1,102 @@
 import errno
+import heapq
+from itertools import islice
 import mailbox
 import math
 import os
+import re
 import socket
 import sqlite3
+import sys
 import time
 try:
     from email.utils import parsedate
 except ImportError: # Python < 2.6  #pragma NO COVERAGE
     from email.Utils import parsedate
+from email.parser import HeaderParser
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # optional backport
+    except ImportError: # pragma: no cover
+        scandir = None
 
 from zope.interface import implements
 
+from repoze.mailin.database import connect
 from repoze.mailin.interfaces import IMessageStore
+from repoze.mailin.metrics import NullMetrics
+from repoze.mailin.schema import migrate
+
+# Each step is a list of statements;  see 'repoze.mailin.schema.migrate'.
+_MESSAGES_SCHEMA = [
+    # 1:  initial schema.
+    ['create table if not exists messages'
+     '( id integer primary key'
+     ', message_id varchar(1024) unique'
+     ', year integer not null'
+     ', month integer not null'
+     ', day integer not null'
+     ', maildir_key varchar(1024) not null unique'
+     ')',
+    ],
+    # 2:  index messages by folder date.
+    ['create index if not exists messages_date '
+     'on messages(year, month, day)',
+    ],
+]
+
+# Delivery timestamp at the start of a Maildir filename.
+_TIMESTAMP = re.compile(r'^(\d+)\.')
+
+def _deliveryOrder(key):
+    # Order keys by their delivery timestamps (numerically, as they may
+    # not be zero-padded), then by name;  put keys without timestamps last.
+    match = _TIMESTAMP.match(key)
+    if match is None:
+        return (sys.maxint, key)
+    return (int(match.group(1)), key)
+
+def _listFiles(path):
+    # List the names of the non-directories in 'path', without stat'ing
+    # each one if 'scandir' is available.
+    if scandir is not None:
+        return [entry.name for entry in scandir(path)
+                    if not entry.is_dir()]
+    return [name for name in os.listdir(path)
+                if not os.path.isdir(os.path.join(path, name))]
+
+def _readHeaders(path):
+    # Parse only the header block of the file at 'path', stopping at the
+    # first blank line.
+    lines = []
+    f = open(path, 'rb')
+    try:
+        for line in f:
+            if not line.strip('\r\n'):
+                break
+            lines.append(line)
+    finally:
+        f.close()
+    return HeaderParser().parsestr(''.join(lines))
 
+def _removeFile(path):
+    # Remove the file at 'path', if it still exists.
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
 
 class SaneFilenameMaildir(mailbox.Maildir):
     """ Subclass stdlib Maildir to override '_create_tmp' w/ sane filenames.
     """
     _count = 0
 
-    def _create_tmp(self): #pragma NO COVERAGE
-        """Create a file in the tmp subdirectory and open and return it."""
-        # Skipping coverage because the mailbox module doesn't let us
-        # hook the file creation.
+    def _uniqueName(self):
+        """ Return a new, strictly sortable message filename.
+        """
         klass = self.__class__
         now = time.time()
         now_i, now_f = math.modf(now)
@@ -37,12 +110,52 @@ class SaneFilenameMaildir(mailbox.Maildir):
                                              os.getpid(),
                                              klass._count,
                                              hostname)
-        path = os.path.join(self._path, 'tmp', uniq)
+        klass._count += 1
+        return uniq
+
+    def iterDelivered(self):
+        """ Return an iterator over the keys of the messages, in delivery
+        order.
+
+        - Unlike 'iterkeys', does not rebuild the table of contents:  just
+          lists 'new' and 'cur' (via 'scandir', if available, avoiding a
+          stat per entry), and yields keys incrementally from a heap,
+          recording each in the table of contents as it is yielded.
+
+        - Callers which move or remove a yielded message should 'forget'
+          its key, so that the table of contents does not grow without
+          bound across calls.
+        """
+        heap = []
+        for subdir in ('new', 'cur'):
+            for name in _listFiles(os.path.join(self._path, subdir)):
+                if name.startswith('.'):
+                    continue
+                key = name.split(self.colon)[0]
+                heap.append((_deliveryOrder(key), os.path.join(subdir, name)))
+        heapq.heapify(heap)
+        return self._popDelivered(heap)
+
+    def _popDelivered(self, heap):
+        while heap:
+            (timestamp, key), subpath = heapq.heappop(heap)
+            self._toc[key] = subpath
+            yield key
+
+    def forget(self, key):
+        """ Drop 'key' from the table of contents, if present.
+        """
+        self._toc.pop(key, None)
+
+    def _create_tmp(self): #pragma NO COVERAGE
+        """Create a file in the tmp subdirectory and open and return it."""
+        # Skipping coverage because the mailbox module doesn't let us
+        # hook the file creation.
+        path = os.path.join(self._path, 'tmp', self._uniqueName())
         try:
             os.stat(path)
         except OSError, e:
             if e.errno == errno.ENOENT:
-                klass._count += 1
                 try:
                     return mailbox._create_carefully(path)
                 except OSError, e:
@@ -56,6 +169,36 @@ class SaneFilenameMaildir(mailbox.Maildir):
                 'Name clash prevented file creation: %s' % path)
 
 
+class FolderCache(object):
+    """ Bounded LRU mapping of folder names onto open Maildir handles.
+    """
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self._handles = {}
+        self._order = []
+
+    def get(self, name):
+        md = self._handles.get(name)
+        if md is not None and self._order[-1] != name:
+            self._order.remove(name)
+            self._order.append(name)
+        return md
+
+    def put(self, name, md):
+        if name in self._handles:
+            self._order.remove(name)
+        self._handles[name] = md
+        self._order.append(name)
+        while len(self._order) > self.maxsize:
+            del self._handles[self._order.pop(0)]
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, name):
+        return name in self._handles
+
+
 class MaildirStore:
     """ Use a :class:`mailbox.Maildir` to store messges.
 
@@ -69,36 +212,41 @@ class MaildirStore:
 
     - Messages stored via the ``IMessageStore`` API will be seated into
       folders keyed by year, month, and day of the message's ``Date`` field.
+
+    - Handles for the most recently used ``folder_cache_size`` folders
+      are kept open, to avoid rescanning the ``Maildir`` on each access.
+
+    - Timings and counts of parsing, writing and committing messages are
+      recorded to ``metrics`` (an ``IMetrics``), if passed.
+
+    - The SQLite database is tuned according to ``profile`` (see
+      ``repoze.mailin.database.PROFILES``), with ``timeout`` overriding its
+      busy timeout, if passed.
     """
     implements(IMessageStore)
+    _root = None
 
-    def __init__(self, path, dbfile=None, isolation_level=None):
+    def __init__(self, path, dbfile=None, isolation_level=None,
+                 folder_cache_size=32, timeout=None, metrics=None,
+                 profile=None):
         self.path = path
         self.mdpath = os.path.join(path, 'Maildir')
+        self.folders = FolderCache(folder_cache_size)
         if dbfile is None:
             dbfile = os.path.join(path, 'metadata.db')
-        sql = self.sql = sqlite3.connect(dbfile,
-                                         isolation_level=isolation_level)
-        found = sql.execute('select * from sqlite_master '
-                             'where type = "table" and name = "messages"'
-                           ).fetchall()
-        if not found:
-            sql.execute('create table messages'
-                        '( id integer primary key'
-                        ', message_id varchar(1024) unique'
-                        ', year integer not null'
-                        ', month integer not null'
-                        ', day integer not null'
-                        ', maildir_key varchar(1024) not null unique'
-                        ')')
-
- 
+        sql = self.sql = connect(dbfile, profile, isolation_level, timeout)
+        migrate(sql, 'messages', _MESSAGES_SCHEMA)
+        if metrics is None:
+            metrics = NullMetrics()
+        self.metrics = metrics
+
     def __getitem__(self, message_id):
         """ See IMessageStore.
         """
+        started = time.time()
         found = self.sql.execute('select year, month, day, maildir_key '
-                                 'from messages where message_id = "%s"'
-                                    % message_id
+                                 'from messages where message_id = ?',
+                                 (message_id,)
                                 ).fetchall()
         if not found:
             raise KeyError(message_id)
@@ -106,26 +254,93 @@ class MaildirStore:
         yy, mm, dd, key = found[0]
         folder_name = self._getFolderName(yy, mm, dd)
         folder = self._getMaildir(folder_name, create=False)
-        return folder[key]
+        message = folder[key]
+        self.metrics.timing('store.load', time.time() - started)
+        return message
 
     def __setitem__(self, message_id, message):
         """ See IMessageStore.
         """
+        started = time.time()
         to_store = mailbox.MaildirMessage(message)
-        date = to_store['Date']
-        yy, mm, dd, hh, mt, ss, wd, jd, dst = parsedate(date)
+        yy, mm, dd = self._getMessageDate(to_store)
         folder_name = self._getFolderName(yy, mm, dd)
         folder = self._getMaildir(folder_name)
+        step = time.time()
         key = folder.add(to_store)
+        self.metrics.timing('store.file', time.time() - step)
         try:
+            step = time.time()
             self.sql.execute('insert into messages'
                              '(message_id, year, month, day, maildir_key) '
-                             'values("%s", %d, %d, %d, "%s")'
-                              % (message_id, yy, mm, dd, key)
-                            )
+                             'values(?, ?, ?, ?, ?)',
+                             (message_id, yy, mm, dd, key))
+            self.metrics.timing('store.insert', time.time() - step)
         except:
             folder.remove(key)
             raise
+        self.metrics.timing('store.write', time.time() - started)
+        self.metrics.increment('store.stored')
+
+    def storeFile(self, message_id, path, key=None, headers=None):
+        """ Move the message in file 'path' into the store, without
+        re-writing it.
+
+        - The file is hard-linked into the 'new' subdirectory of the folder
+          for the message's ``Date``, falling back to a rename where hard
+          links are not supported.  It is removed from 'path' once its
+          metadata is recorded.
+
+        - 'key' is the Maildir key to use within the folder;  if None,
+          generate a new one.
+
+        - 'headers', if passed, should be the parsed headers of the message
+          (avoiding re-reading them from 'path').
+
+        - Raise 'sqlite3.IntegrityError' if 'message_id' is already stored;
+          in that case, the file is left in place.  If it is stored as 'key'
+          by an earlier, interrupted call, which linked the file but did
+          not remove it from 'path', just finish the job.
+
+        - Return the Maildir key of the stored message.
+        """
+        started = time.time()
+        if headers is None:
+            headers = _readHeaders(path)
+        if key is None:
+            key = self._getMaildir()._uniqueName()
+        yy, mm, dd = self._getMessageDate(headers)
+        folder = self._getMaildir(self._getFolderName(yy, mm, dd))
+        dst = os.path.join(folder._path, 'new', key)
+        step = time.time()
+        created, renamed = self._placeFile(path, dst)
+        self.metrics.timing('store.file', time.time() - step)
+        if not created and self._isStored(message_id, key):
+            _removeFile(path)
+            return key
+        try:
+            step = time.time()
+            self.sql.execute('insert into messages'
+                             '(message_id, year, month, day, maildir_key) '
+                             'values(?, ?, ?, ?, ?)',
+                             (message_id, yy, mm, dd, key))
+            self.metrics.timing('store.insert', time.time() - step)
+        except:
+            if renamed:
+                os.rename(dst, path)
+            elif created:
+                os.unlink(dst)
+            raise
+        if not renamed:
+            _removeFile(path)
+        self.metrics.timing('store.write', time.time() - started)
+        self.metrics.increment('store.stored')
+        return key
+
+    def _isStored(self, message_id, key):
+        return self.sql.execute('select 1 from messages '
+                                'where message_id = ? and maildir_key = ?',
+                                (message_id, key)).fetchone() is not None
 
     def iterkeys(self):
         """ See IMessageStore.
@@ -134,7 +349,23 @@ class MaildirStore:
         for row in cursor:
             yield row[0]
 
-    def drainInbox(self, pending_queue=None, limit=None, dry_run=False):
+    def knownMessageIds(self, message_ids):
+        """ Return the set of 'message_ids' already present in the store.
+        """
+        # Query in chunks to stay under SQLite's bound-parameter limit.
+        known = set()
+        message_ids = list(message_ids)
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i+500]
+            cursor = self.sql.execute('select message_id from messages '
+                                      'where message_id in (%s)'
+                                        % ','.join(['?'] * len(chunk)),
+                                      chunk)
+            known.update([row[0] for row in cursor])
+        return known
+
+    def drainInbox(self, pending_queue=None, limit=None, dry_run=False,
+                   batch_size=None, claim=None, headers_only=False):
         """ Drain any items from our inbox into the main store.
 
         - Process the messages in the order they were added to the maildir.
@@ -147,44 +378,383 @@ class MaildirStore:
 
         - If 'dry_run' is false, don't make any changes.
 
+        - 'batch_size' must be a positive integer, or None.  If not None,
+          store messages in batches of up to 'batch_size', using a single
+          SQL transaction per batch;  inbox messages are removed only after
+          their batch commits.
+
+        - 'claim' may be a name identifying this drainer among several
+          running concurrently against the same store.  If not None, each
+          message is first claimed by renaming it into a per-drainer
+          Maildir under 'Maildir/claimed';  messages claimed by other
+          drainers are skipped.  Messages left in the claim area by an
+          interrupted run are drained first.  Incompatible with 'dry_run'.
+          Without 'claim', messages in the claim areas are left alone
+          (see 'releaseClaims').
+
+        - If 'headers_only' is true, parse only the header block of each
+          inbox message, and link the message file into its dated folder
+          (rather than re-writing the parsed message there).
+
+        - A message which cannot be loaded or parsed (e.g., for a bad
+          ``Date``) is moved aside, into the 'Maildir/failed' Maildir, and
+          its error raised;  with 'batch_size', only after the rest of its
+          batch is stored.
+
         - Return a generator of the message IDs drained.
         """
         count = 0
         md = self._getMaildir()
-        keys = list(md.iterkeys())  # avoid mutating while iterating
-        for key in sorted(keys):    # preserve order
-            message = md.get_message(key)
+        if claim is not None:
+            if dry_run:
+                raise ValueError('Cannot claim messages during a dry run')
+            drained = self._drainClaimed(md, claim, pending_queue,
+                                         batch_size, limit, headers_only)
+            for message_id in drained:
+                yield message_id
+            return
+        keys = self._listInbox(md)    # preserve order
+        if batch_size and not dry_run:
+            drained = self._drainBatches(md, keys, pending_queue,
+                                         batch_size, limit, headers_only)
+        else:
+            drained = self._drainEach(md, keys, pending_queue, dry_run,
+                                      headers_only)
+        for message_id in drained:
+            yield message_id
+            count += 1
+            if limit and count >= limit:
+                break
+
+    def releaseClaims(self, keep=()):
+        """ Move the messages left in the claim areas (see 'drainInbox')
+        of drainers not named in 'keep' back into the inbox.
+
+        - Call only while no drainer outside 'keep' is running, e.g. when
+          a previous run used more drainers, or other names.
+
+        - Return the number of messages moved.
+        """
+        claims = os.path.join(self.mdpath, 'claimed')
+        if not os.path.isdir(claims):
+            return 0
+        inbox = self._getMaildir()._path
+        count = 0
+        for claim in sorted(os.listdir(claims)):
+            if claim in keep:
+                continue
+            for subdir in ('new', 'cur'):
+                path = os.path.join(claims, claim, subdir)
+                if not os.path.isdir(path):
+                    continue
+                for name in _listFiles(path):
+                    if name.startswith('.'):
+                        continue
+                    try:
+                        os.rename(os.path.join(path, name),
+                                  os.path.join(inbox, subdir, name))
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        continue # released by another drainer
+                    count += 1
+        return count
+
+    def _listInbox(self, md):
+        started = time.time()
+        keys = md.iterDelivered()
+        self.metrics.timing('store.enumerate', time.time() - started)
+        return keys
+
+    def _drainEach(self, md, keys, pending_queue, dry_run, headers_only):
+        for key in keys:
+            if dry_run:
+                yield self._loadMessage(md, key, headers_only)['Message-ID']
+                continue
+            path = os.path.join(md._path, md._lookup(key))
+            try:
+                message = self._loadMessage(md, key, headers_only)
+                self._getMessageDate(message)
+            except Exception:
+                # Don't let a bad message block the inbox.
+                self._setAside(md, key)
+                raise
             message_id = message['Message-ID']
-            if not dry_run:
-                try:
+            # Other errors storing the message, e.g. a full disk, leave
+            # it in the inbox, to retry.
+            try:
+                if headers_only:
+                    self.storeFile(message_id, path, key, message)
+                else:
                     self[message_id] = message
-                except sqlite3.IntegrityError:
-                    # Occasionally, certain Microsoft clients will resend
-                    # an identical message with the same message id
-                    # Skip these.
-                    continue
-                finally:
-                    # Make sure we remove the message from the incoming
-                    # Maildir no matter what.
-                    md.remove(key)
-            if not dry_run and pending_queue is not None:
+            except sqlite3.IntegrityError:
+                # Occasionally, certain Microsoft clients will resend
+                # an identical message with the same message id
+                # Skip these.
+                self.metrics.increment('store.duplicates')
+                _removeFile(path)
+                md.forget(key)
+                continue
+            _removeFile(path)
+            md.forget(key)
+            if pending_queue is not None:
                 pending_queue.push(message_id)
             yield message_id
+
+    def _drainBatches(self, md, keys, pending_queue, batch_size, limit,
+                      headers_only):
+        count = 0
+        keys = iter(keys)
+        while True:
+            size = batch_size
+            if limit:
+                size = min(size, limit - count)
+                if size <= 0:
+                    break
+            batch = list(islice(keys, size))
+            if not batch:
+                break
+            stored, failure = self._storeBatch(md, batch, pending_queue,
+                                               headers_only)
+            for message_id in stored:
+                yield message_id
+                count += 1
+            if failure is not None:
+                raise failure[0], failure[1], failure[2]
+
+    def _drainClaimed(self, md, claim, pending_queue, batch_size, limit,
+                      headers_only):
+        claimed = self._getClaimMaildir(claim)
+        count = 0
+        keys = self._listInbox(md)
+        exhausted = False
+        while True:
+            # Drain whatever is in the claim area, including messages left
+            # over from an interrupted run.
+            c_keys = self._listInbox(claimed)
+            if limit:
+                c_keys = islice(c_keys, limit - count)
+            if batch_size:
+                drained = self._drainBatches(claimed, c_keys, pending_queue,
+                                             batch_size, None, headers_only)
+            else:
+                drained = self._drainEach(claimed, c_keys, pending_queue,
+                                          False, headers_only)
+            for message_id in drained:
+                yield message_id
+                count += 1
+            how_many = batch_size or 1
+            if limit:
+                how_many = min(how_many, limit - count)
+            if how_many <= 0 or exhausted:
+                break
+            moved = self._claimMessages(md, claimed, keys, how_many)
+            if not moved:
+                break
+            exhausted = moved < how_many
+
+    def _claimMessages(self, md, claimed, keys, how_many):
+        # Move up to 'how_many' messages for the 'keys' iterator from the
+        # inbox into the 'claimed' Maildir.  The rename is atomic, so a
+        # message vanishing underneath us has been claimed by another
+        # drainer.  Return the number moved, fewer than 'how_many' only if
+        # 'keys' is exhausted.
+        count = 0
+        for key in keys:
+            subpath = md._toc.get(key)
+            if subpath is None:
+                continue
+            try:
+                os.rename(os.path.join(md._path, subpath),
+                          os.path.join(claimed._path, subpath))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                md.forget(key)
+                continue
+            md.forget(key)
             count += 1
-            if limit and count >= limit:
+            if count >= how_many:
                 break
+        return count
+
+    def _getClaimMaildir(self, claim):
+        claims = os.path.join(self.mdpath, 'claimed')
+        try:
+            os.mkdir(claims)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        return SaneFilenameMaildir(os.path.join(claims, claim),
+                                   factory=None,
+                                   create=True)
+
+    def _storeBatch(self, md, keys, pending_queue, headers_only):
+        # Store the inbox messages for 'keys' in a single transaction,
+        # removing them from the inbox only after the commit.  Messages
+        # which cannot be loaded or parsed are set aside.  Return the list
+        # of message IDs stored, and the 'sys.exc_info()' of the first
+        # message set aside (or None).
+        batch = []
+        failure = None
+        for key in keys:
+            path = os.path.join(md._path, md._lookup(key))
+            try:
+                message = self._loadMessage(md, key, headers_only)
+                self._getMessageDate(message)
+            except Exception:
+                if failure is None:
+                    failure = sys.exc_info()
+                self._setAside(md, key)
+                continue
+            batch.append((key, path, message['Message-ID'], message))
+        undo = []
+        rows = []
+        self._begin()
+        try:
+            seen = self.knownMessageIds([x[2] for x in batch])
+            for key, path, message_id, message in batch:
+                if message_id in seen:
+                    # Skip resent duplicates, as in '_drainEach'.
+                    continue
+                seen.add(message_id)
+                started = time.time()
+                (yy, mm, dd), f_key, undo_add = self._addToFolder(
+                                            key, path, message, headers_only)
+                self.metrics.timing('store.write', time.time() - started)
+                undo.append(undo_add)
+                rows.append((message_id, yy, mm, dd, f_key))
+            started = time.time()
+            self.sql.executemany('insert into messages'
+                                 '(message_id, year, month, day, maildir_key) '
+                                 'values(?, ?, ?, ?, ?)', rows)
+            self.metrics.timing('store.insert', time.time() - started)
+            started = time.time()
+            self.sql.commit()
+            self.metrics.timing('store.commit', time.time() - started)
+        except:
+            self.sql.rollback()
+            for undo_add in undo:
+                undo_add()
+            raise
+        for key, path, message_id, message in batch:
+            _removeFile(path)
+            md.forget(key)
+        stored = [row[0] for row in rows]
+        self.metrics.increment('store.stored', len(stored))
+        if len(stored) < len(batch):
+            self.metrics.increment('store.duplicates',
+                                   len(batch) - len(stored))
+        if pending_queue is not None:
+            push_many = getattr(pending_queue, 'push_many', None)
+            if push_many is not None:
+                push_many(stored) # one transaction for the batch
+            else:
+                for message_id in stored:
+                    pending_queue.push(message_id)
+        return stored, failure
+
+    def _loadMessage(self, md, key, headers_only):
+        started = time.time()
+        if headers_only:
+            message = _readHeaders(os.path.join(md._path,
+                                                     md._lookup(key)))
+        else:
+            message = md.get_message(key)
+        self.metrics.timing('store.parse', time.time() - started)
+        return message
+
+    def _addToFolder(self, key, path, message, link):
+        # Add the inbox message for 'key' (stored at 'path') to its dated
+        # folder, either by writing a copy of 'message' or by linking the
+        # inbox file, as in 'storeFile'.  Return the date, the key within
+        # the folder, and a callable which undoes the addition.
+        if link:
+            date = self._getMessageDate(message)
+            folder = self._getMaildir(self._getFolderName(*date))
+            dst = os.path.join(folder._path, 'new', key)
+            started = time.time()
+            created, renamed = self._placeFile(path, dst)
+            self.metrics.timing('store.file', time.time() - started)
+            if renamed:
+                return date, key, lambda: os.rename(dst, path)
+            if created:
+                return date, key, lambda: os.unlink(dst)
+            return date, key, lambda: None
+        to_store = mailbox.MaildirMessage(message)
+        date = self._getMessageDate(to_store)
+        folder = self._getMaildir(self._getFolderName(*date))
+        started = time.time()
+        f_key = folder.add(to_store)
+        self.metrics.timing('store.file', time.time() - started)
+        return date, f_key, lambda: folder.remove(f_key)
+
+    def _placeFile(self, src, dst):
+        # Hard-link 'src' to 'dst', falling back to a rename if links are
+        # not supported.  Return whether 'dst' was created, and whether
+        # 'src' was renamed.  If 'dst' is already a link to 'src', made by
+        # an interrupted drain, leave it be:  it may be the stored copy.
+        try:
+            os.link(src, dst)
+        except OSError, e:
+            if e.errno == errno.EEXIST and os.path.samefile(src, dst):
+                return False, False
+            if e.errno not in (errno.EPERM, errno.EOPNOTSUPP):
+                raise
+            os.rename(src, dst)
+            return True, True
+        return True, False
+
+    def _setAside(self, md, key):
+        # Move the message for 'key' out of 'md' into the 'failed' Maildir.
+        subpath = md._lookup(key)
+        failed = self._getFailedMaildir()
+        os.rename(os.path.join(md._path, subpath),
+                  os.path.join(failed._path, subpath))
+        md.forget(key)
+        self.metrics.increment('store.failed')
+
+    def _getFailedMaildir(self):
+        root = self._getMaildir()
+        return SaneFilenameMaildir(os.path.join(root._path, 'failed'),
+                                   factory=None, create=True)
+
+    def _begin(self):
+        # With the default (autocommit) isolation level, open an explicit
+        # transaction;  otherwise, the connection opens one implicitly.
+        if self.sql.isolation_level is None:
+            self.sql.execute('begin immediate')
+
+    def _getMessageDate(self, message):
+        yy, mm, dd, hh, mt, ss, wd, jd, dst = parsedate(message['Date'])
+        return yy, mm, dd
 
     def _getFolderName(self, yy, mm, dd):
         return '%04d.%02d.%02d' % (yy, mm, dd)
 
     def _getMaildir(self, folder=None, create=True):
-        root = md = SaneFilenameMaildir(self.mdpath,
-                                        factory=None,
-                                        create=create)
-        if folder is not None:
-            if folder not in root.list_folders():
+        root = self._root
+        if root is None:
+            root = self._root = SaneFilenameMaildir(self.mdpath,
+                                                    factory=None,
+                                                    create=create)
+        if folder is None:
+            return root
+        started = time.time()
+        md = self.folders.get(folder)
+        if md is None:
+            # Check the filesystem, rather than 'root.list_folders()', so
+            # that folders created by other processes are found cheaply.
+            if not os.path.isdir(os.path.join(self.mdpath, '.' + folder)):
                 if not create:
                     raise KeyError(folder)
-                root.add_folder(folder)
+                try:
+                    root.add_folder(folder)
+                except OSError, e:
+                    # Another process may have just created it.
+                    if e.errno != errno.EEXIST:
+                        raise
             md = root.get_folder(folder)
+            self.folders.put(folder, md)
+        self.metrics.timing('store.folder', time.time() - started)
         return md
@@ -0,0 +1,247 @@
+""" IMetrics implementations:  a null recorder, and exporters for the
+Prometheus node exporter's textfile collector and for StatsD.
+"""
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+from zope.interface import implements
+
+from repoze.mailin.interfaces import IMetrics
+
+class NullMetrics:
+    """ Discard all metrics.
+    """
+    implements(IMetrics)
+
+    def increment(self, name, value=1):
+        """ See IMetrics.
+        """
+
+    def gauge(self, name, value):
+        """ See IMetrics.
+        """
+
+    def timing(self, name, seconds):
+        """ See IMetrics.
+        """
+
+    def flush(self):
+        """ See IMetrics.
+        """
+
+_INVALID = re.compile(r'[^a-zA-Z0-9_]')
+
+# Upper bounds of the histogram buckets for timers, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+class PrometheusTextfileMetrics:
+    """ Accumulate metrics, writing them in the Prometheus text format to
+    the file at 'path', for the node exporter's textfile collector.
+
+    - Names are prefixed with 'prefix' and have dots replaced, e.g.
+      'store.write' becomes 'mailin_store_write'.  Counters get a '_total'
+      suffix;  timers become histograms (in seconds) with 'buckets'.
+
+    - 'labels', if passed, is a mapping of label names to values added to
+      every sample, e.g. to tell apart the files of several processes.
+
+    - The file is rewritten atomically, at most every 'interval' seconds as
+      metrics are recorded, and by 'flush'.
+    """
+    implements(IMetrics)
+
+    def __init__(self, path, prefix='mailin', interval=10.0,
+                 buckets=DEFAULT_BUCKETS, labels=None):
+        self.path = path
+        self.prefix = prefix
+        self.interval = interval
+        self.buckets = tuple(sorted(buckets))
+        self.labels = sorted((labels or {}).items())
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._lock = threading.Lock()
+        self._written = time.time()
+
+    def _name(self, name):
+        return _INVALID.sub('_', '%s_%s' % (self.prefix, name))
+
+    def _labels(self, *extra):
+        labels = self.labels + list(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(['%s="%s"' % x for x in labels])
+
+    def increment(self, name, value=1):
+        """ See IMetrics.
+        """
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + value
+        finally:
+            self._lock.release()
+        self._maybeFlush()
+
+    def gauge(self, name, value):
+        """ See IMetrics.
+        """
+        self._lock.acquire()
+        try:
+            self._gauges[name] = value
+        finally:
+            self._lock.release()
+        self._maybeFlush()
+
+    def timing(self, name, seconds):
+        """ See IMetrics.
+        """
+        self._lock.acquire()
+        try:
+            timer = self._timers.get(name)
+            if timer is None:
+                # [count per bucket, total count, sum]
+                timer = self._timers[name] = [[0] * len(self.buckets), 0, 0.0]
+            counts = timer[0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            timer[1] += 1
+            timer[2] += seconds
+        finally:
+            self._lock.release()
+        self._maybeFlush()
+
+    def _maybeFlush(self):
+        if time.time() - self._written >= self.interval:
+            self.flush()
+
+    def render(self):
+        """ Return the metrics in the Prometheus text format.
+        """
+        lines = []
+        labels = self._labels()
+        self._lock.acquire()
+        try:
+            for name, value in sorted(self._counters.items()):
+                name = self._name(name) + '_total'
+                lines.append('# TYPE %s counter' % name)
+                lines.append('%s%s %r' % (name, labels, value))
+            for name, value in sorted(self._gauges.items()):
+                name = self._name(name)
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s%s %r' % (name, labels, value))
+            for name, (counts, count, total) in sorted(self._timers.items()):
+                name = self._name(name) + '_seconds'
+                lines.append('# TYPE %s histogram' % name)
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append('%s_bucket%s %d'
+                                    % (name, self._labels(('le', repr(bound))),
+                                       cumulative))
+                lines.append('%s_bucket%s %d'
+                                % (name, self._labels(('le', '+Inf')), count))
+                lines.append('%s_sum%s %r' % (name, labels, total))
+                lines.append('%s_count%s %d' % (name, labels, count))
+        finally:
+            self._lock.release()
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """ See IMetrics.
+
+        - Write to a temporary file and rename it, so the collector never
+          reads a partial file.
+        """
+        self._written = time.time()
+        text = self.render()
+        directory, filename = os.path.split(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(prefix='.' + filename, dir=directory)
+        try:
+            os.write(fd, text)
+        finally:
+            os.close(fd)
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.path)
+
+class StatsDMetrics:
+    """ Send metrics to a StatsD server at 'host' and 'port', over UDP.
+
+    - Names are prefixed with 'prefix', e.g. 'mailin.store.write'.
+
+    - Sending never blocks, and errors are ignored:  metrics must not
+      interrupt mail handling.
+    """
+    implements(IMetrics)
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='mailin'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+    def _send(self, name, value, kind):
+        if self.prefix:
+            name = '%s.%s' % (self.prefix, name)
+        try:
+            self.socket.sendto('%s:%s|%s' % (name, value, kind),
+                               self.address)
+        except socket.error:
+            pass
+
+    def increment(self, name, value=1):
+        """ See IMetrics.
+        """
+        self._send(name, value, 'c')
+
+    def gauge(self, name, value):
+        """ See IMetrics.
+        """
+        self._send(name, value, 'g')
+
+    def timing(self, name, seconds):
+        """ See IMetrics.
+
+        - StatsD timers are in milliseconds.
+        """
+        self._send(name, '%.3f' % (seconds * 1000), 'ms')
+
+    def flush(self):
+        """ See IMetrics.
+        """
+
+def makeMetrics(spec, worker=None):
+    """ Return the IMetrics implementation described by 'spec', e.g. from a
+    command-line option:
+
+    - 'statsd:HOST:PORT' (with ':PORT' optional) sends to StatsD;
+
+    - 'textfile:PATH' writes a Prometheus textfile to 'PATH'.  If 'worker'
+      is passed, it is appended to the file's name (before any extension),
+      and added to its samples as the 'worker' label, so that each worker
+      process writes its own file.
+
+    - Raise ValueError for other specs.
+    """
+    kind, sep, rest = spec.partition(':')
+    if kind == 'statsd' and sep:
+        host, sep, port = rest.partition(':')
+        if port:
+            try:
+                port = int(port)
+            except ValueError:
+                raise ValueError('Invalid StatsD port: %s' % port)
+            return StatsDMetrics(host or '127.0.0.1', port)
+        return StatsDMetrics(host or '127.0.0.1')
+    if kind == 'textfile' and rest:
+        if worker is None:
+            return PrometheusTextfileMetrics(rest)
+        base, ext = os.path.splitext(rest)
+        return PrometheusTextfileMetrics('%s-%s%s' % (base, worker, ext),
+                                         labels={'worker': worker})
+    raise ValueError('Invalid metrics spec: %s' % spec)
@@ -1,23 +1,98 @@
 import os
 import sqlite3
+import time
 
 from zope.interface import implements
 
+from repoze.mailin.database import connect
 from repoze.mailin.interfaces import IPendingQueue
+from repoze.mailin.metrics import NullMetrics
+from repoze.mailin.schema import migrate
+from repoze.mailin.schema import partialIndex
+
+# Each step is a list of statements;  see 'repoze.mailin.schema.migrate'.
+_PENDING_SCHEMA = [
+    # 1:  initial schema.
+    ['create table if not exists pending'
+     '( id integer primary key'
+     ', message_id varchar(1024) unique'
+     ', quarantined boolean'
+     ', error_msg'
+     ')',
+    ],
+    # 2:  index the unquarantined messages, in queue order.
+    [partialIndex('create index if not exists pending_quarantined '
+                  'on pending(quarantined, id)', 'quarantined = 0'),
+    ],
+    # 3:  leases for 'claim' / 'ack' / 'nack'.
+    ['alter table pending add column lease_expires real',
+    ],
+    # 4:  trigger-maintained count of unquarantined messages.
+    ['create table if not exists pending_count(n integer not null)',
+     'insert into pending_count(n) '
+     'select count(*) from pending where quarantined=0',
+     'create trigger if not exists pending_count_insert '
+     'after insert on pending when new.quarantined=0 '
+     'begin update pending_count set n = n + 1; end',
+     'create trigger if not exists pending_count_delete '
+     'after delete on pending when old.quarantined=0 '
+     'begin update pending_count set n = n - 1; end',
+     'create trigger if not exists pending_count_update '
+     'after update of quarantined on pending '
+     'when (old.quarantined=0) != (new.quarantined=0) '
+     'begin update pending_count set n = n + '
+     '(case when new.quarantined=0 then 1 else -1 end); end',
+    ],
+    # 5:  index the leased messages, to subtract them from the count.
+    [partialIndex('create index if not exists pending_leased '
+                  'on pending(lease_expires)', 'lease_expires is not null'),
+    ],
+]
+
+# Messages which are neither quarantined nor under an unexpired lease.
+_AVAILABLE = ('quarantined=0 and '
+              '(lease_expires is null or lease_expires <= :now)')
 
 class PendingQueue(object):
     """ SQLite implementation of IPendingQueue.
+
+    - Timings and counts of queue operations are recorded to 'metrics' (an
+      IMetrics), if passed.
+
+    - The database is tuned according to 'profile', e.g. 'wal' (see
+      'repoze.mailin.database.PROFILES');  'timeout', 'journal_mode' and
+      'synchronous', if passed, override its settings.
+
+    - 'group_commit_size' and / or 'group_commit_ms', if passed, buffer
+      'push':  the buffered IDs are inserted in one transaction once there
+      are 'group_commit_size' of them, or on the first push at least
+      'group_commit_ms' milliseconds after the oldest, and by 'flush'.
+      Reading or updating the queue flushes first.  IDs still buffered when
+      the process dies are lost, so producers must 'flush' before
+      forgetting the messages' sources.
     """
     implements(IPendingQueue)
+    _returning = sqlite3.sqlite_version_info >= (3, 35, 0)
 
     def __init__(self,
                  path=None,
                  dbfile=None,
                  isolation_level=None,
                  logger=None,
+                 timeout=None,
+                 metrics=None,
+                 profile=None,
+                 journal_mode=None,
+                 synchronous=None,
+                 group_commit_size=None,
+                 group_commit_ms=None,
                 ):
 
         self.path = path
+        self.group_commit_size = group_commit_size
+        self.group_commit_ms = group_commit_ms
+        self._buffer = []
+        self._buffered_at = None
 
         if path is None:
             dbfile = ':memory:'
@@ -25,74 +100,207 @@ class PendingQueue(object):
         if dbfile is None:
             dbfile = os.path.join(path, 'pending.db')
 
-        sql = self.sql = sqlite3.connect(dbfile,
-                                         isolation_level=isolation_level)
+        sql = self.sql = connect(dbfile, profile, isolation_level, timeout,
+                                 journal_mode=journal_mode,
+                                 synchronous=synchronous)
         sql.text_factory = str
-
-        found = sql.execute('select * from sqlite_master '
-                             'where type = "table" and name = "pending"'
-                           ).fetchall()
-        if not found:
-            sql.execute('create table pending'
-                        '( id integer primary key'
-                        ', message_id varchar(1024) unique'
-                        ', quarantined boolean'
-                        ', error_msg'
-                        ')')
+        migrate(sql, 'pending', _PENDING_SCHEMA)
 
         if logger is not None and getattr(logger, 'log', None) is None:
             raise ValueError('logger must implement logging module interface.')
 
         self.logger = logger
 
+        if metrics is None:
+            metrics = NullMetrics()
+        self.metrics = metrics
+
     def push(self, message_id):
         """ See IPendingQueue.
+
+        - If buffering, see the class docstring.
         """
-        self.sql.execute('insert into pending(message_id, quarantined) '
-                         'values(?,?)', (message_id, False))
+        if self.group_commit_size is None and self.group_commit_ms is None:
+            self.push_many([message_id])
+            return
+        if not self._buffer:
+            self._buffered_at = time.time()
+        self._buffer.append(message_id)
+        if (self.group_commit_size is not None and
+                len(self._buffer) >= self.group_commit_size):
+            self.flush()
+        elif (self.group_commit_ms is not None and
+                (time.time() - self._buffered_at) * 1000
+                    >= self.group_commit_ms):
+            self.flush()
+
+    def push_many(self, message_ids):
+        """ Push each of 'message_ids' onto the queue, in one transaction.
+
+        - With the default (autocommit) isolation level, the IDs are
+          committed together;  otherwise, the caller's transaction rules.
+
+        - If any ID is already queued, raise IntegrityError;  under
+          autocommit, none of them is then pushed.
+        """
+        message_ids = list(message_ids)
+        if not message_ids:
+            return
+        started = time.time()
+        autocommit = self.sql.isolation_level is None
+        if autocommit and len(message_ids) > 1:
+            self.sql.execute('begin immediate')
+        else:
+            autocommit = False
+        try:
+            self.sql.executemany('insert into pending'
+                                 '(message_id, quarantined) values(?,?)',
+                                 [(m_id, False) for m_id in message_ids])
+            if autocommit:
+                self.sql.commit()
+        except:
+            if autocommit:
+                self.sql.rollback()
+            raise
+        self.metrics.timing('queue.push', time.time() - started)
+        self.metrics.increment('queue.pushed', len(message_ids))
+
+    def flush(self):
+        """ Push any buffered message IDs.
+
+        - IDs already queued are skipped:  the buffered 'push' calls cannot
+          report them.
+
+        - If the push fails otherwise, the IDs stay buffered.
+        """
+        if not self._buffer:
+            return
+        buffered, self._buffer = self._buffer, []
+        try:
+            try:
+                self.push_many(buffered)
+            except sqlite3.IntegrityError:
+                # Push them one by one, skipping the duplicates.
+                while buffered:
+                    try:
+                        self.push_many(buffered[:1])
+                    except sqlite3.IntegrityError:
+                        self.metrics.increment('queue.duplicates')
+                    del buffered[0]
+        except:
+            self._buffer = buffered + self._buffer
+            raise
 
     def pop(self, how_many=1):
         """ See IPendingQueue.
         """
-        cursor = self.sql.execute('select id, message_id from pending '
-                                 'where quarantined=0 order by id')
-        if how_many is None:
-            rows = cursor.fetchall()
-            how_many = len(rows)
-        else:
-            rows = cursor.fetchmany(how_many)
-        cursor.close()
-        count = 0
-        popped_ids = []
-        popped_m_ids = []
-        while rows and count < how_many:
-            id, m_id = rows.pop(0)
-            popped_m_ids.append(m_id)
-            popped_ids.append(str(id))
-            count += 1
-        if count < how_many:
+        self.flush()
+        started = time.time()
+        rows = self._claimRows(how_many,
+                               'delete from pending where %s' % _AVAILABLE,
+                               'delete from pending where id = :id')
+        popped_m_ids = [m_id for id, m_id in rows]
+        count = len(popped_m_ids)
+        self.metrics.timing('queue.pop', time.time() - started)
+        self.metrics.increment('queue.popped', count)
+        if how_many is not None and count < how_many:
+            self.metrics.increment('queue.underflow')
             if self.logger is not None:
                 self.logger.log('Queue underflow: requested %d, popped %d'
                                   % (how_many, count))
-        set = ','.join(['"%s"' % x for x in popped_ids])
-        self.sql.execute('delete from pending where id in (%s)' % set)
         return popped_m_ids
 
+    def claim(self, how_many=1, lease_seconds=300):
+        """ See IPendingQueue.
+        """
+        self.flush()
+        started = time.time()
+        rows = self._claimRows(how_many,
+                               'update pending set lease_expires = :expires '
+                               'where %s' % _AVAILABLE,
+                               'update pending set lease_expires = :expires '
+                               'where id = :id',
+                               lease_seconds)
+        self.metrics.timing('queue.claim', time.time() - started)
+        self.metrics.increment('queue.claimed', len(rows))
+        return [m_id for id, m_id in rows]
+
+    def ack(self, message_id):
+        """ See IPendingQueue.
+        """
+        self.remove(message_id)
+        self.metrics.increment('queue.acked')
+
+    def nack(self, message_id):
+        """ See IPendingQueue.
+        """
+        self.flush()
+        cursor = self.sql.execute('update pending set lease_expires = null '
+                                  'where message_id = ?', (message_id,))
+        if cursor.rowcount == 0:
+            raise KeyError(message_id)
+        self.metrics.increment('queue.nacked')
+
+    def _claimRows(self, how_many, claim_available, claim_one,
+                   lease_seconds=0):
+        # Atomically apply a claiming statement to the first 'how_many'
+        # available rows (all of them, if None), returning their
+        # '(id, message_id)' in queue order.  'claim_available' is the
+        # statement, ending in a 'where' clause for available rows;
+        # 'claim_one' is its single-row form, taking an ':id'.  Both may
+        # use ':now' and ':expires'.
+        now = time.time()
+        params = {'now': now,
+                  'expires': now + lease_seconds,
+                  'limit': how_many is None and -1 or how_many,
+                 }
+        if self._returning:
+            # A single statement is atomic, whatever the isolation level.
+            # The rows are the lowest available IDs, so restricting the
+            # available rows to those below the highest selects them.
+            rows = self.sql.execute(
+                '%s and id <= (select max(id) from (select id from pending '
+                'where %s order by id limit :limit)) returning id, message_id'
+                    % (claim_available, _AVAILABLE), params).fetchall()
+            rows.sort()
+            return rows
+        # Fallback for SQLite < 3.35, which lacks 'returning'.  With the
+        # default (autocommit) isolation level, 'begin immediate' keeps
+        # other consumers out;  otherwise, the caller's transaction rules.
+        autocommit = self.sql.isolation_level is None
+        if autocommit:
+            self.sql.execute('begin immediate')
+        try:
+            rows = self.sql.execute('select id, message_id from pending '
+                                    'where %s order by id limit :limit'
+                                        % _AVAILABLE, params).fetchall()
+            self.sql.executemany(claim_one,
+                                 [dict(params, id=row[0]) for row in rows])
+            if autocommit:
+                self.sql.commit()
+        except:
+            if autocommit:
+                self.sql.rollback()
+            raise
+        return rows
+
     def remove(self, message_id):
         """ See IPendingQueue.
         """
+        self.flush()
         cursor = self.sql.execute('delete from pending '
-                                  'where message_id = "%s"' % message_id)
+                                  'where message_id = ?', (message_id,))
         if cursor.rowcount == 0:
             raise KeyError(message_id)
 
     def quarantine(self, message_id, error_msg=None):
         """ See IPendingQueue
         """
+        self.flush()
         if message_id in self:
             self.sql.execute(
-                'update pending set quarantined=?, error_msg=? '
-                'where message_id=?',
+                'update pending set quarantined=?, error_msg=?, '
+                'lease_expires=null where message_id=?',
                 (True, error_msg, message_id)
             )
         else:
@@ -101,6 +309,7 @@ class PendingQueue(object):
                 'values (?,?,?)',
                 (message_id, True, error_msg)
             )
+        self.metrics.increment('queue.quarantined')
 
     def iter_quarantine(self):
         """ See IPendingQueue
@@ -132,16 +341,36 @@ class PendingQueue(object):
     def __nonzero__(self):
         """ See IPendingQueue.
         """
+        self.flush()
+        return bool(self.sql.execute(
+            'select exists (select 1 from pending where %s)' % _AVAILABLE,
+            {'now': time.time()}).fetchone()[0])
+
+    def __len__(self):
+        """ See IPendingQueue.
+        """
+        # 'quarantine' and 'nack' clear leases, so every unexpired lease
+        # is on a message counted in 'pending_count'.
+        self.flush()
         return self.sql.execute(
-            'select count(*) from pending where quarantined=0'
-            ).fetchone()[0]
+            'select (select n from pending_count) - '
+            '(select count(*) from pending where lease_expires > :now)',
+            {'now': time.time()}).fetchone()[0]
+
+    def depth(self):
+        """ See IPendingQueue.
+        """
+        self.flush()
+        return self.sql.execute('select n from pending_count').fetchone()[0]
 
     def __iter__(self):
+        self.flush()
         return self.sql.execute(
-            'select id, message_id from pending where quarantined=0'
-        )
+            'select id, message_id from pending where %s' % _AVAILABLE,
+            {'now': time.time()})
 
     def __contains__(self, message_id):
+        self.flush()
         cursor = self.sql.execute(
             'select message_id from pending where message_id=?', (message_id,)
             )
@@ -150,5 +379,10 @@ class PendingQueue(object):
         return contains
 
     def __del__(self):
-        self.sql.close()
+        if 'sql' not in self.__dict__:
+            return # '__init__' failed to connect
+        try:
+            self.flush()
+        finally:
+            self.sql.close()
         del self.sql
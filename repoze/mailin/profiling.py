@@ -0,0 +1,150 @@
+""" Profile script runs:  a cProfile of the run, plus a breakdown of the
+time spent in each phase of handling messages (as reported via IMetrics).
+"""
+import cProfile
+import threading
+import time
+
+from zope.interface import implements
+
+from repoze.mailin.interfaces import IMetrics
+from repoze.mailin.metrics import NullMetrics
+
+# Descriptions of the phases reported by the store, queue and scripts.
+PHASES = {'store.enumerate': 'list inbox',
+          'store.parse': 'parse message',
+          'store.folder': 'folder lookup',
+          'store.file': 'file write / link',
+          'store.insert': 'SQL insert',
+          'store.commit': 'SQL commit',
+          'store.write': 'store message (total)',
+          'store.load': 'load message',
+          'queue.push': 'pending push',
+          'queue.pop': 'pending pop',
+          'queue.claim': 'pending claim',
+          'imap.connect': 'IMAP connect',
+          'imap.fetch': 'IMAP fetch',
+          'imap.fetch_headers': 'IMAP fetch headers',
+          'imap.stream': 'IMAP stream to disk',
+          'imap.parse': 'parse fetched message',
+          'imap.delete': 'IMAP delete / expunge',
+          'draino.drain': 'drain (total)',
+          'pollster.poll': 'poll (total)',
+          'pollster.store': 'store polled message',
+         }
+
+def expandProfileOption(argv, default):
+    """ Return a copy of 'argv' in which a bare '--profile' option is given
+    the value 'default' (as '--profile=default').
+
+    - 'getopt' does not support options with optional values.
+    """
+    result = []
+    for i, arg in enumerate(argv):
+        if arg == '--':
+            return result + argv[i:]
+        if arg == '--profile':
+            arg = '--profile=%s' % default
+        result.append(arg)
+    return result
+
+class PhaseTimer:
+    """ Accumulate the timings reported for each phase.
+
+    - Also passes everything through to 'wrapped', another IMetrics.
+    """
+    implements(IMetrics)
+
+    def __init__(self, wrapped=None):
+        if wrapped is None:
+            wrapped = NullMetrics()
+        self.wrapped = wrapped
+        self.phases = {} # name -> [calls, total, max]
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        """ See IMetrics.
+        """
+        self.wrapped.increment(name, value)
+
+    def gauge(self, name, value):
+        """ See IMetrics.
+        """
+        self.wrapped.gauge(name, value)
+
+    def timing(self, name, seconds):
+        """ See IMetrics.
+        """
+        self._lock.acquire()
+        try:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = [0, 0.0, 0.0]
+            phase[0] += 1
+            phase[1] += seconds
+            phase[2] = max(phase[2], seconds)
+        finally:
+            self._lock.release()
+        self.wrapped.timing(name, seconds)
+
+    def flush(self):
+        """ See IMetrics.
+        """
+        self.wrapped.flush()
+
+    def report(self, elapsed):
+        """ Return a table of the phases, by total time, with each total's
+        share of 'elapsed' seconds.
+
+        - Phases may nest (e.g., 'store.file' within 'store.write'), or
+          overlap in concurrent threads, so shares need not add up to 100%.
+        """
+        lines = ['%-20s %-24s %8s %10s %10s %10s %6s'
+                    % ('phase', 'description', 'calls', 'total s',
+                       'mean ms', 'max ms', '%'),
+                ]
+        self._lock.acquire()
+        try:
+            phases = sorted(self.phases.items(),
+                            key=lambda x: (-x[1][1], x[0]))
+        finally:
+            self._lock.release()
+        for name, (calls, total, longest) in phases:
+            share = elapsed and 100 * total / elapsed or 0
+            lines.append('%-20s %-24s %8d %10.3f %10.3f %10.3f %6.1f'
+                            % (name, PHASES.get(name, ''), calls, total,
+                               1000 * total / calls, 1000 * longest, share))
+        lines.append('%-20s %-24s %8s %10.3f' % ('(run)', 'elapsed', '',
+                                                 elapsed))
+        return '\n'.join(lines) + '\n'
+
+class Profiler:
+    """ Profile a call with cProfile, timing its phases via 'phases' (a
+    PhaseTimer, to be passed as the 'metrics' of the stores and scripts).
+
+    - 'write' saves the profile to 'path' (for 'pstats', or a viewer such
+      as 'snakeviz'), and the phase breakdown to 'path' + '.phases'.
+
+    - cProfile sees only the calling thread;  the phase timings cover all.
+    """
+    elapsed = 0.0
+
+    def __init__(self, path):
+        self.path = path
+        self.phases = PhaseTimer()
+        self.profile = cProfile.Profile()
+
+    def runcall(self, func, *args):
+        started = time.time()
+        try:
+            return self.profile.runcall(func, *args)
+        finally:
+            self.elapsed = time.time() - started
+
+    def write(self):
+        self.profile.dump_stats(self.path)
+        f = open(self.path + '.phases', 'w')
+        try:
+            f.write(self.phases.report(self.elapsed))
+        finally:
+            f.close()
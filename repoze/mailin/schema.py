@@ -0,0 +1,69 @@
+""" Versioned schema migrations for the SQLite databases.
+"""
+import sqlite3
+
+
+def migrate(sql, name, steps):
+    """ Bring the schema named 'name' in the database on 'sql' up to date.
+
+    - 'steps' is a sequence of migration steps, each a sequence of SQL
+      statements;  the version of the schema is the number of steps which
+      have been applied to it.
+
+    - Versions are recorded in the 'schema_versions' table, so that several
+      schemas may share one database file.
+
+    - Each step is applied in its own transaction, so that concurrent
+      openers do not apply it twice.
+
+    - Return the resulting version.
+    """
+    isolation_level = sql.isolation_level
+    sql.isolation_level = None # manage the transactions ourselves
+    try:
+        sql.execute('create table if not exists schema_versions'
+                    '( name varchar(64) primary key'
+                    ', version integer not null'
+                    ')')
+        version = getVersion(sql, name)
+        while version < len(steps):
+            sql.execute('begin immediate')
+            try:
+                version = getVersion(sql, name)
+                if version < len(steps):
+                    for statement in steps[version]:
+                        sql.execute(statement)
+                    version += 1
+                    sql.execute('insert or replace into schema_versions'
+                                '(name, version) values(?, ?)',
+                                (name, version))
+                sql.execute('commit')
+            except:
+                sql.execute('rollback')
+                raise
+        return version
+    finally:
+        sql.isolation_level = isolation_level
+
+
+def getVersion(sql, name):
+    """ Return the applied version of the schema named 'name', or 0.
+    """
+    try:
+        row = sql.execute('select version from schema_versions '
+                          'where name = ?', (name,)).fetchone()
+    except sqlite3.OperationalError: # no 'schema_versions' table
+        return 0
+    if row is None:
+        return 0
+    return row[0]
+
+
+def partialIndex(statement, where):
+    """ Return 'statement' restricted by 'where', if SQLite supports
+    partial indexes (3.8.0 and later).
+    """
+    if sqlite3.sqlite_version_info >= (3, 8, 0):
+        return '%s where %s' % (statement, where)
+    return statement #pragma NO COVERAGE
+
@@ -10,6 +10,57 @@ OPTIONS can include:
 
  --limit, -l            Limit the number of messages drained.
 
+ --batch-size, -b       Store messages in batches of this size, committing
+                        one SQLite transaction per batch.
+
+ --sqlite-profile, -P   Tune the SQLite databases according to this profile:
+                        'default' (SQLite's defaults), 'wal' (a write-ahead
+                        log, so that readers such as 'mailin-process' never
+                        block draino, and a longer busy timeout) or 'fast'
+                        (as 'wal', plus memory-mapped reads and a larger
+                        cache).  WAL mode persists in the database files.
+
+ --headers-only, -H     Parse only message headers, and link each message
+                        file into its dated folder instead of re-writing it.
+
+ --workers, -w          Drain using this many worker processes, each of
+                        which claims inbox messages atomically before
+                        storing them.  Any '--limit' is divided among
+                        the workers.  Messages left claimed by workers of
+                        an earlier run are returned to the inbox.
+                        Incompatible with '--dry-run'.
+
+ --release-claims, -r   Without '--workers', first return any messages left
+                        claimed by the workers of an earlier '--workers'
+                        run to the inbox.  Don't use while such a run is
+                        still draining.  Incompatible with '--dry-run'.
+
+ --watch, -W            Keep running, draining messages as they are
+                        delivered into the inbox.  Uses inotify if the
+                        'pyinotify' package is installed;  otherwise, polls
+                        the inbox every '--interval' seconds.  A drain
+                        which fails is reported and retried, backing off
+                        from one second up to five minutes.  Incompatible
+                        with '--dry-run'.
+
+ --interval, -i         In watch mode without inotify, seconds between polls
+                        of the inbox:  default, 1.
+
+ --metrics, -e          Export metrics (drain and SQLite timings, counts
+                        and the pending queue's depth):  either
+                        'statsd:HOST:PORT' to send them to StatsD, or
+                        'textfile:PATH' to write them to a file for the
+                        Prometheus node exporter (with '--workers', one file
+                        per worker, its name suffixed with the worker's).
+
+ --profile[=PATH]       Profile the run with cProfile, writing the profile
+                        to PATH (default, 'draino.prof'), and a breakdown of
+                        the time spent in each phase (listing the inbox,
+                        parsing, folder lookup, file writes, SQL inserts and
+                        commits, pending queue pushes) to PATH + '.phases'.
+                        With '--workers', each worker writes its own files,
+                        PATH suffixed with the worker's name.
+
  --dry-run, -n          Don't make any changes, just show what would be done.
 
  --verbose, -v          Be noisier (can be repeated).
@@ -19,29 +70,70 @@ OPTIONS can include:
  --help, -h, -?         Print this message and exit.
 """
 import getopt
+import multiprocessing
 import os
 import sys
+import time
 
+from repoze.mailin.database import getProfile
 from repoze.mailin.maildir import MaildirStore
+from repoze.mailin.metrics import NullMetrics
+from repoze.mailin.metrics import makeMetrics
 from repoze.mailin.pending import PendingQueue
+from repoze.mailin.profiling import Profiler
+from repoze.mailin.profiling import expandProfileOption
+from repoze.mailin.watch import InboxWatcher
+
+def splitLimit(limit, workers):
+    """ Return a list of the 'limit' for each of 'workers', summing to
+    'limit';  the first 'limit % workers' get one more than the rest.
+    A false 'limit' (no limit) is passed to each.
+    """
+    if not limit:
+        return [limit] * workers
+    each, extra = divmod(limit, workers)
+    return [each + (i < extra) for i in range(workers)]
 
 class Draino:
 
     pending_queue = None
     limit = None
+    batch_size = None
+    sqlite_profile = None
+    headers_only = False
+    workers = 1
+    release_claims = False
+    watch = False
+    interval = 1.0
+    min_backoff = 1
+    max_backoff = 300
+    metrics = None
+    profile = None
+    profiler = None
     dry_run = False
     verbose = 1
+    lock_timeout = 60.0 # seconds workers wait on each other's SQL writes
 
     def __init__(self, argv):
         self.parseOptions(argv)
 
     def parseOptions(self, argv):
         pending_queue = None
+        argv = expandProfileOption(argv, 'draino.prof')
         try:
             options, arguments = getopt.gnu_getopt(argv[1:],
-                                                   'p:l:nvqh?',
+                                                   'p:l:b:P:Hw:rWi:e:nvqh?',
                                                    ['pending-queue=',
                                                     'limit=',
+                                                    'batch-size=',
+                                                    'sqlite-profile=',
+                                                    'headers-only',
+                                                    'workers=',
+                                                    'release-claims',
+                                                    'watch',
+                                                    'interval=',
+                                                    'metrics=',
+                                                    'profile=',
                                                     'dry-run',
                                                     'verbose',
                                                     'quiet',
@@ -61,6 +153,50 @@ class Draino:
                 except ValueError:
                     self.usage('Limit must be an integer: %s' % v)
 
+            elif k in ('-b', '--batch-size'):
+                try:
+                    self.batch_size = int(v)
+                except ValueError:
+                    self.usage('Batch size must be an integer: %s' % v)
+
+            elif k in ('-P', '--sqlite-profile'):
+                try:
+                    getProfile(v)
+                except ValueError, e:
+                    self.usage(str(e))
+                self.sqlite_profile = v
+
+            elif k in ('-H', '--headers-only'):
+                self.headers_only = True
+
+            elif k in ('-w', '--workers'):
+                try:
+                    self.workers = int(v)
+                except ValueError:
+                    self.usage('Workers must be an integer: %s' % v)
+
+            elif k in ('-r', '--release-claims'):
+                self.release_claims = True
+
+            elif k in ('-W', '--watch'):
+                self.watch = True
+
+            elif k in ('-i', '--interval'):
+                try:
+                    self.interval = float(v)
+                except ValueError:
+                    self.usage('Interval must be a number: %s' % v)
+
+            elif k in ('-e', '--metrics'):
+                try:
+                    makeMetrics(v)
+                except ValueError, e:
+                    self.usage(str(e))
+                self.metrics = v
+
+            elif k == '--profile':
+                self.profile = os.path.abspath(v)
+
             elif k in ('-n', '--dry-run'):
                 self.dry_run = True
 
@@ -76,6 +212,18 @@ class Draino:
             else:
                 self.usage('Unknown option: %s' % k)
 
+        if self.batch_size is not None and self.batch_size < 0:
+            self.usage('Batch size must not be negative')
+
+        if self.workers > 1 and self.dry_run:
+            self.usage('Cannot use multiple workers during a dry run')
+
+        if self.release_claims and self.dry_run:
+            self.usage('Cannot release claims during a dry run')
+
+        if self.watch and self.dry_run:
+            self.usage('Cannot watch the inbox during a dry run')
+
         if len(arguments) != 1:
             self.usage('Must supply maildir_path')
 
@@ -103,20 +251,159 @@ class Draino:
             print 
         sys.exit(rc)
 
+    def open_metrics(self, worker=None):
+        if self.metrics is None:
+            metrics = NullMetrics()
+        else:
+            metrics = makeMetrics(self.metrics, worker)
+        if self.profiler is not None:
+            self.profiler.phases.wrapped = metrics
+            metrics = self.profiler.phases
+        return metrics
+
+    def profiled(self, worker, func, *args):
+        # Call 'func' under a profiler, whose phase timer 'open_metrics'
+        # then hands out.
+        path = self.profile
+        if worker is not None:
+            base, ext = os.path.splitext(path)
+            path = '%s-%s%s' % (base, worker, ext)
+        self.profiler = Profiler(path)
+        try:
+            return self.profiler.runcall(func, *args)
+        finally:
+            self.profiler.write()
+            if self.verbose:
+                print 'Profile written  : ', path
+
+    def report(self, metrics, pq, count, started):
+        metrics.timing('draino.drain', time.time() - started)
+        metrics.increment('draino.drained', count)
+        if self.pending_queue is not None:
+            metrics.gauge('queue.depth', pq.depth())
+        metrics.flush()
+
     def do_drain(self):
+        if self.workers > 1:
+            return self.do_drain_parallel()
+
+        metrics = self.open_metrics()
+        if self.pending_queue is not None:
+            pq = PendingQueue(self.pending_queue, metrics=metrics,
+                              profile=self.sqlite_profile)
+        else:
+            pq = PendingQueue(metrics=metrics)
+
+        md = MaildirStore(self.maildir_path, metrics=metrics,
+                          profile=self.sqlite_profile)
+        if self.release_claims:
+            md.releaseClaims()
+
+        def drain():
+            started = time.time()
+            count = 0
+            for drained in md.drainInbox(pq, self.limit, self.dry_run,
+                                         self.batch_size,
+                                         headers_only=self.headers_only):
+                if self.verbose > 1:
+                    print ' -', drained
+                count += 1
+
+            if not self.dry_run:
+                md.sql.commit()
+                pq.sql.commit()
+            self.report(metrics, pq, count, started)
+            return count
+
+        if self.watch:
+            self.watch_inbox(md, drain, self.limit)
+        else:
+            drain()
+
+    def do_drain_parallel(self):
+        plan = []
+        for i, limit in enumerate(splitLimit(self.limit, self.workers)):
+            if limit or not self.limit: # skip workers with nothing to do
+                plan.append(('worker-%d' % i, limit))
+        # Return messages claimed by workers of an earlier run, but not
+        # by this one's:  theirs are drained first.
+        md = MaildirStore(self.maildir_path, profile=self.sqlite_profile)
+        md.releaseClaims([claim for claim, limit in plan])
+        md.sql.close()
+        workers = []
+        for claim, limit in plan:
+            worker = multiprocessing.Process(target=self.run_worker,
+                                             args=(claim, limit))
+            worker.start()
+            workers.append(worker)
+        failed = 0
+        for worker in workers:
+            worker.join()
+            if worker.exitcode:
+                failed += 1
+        if failed:
+            print '%d of %d workers failed' % (failed, len(workers))
+            sys.exit(1)
+
+    def run_worker(self, claim, limit):
+        if self.profile is not None:
+            self.profiled(claim, self.do_drain_claimed, claim, limit)
+        else:
+            self.do_drain_claimed(claim, limit)
+
+    def do_drain_claimed(self, claim, limit):
+        metrics = self.open_metrics(claim)
         if self.pending_queue is not None:
-            pq = PendingQueue(self.pending_queue)
+            pq = PendingQueue(self.pending_queue, timeout=self.lock_timeout,
+                              metrics=metrics, profile=self.sqlite_profile)
         else:
-            pq = PendingQueue()
+            pq = PendingQueue(metrics=metrics)
+
+        md = MaildirStore(self.maildir_path, timeout=self.lock_timeout,
+                          metrics=metrics, profile=self.sqlite_profile)
 
-        md = MaildirStore(self.maildir_path)
-        for drained in md.drainInbox(pq, self.limit, self.dry_run):
-            if self.verbose > 1:
-                print ' -', drained
+        def drain():
+            started = time.time()
+            count = 0
+            for drained in md.drainInbox(pq, limit, False, self.batch_size,
+                                         claim=claim,
+                                         headers_only=self.headers_only):
+                if self.verbose > 1:
+                    print ' -', claim, drained
+                count += 1
 
-        if not self.dry_run:
             md.sql.commit()
             pq.sql.commit()
+            self.report(metrics, pq, count, started)
+            return count
+
+        if self.watch:
+            self.watch_inbox(md, drain, limit)
+        else:
+            drain()
+
+    def watch_inbox(self, md, drain, limit):
+        # Call 'drain' whenever messages are delivered, or immediately again
+        # if it stopped at 'limit';  if it fails, again after a backoff.
+        watcher = InboxWatcher(md._getMaildir()._path, self.interval)
+        backoff = self.min_backoff
+        try:
+            while True:
+                try:
+                    count = drain()
+                except Exception, e:
+                    md.metrics.increment('draino.errors')
+                    if self.verbose:
+                        print 'error: %s;  retrying in %d seconds' % (
+                                    e, backoff)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                backoff = self.min_backoff
+                if not limit or count < limit:
+                    watcher.wait()
+        finally:
+            watcher.close()
 
     def run(self):
         if self.verbose:
@@ -126,8 +413,17 @@ class Draino:
 
             print 'Dry-run          : ', self.dry_run
             print 'Pending queue    : ', self.pending_queue
-
-        self.do_drain()
+            print 'Batch size       : ', self.batch_size
+            print 'Headers only     : ', self.headers_only
+            print 'Workers          : ', self.workers
+            print 'Watch?           : ', self.watch
+            print 'Metrics          : ', self.metrics
+            print 'Profile          : ', self.profile
+
+        if self.profile is not None and self.workers == 1:
+            self.profiled(None, self.do_drain)
+        else:
+            self.do_drain()
 
         if self.verbose:
             print
@@ -1,7 +1,10 @@
 """ pollster [OPTIONS] maildir_path imap_host credentials
+    pollster [OPTIONS] --config config_file maildir_path
 
 Poll the inbox of the IMAP account at 'imap_host', moving the messages
-into date-based folders in a local maildir.
+into date-based folders in a local maildir.  With '--config', poll each
+of the accounts listed in 'config_file' concurrently, into the same maildir
+(and pending queue).
 
 'maildir_path'
     the target maildir 
@@ -17,6 +20,23 @@ into date-based folders in a local maildir.
 
 OPTIONS can include:
 
+ --config, -f           Poll the accounts listed in this file rather than
+                        the one given on the command line.  Each section
+                        names an account, e.g.:
+
+                          [phred]
+                          host = imap.example.com:993
+                          credentials = phred:secret
+                          mailbox = INBOX
+                          ssl = true
+
+                        where 'host' and 'credentials' are as above, and
+                        'mailbox' and 'ssl' are optional, defaulting as
+                        for the options below.
+
+ --max-connections, -M  With '--config', the most connections to open to
+                        any one IMAP server at once:  default, 4.
+
  --mailbox, -m          The name of the mailbox being polled: default, 'INBOX'.
 
  --ssl, -s              Use SSL (enabled by default if port is 993).
@@ -31,7 +51,61 @@ OPTIONS can include:
  --pending-queue, -p    SQLite database filename for the 'pending queue'.
                         If omitted, no pending queue entries will be made.
 
- --limit, -l            Limit the number of messages polled.
+ --group-commit, -g     Buffer pending queue entries, inserting up to this
+                        many in one SQLite transaction;  the rest are
+                        inserted before the messages are deleted from the
+                        server.
+
+ --sqlite-profile, -P   Tune the SQLite databases according to this profile:
+                        'default' (SQLite's defaults), 'wal' (a write-ahead
+                        log, so that readers such as 'mailin-process' never
+                        block pollster, and a longer busy timeout) or 'fast'
+                        (as 'wal', plus memory-mapped reads and a larger
+                        cache).  WAL mode persists in the database files.
+
+ --limit, -l            Limit the number of messages polled (from each
+                        account).
+
+ --chunk-size, -c       Fetch (and then delete) messages in chunks of this
+                        size, bounding memory use:  default, 100.
+
+ --stream-threshold, -T Stream messages larger than this many bytes to disk
+                        in pieces, rather than downloading them whole into
+                        memory:  default, 10485760 (10 MB).  Use 0 to
+                        disable streaming.
+
+ --skip-known, -k       Fetch only the Message-ID and Date headers first,
+                        downloading just the messages not already in the
+                        maildir (known ones are deleted, as if stored).
+
+ --full, -F             Poll the whole mailbox, rather than only messages
+                        newer than those seen by earlier polls (whose UIDs
+                        are recorded in 'pollster.db' in 'maildir_path').
+
+ --daemon, -x           Keep running, polling again whenever the server
+                        reports new mail (or every '--interval' seconds),
+                        and reconnecting after errors.  With '--config',
+                        each account holds its connection open, so
+                        '--max-connections' must allow for all of the
+                        accounts on each server.
+
+ --interval, -i         In daemon mode, seconds to wait for new mail before
+                        polling again:  default, 60.
+
+ --metrics, -e          Export metrics (IMAP latencies and bytes fetched,
+                        storage timings, counts and the pending queue's
+                        depth):  either 'statsd:HOST:PORT' to send them to
+                        StatsD, or 'textfile:PATH' to write them to a file
+                        for the Prometheus node exporter.
+
+ --profile[=PATH]       Profile the run with cProfile, writing the profile
+                        to PATH (default, 'pollster.prof'), and a breakdown
+                        of the time spent in each phase (IMAP connects,
+                        fetches and deletes, parsing, folder lookup, file
+                        writes, SQL inserts, pending queue pushes) to
+                        PATH + '.phases'.  With '--config', cProfile sees
+                        only the main thread, which stores the messages
+                        fetched by the others;  the phases cover all.
 
  --dry-run, -n          Don't make any changes, just show what would be done.
 
@@ -41,14 +115,78 @@ OPTIONS can include:
 
  --help, -h, -?         Print this message and exit.
 """
+from ConfigParser import Error as ConfigError
+from ConfigParser import RawConfigParser
 import email
+from email.parser import HeaderParser
+import errno
 import getopt
 import imaplib
 import os
+import Queue
+import re
+import socket
+import sqlite3
+import ssl
 import sys
+import tempfile
+import threading
+import time
 
+from repoze.mailin.database import connect
+from repoze.mailin.database import getProfile
 from repoze.mailin.maildir import MaildirStore
+from repoze.mailin.maildir import _readHeaders
+from repoze.mailin.maildir import _removeFile
+from repoze.mailin.metrics import NullMetrics
+from repoze.mailin.metrics import makeMetrics
 from repoze.mailin.pending import PendingQueue
+from repoze.mailin.profiling import Profiler
+from repoze.mailin.profiling import expandProfileOption
+from repoze.mailin.schema import migrate
+
+_UID = re.compile(r'\bUID (\d+)')
+_SIZE = re.compile(r'\bRFC822\.SIZE (\d+)')
+
+# Each step is a list of statements;  see 'repoze.mailin.schema.migrate'.
+_STATE_SCHEMA = [
+    # 1:  initial schema.
+    ['create table if not exists uid_state'
+     '( mailbox varchar(1024) primary key'
+     ', uidvalidity integer not null'
+     ', last_uid integer not null'
+     ')',
+    ],
+]
+
+class PollsterState:
+    """ Record the highest UID stored from each polled mailbox.
+
+    - The database is tuned according to 'profile' (see
+      'repoze.mailin.database.PROFILES').
+    """
+    def __init__(self, path, dbfile=None, profile=None):
+        if dbfile is None:
+            dbfile = os.path.join(path, 'pollster.db')
+        self.sql = connect(dbfile, profile)
+        migrate(self.sql, 'uid_state', _STATE_SCHEMA)
+
+    def getLastUID(self, mailbox, uidvalidity):
+        """ Return the highest UID stored from 'mailbox'.
+
+        - Return 0 if 'mailbox' is unknown, or if its UIDVALIDITY has
+          changed (invalidating the UIDs we recorded).
+        """
+        row = self.sql.execute('select uidvalidity, last_uid from uid_state '
+                               'where mailbox = ?', (mailbox,)).fetchone()
+        if row is None or row[0] != uidvalidity:
+            return 0
+        return row[1]
+
+    def setLastUID(self, mailbox, uidvalidity, last_uid):
+        self.sql.execute('insert or replace into uid_state'
+                         '(mailbox, uidvalidity, last_uid) values(?, ?, ?)',
+                         (mailbox, uidvalidity, last_uid))
 
 class IMAPError(Exception):
     def __init__(self, command, typ, data):
@@ -60,13 +198,227 @@ class IMAPError(Exception):
         return ('<IMAPError: command=%s, typ=%s, data=%s'
                  % (self.command, self.typ, self.data))
 
+class Account:
+    """ Connection settings for one polled IMAP mailbox.
+    """
+    def __init__(self, imap_host, credentials, mailbox='INBOX',
+                 use_ssl=None):
+        if ':' in imap_host:
+            imap_host, port = imap_host.split(':')
+            port = int(port)
+        else:
+            port = 143
+        self.imap_host = imap_host
+        self.imap_port = port
+
+        if use_ssl is None:
+            use_ssl = (port == 993)
+        self.use_ssl = use_ssl
+
+        self.credentials = credentials
+        if ':' not in credentials:
+            credentials = open(credentials).readline().strip()
+
+        self.account, self.password = credentials.split(':')
+        self.mailbox = mailbox
+        self.state_key = '%s@%s:%d/%s' % (self.account, self.imap_host,
+                                          self.imap_port, self.mailbox)
+
+    def __str__(self):
+        return self.state_key
+
+def _parseFetch(data):
+    # Return a list of (uid, text, literal) for the FETCH responses in
+    # 'data', as returned by imaplib:  'text' is the response outside any
+    # literal (imaplib splits off what follows a literal, which may hold
+    # the UID), and 'literal' is None if there isn't one.  Skip responses
+    # without a UID, e.g. unsolicited FLAGS updates.
+    responses = []
+    after_literal = False
+    for d in data:
+        if type(d) is tuple:
+            responses.append([d[0], d[1]])
+            after_literal = True
+            continue
+        if d:
+            if after_literal:
+                responses[-1][0] += d
+            else:
+                responses.append([d, None])
+        after_literal = False
+    result = []
+    for text, literal in responses:
+        match = _UID.search(text)
+        if match is not None:
+            result.append((int(match.group(1)), text, literal))
+    return result
+
+def _createFile(tmpdir):
+    # Create a new file in 'tmpdir', returning its path and the file, open
+    # for writing.  Unlike 'tempfile.mkstemp', which makes files private,
+    # honor the umask, as 'mailbox' does:  the file is linked into the store.
+    while True:
+        path = tempfile.mktemp(dir=tmpdir)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            return path, os.fdopen(fd, 'wb')
+
+class MessageSink:
+    """ Store polled messages in a maildir and pending queue.
+    """
+    def __init__(self, md, pq, dry_run=False, verbose=1, metrics=None):
+        self.md = md
+        self.pq = pq
+        self.dry_run = dry_run
+        self.verbose = verbose
+        if metrics is None:
+            metrics = NullMetrics()
+        self.metrics = metrics
+
+    def store(self, message_id, message, path=None):
+        # If 'path' is not None, 'message' holds just the headers of the
+        # message in file 'path', which is moved into the store.  Skip
+        # messages already stored, e.g. delivered to several of the polled
+        # accounts, or stored by a run which died before deleting them
+        # from the server:  as in 'drainInbox', they are not queued again.
+        started = time.time()
+        try:
+            if not self.dry_run:
+                try:
+                    self.md._getMessageDate(message)
+                except Exception:
+                    # Don't let a bad message stop the poll:  as in
+                    # 'drainInbox', set it aside in 'Maildir/failed'.
+                    self.setAside(message_id, message, path)
+                    return
+                try:
+                    if path is None:
+                        self.md[message_id] = message
+                    else:
+                        self.md.storeFile(message_id, path, headers=message)
+                except sqlite3.IntegrityError:
+                    self.metrics.increment('pollster.duplicates')
+                    if self.verbose > 1:
+                        print ' - duplicate', message_id
+                    return
+                self.pq.push(message_id)
+            if self.verbose > 1:
+                print ' -', message_id
+        finally:
+            if path is not None:
+                _removeFile(path)
+        self.metrics.timing('pollster.store', time.time() - started)
+        self.metrics.increment('pollster.stored')
+
+    def setAside(self, message_id, message, path=None):
+        failed = self.md._getFailedMaildir()
+        if path is None:
+            failed.add(message)
+        else:
+            f = open(path, 'rb')
+            try:
+                failed.add(f)
+            finally:
+                f.close()
+        self.metrics.increment('pollster.failed')
+        if self.verbose:
+            print ' - set aside', message_id
+
+    def flush(self):
+        # Push any pending queue entries buffered for a group commit.
+        if not self.dry_run:
+            self.pq.flush()
+
+    def report(self):
+        # Called after each poll:  export the queue's depth, and flush.
+        if not self.dry_run:
+            self.metrics.gauge('queue.depth', self.pq.depth())
+        self.metrics.flush()
+
+    def known(self, message_ids):
+        return self.md.knownMessageIds(message_ids)
+
+    def tmpdir(self):
+        return os.path.join(self.md._getMaildir()._path, 'tmp')
+
+class RelaySink:
+    """ Relay calls to a 'MessageSink' owned by another thread.
+
+    - SQLite connections belong to the thread which opened them, so the
+      polling threads relay their calls via 'requests' to the thread which
+      owns the sink (see 'serve'), each waiting for the result.
+    """
+    def __init__(self, requests):
+        self.requests = requests
+
+    def _call(self, name, *args):
+        reply = Queue.Queue(1)
+        self.requests.put((name, args, reply))
+        ok, result = reply.get()
+        if not ok:
+            raise result
+        return result
+
+    def store(self, message_id, message, path=None):
+        return self._call('store', message_id, message, path)
+
+    def known(self, message_ids):
+        return self._call('known', message_ids)
+
+    def tmpdir(self):
+        return self._call('tmpdir')
+
+    def flush(self):
+        return self._call('flush')
+
+    def report(self):
+        return self._call('report')
+
+    def serve(self, sink, running):
+        # Answer requests using 'sink', until 'running' threads have put
+        # None to signal that they are finished.
+        while running:
+            try:
+                request = self.requests.get(True, 1) # stay interruptible
+            except Queue.Empty:
+                continue
+            if request is None:
+                running -= 1
+                continue
+            name, args, reply = request
+            try:
+                result = getattr(sink, name)(*args)
+            except Exception, e:
+                reply.put((False, e))
+            else:
+                reply.put((True, result))
+
 class Pollster:
 
     mailbox = 'INBOX'
     use_ssl = None
     delete = True
     pending_queue = None
+    group_commit = None
+    sqlite_profile = None
     limit = None
+    chunk_size = 100
+    stream_threshold = 10 * 1024 * 1024
+    stream_piece_size = 1024 * 1024
+    skip_known = False
+    full = False
+    config = None
+    max_connections = 4
+    daemon = False
+    interval = 60
+    min_backoff = 1
+    max_backoff = 300
+    metrics = None
+    profile = None
     dry_run = False
     verbose = 1
 
@@ -75,16 +427,30 @@ class Pollster:
 
     def parseOptions(self, argv):
         pending_queue = None
+        argv = expandProfileOption(argv, 'pollster.prof')
         try:
             options, arguments = getopt.gnu_getopt(argv[1:],
-                                                   'm:sSdDp:l:nvqh?',
-                                                   ['mailbox=',
+                                                   'f:M:m:sSdDp:g:P:l:c:T:'
+                                                   'kFxi:e:nvqh?',
+                                                   ['config=',
+                                                    'max-connections=',
+                                                    'mailbox=',
                                                     'ssl',
                                                     'no-ssl',
                                                     'delete',
                                                     'no-delete',
                                                     'pending-queue=',
+                                                    'group-commit=',
+                                                    'sqlite-profile=',
                                                     'limit=',
+                                                    'chunk-size=',
+                                                    'stream-threshold=',
+                                                    'skip-known',
+                                                    'full',
+                                                    'daemon',
+                                                    'interval=',
+                                                    'metrics=',
+                                                    'profile=',
                                                     'dry-run',
                                                     'verbose',
                                                     'quiet',
@@ -95,7 +461,16 @@ class Pollster:
 
         for k, v in options:
 
-            if k in ('-m', '--mailbox'):
+            if k in ('-f', '--config'):
+                self.config = v
+
+            elif k in ('-M', '--max-connections'):
+                try:
+                    self.max_connections = int(v)
+                except ValueError:
+                    self.usage('Max connections must be an integer: %s' % v)
+
+            elif k in ('-m', '--mailbox'):
                 self.mailbox = v
 
             elif k in ('-s', '--ssl'):
@@ -113,12 +488,61 @@ class Pollster:
             elif k in ('-p', '--pending-queue'):
                 pending_queue = v
 
+            elif k in ('-g', '--group-commit'):
+                try:
+                    self.group_commit = int(v)
+                except ValueError:
+                    self.usage('Group commit must be an integer: %s' % v)
+
+            elif k in ('-P', '--sqlite-profile'):
+                try:
+                    getProfile(v)
+                except ValueError, e:
+                    self.usage(str(e))
+                self.sqlite_profile = v
+
             elif k in ('-l', '--limit'):
                 try:
                     self.limit = int(v)
                 except ValueError:
                     self.usage('Limit must be an integer: %s' % v)
 
+            elif k in ('-c', '--chunk-size'):
+                try:
+                    self.chunk_size = int(v)
+                except ValueError:
+                    self.usage('Chunk size must be an integer: %s' % v)
+
+            elif k in ('-T', '--stream-threshold'):
+                try:
+                    self.stream_threshold = int(v)
+                except ValueError:
+                    self.usage('Stream threshold must be an integer: %s' % v)
+
+            elif k in ('-k', '--skip-known'):
+                self.skip_known = True
+
+            elif k in ('-F', '--full'):
+                self.full = True
+
+            elif k in ('-x', '--daemon'):
+                self.daemon = True
+
+            elif k in ('-i', '--interval'):
+                try:
+                    self.interval = int(v)
+                except ValueError:
+                    self.usage('Interval must be an integer: %s' % v)
+
+            elif k in ('-e', '--metrics'):
+                try:
+                    self.metrics = makeMetrics(v)
+                except ValueError, e:
+                    self.usage(str(e))
+
+            elif k == '--profile':
+                self.profile = os.path.abspath(v)
+
             elif k in ('-n', '--dry-run'):
                 self.dry_run = True
 
@@ -134,10 +558,18 @@ class Pollster:
             else:
                 self.usage('Unknown option: %s' % k)
 
-        if len(arguments) != 3:
-            self.usage('Arguments: maildir_path, imap_host, credentials')
+        if self.config is not None:
+            if len(arguments) != 1:
+                self.usage('Arguments: maildir_path')
+            maildir_path, = arguments
+            self.accounts = self.readConfig(self.config)
+        else:
+            if len(arguments) != 3:
+                self.usage('Arguments: maildir_path, imap_host, credentials')
+            maildir_path, imap_host, credentials = arguments
+            self.accounts = [Account(imap_host, credentials, self.mailbox,
+                                     self.use_ssl)]
 
-        maildir_path, imap_host, credentials = arguments
         maildir_path = os.path.abspath(maildir_path)
 
         if not os.path.isdir(maildir_path):
@@ -145,22 +577,17 @@ class Pollster:
 
         self.maildir_path = maildir_path
 
-        if ':' in imap_host:
-            imap_host, port = imap_host.split(':')
-            port = int(port)
-        else:
-            port = 143
-        self.imap_host = imap_host
-        self.imap_port = port
-
-        if self.use_ssl is None:
-            self.use_ssl = (port == 993)
+        if self.max_connections < 1:
+            self.usage('Max connections must be at least 1')
 
-        self.credentials = credentials
-        if ':' not in credentials:
-            credentials = open(credentials).readline()
+        if self.chunk_size < 0:
+            self.usage('Chunk size must not be negative')
 
-        self.account, self.password = credentials.split(':')
+        if self.daemon:
+            for host, count in self.countAccountsByHost().items():
+                if count > self.max_connections:
+                    self.usage('Daemon mode needs a connection for each of '
+                               'the %d accounts on %s:%d' % ((count,) + host))
 
         if pending_queue is not None:
             pending_queue = os.path.abspath(pending_queue)
@@ -171,6 +598,40 @@ class Pollster:
 
         self.pending_queue = pending_queue
 
+        if self.metrics is None:
+            self.metrics = NullMetrics()
+
+    def readConfig(self, filename):
+        parser = RawConfigParser() # no '%' interpolation in passwords
+        if not parser.read([filename]):
+            self.usage('Invalid config file: %s' % filename)
+        accounts = []
+        try:
+            for section in parser.sections():
+                if parser.has_option(section, 'mailbox'):
+                    mailbox = parser.get(section, 'mailbox')
+                else:
+                    mailbox = self.mailbox
+                if parser.has_option(section, 'ssl'):
+                    use_ssl = parser.getboolean(section, 'ssl')
+                else:
+                    use_ssl = self.use_ssl
+                accounts.append(Account(parser.get(section, 'host'),
+                                        parser.get(section, 'credentials'),
+                                        mailbox, use_ssl))
+        except (ConfigError, ValueError), e:
+            self.usage('Invalid config file: %s: %s' % (filename, e))
+        if not accounts:
+            self.usage('No accounts in config file: %s' % filename)
+        return accounts
+
+    def countAccountsByHost(self):
+        counts = {}
+        for account in self.accounts:
+            host = (account.imap_host, account.imap_port)
+            counts[host] = counts.get(host, 0) + 1
+        return counts
+
     def usage(self, message=None, rc=1):
         print __doc__
         if message is not None:
@@ -178,27 +639,70 @@ class Pollster:
             print 
         sys.exit(rc)
 
-    def connect_to_imap(self):
-        if self.use_ssl:
-            conn = imaplib.IMAP4_SSL(self.imap_host, self.imap_port)
+    def connect_to_imap(self, account):
+        started = time.time()
+        if account.use_ssl:
+            conn = imaplib.IMAP4_SSL(account.imap_host, account.imap_port)
         else:
-            conn = imaplib.IMAP4(self.imap_host, self.imap_port)
+            conn = imaplib.IMAP4(account.imap_host, account.imap_port)
 
-        typ, data = conn.login(self.account, self.password)
+        typ, data = conn.login(account.account, account.password)
         if typ != 'OK':
             raise IMAPError('login', typ, data)
 
-        typ, data = conn.select(self.mailbox, readonly=self.dry_run)
+        typ, data = conn.select(account.mailbox, readonly=self.dry_run)
         if typ != 'OK':
-            raise IMAPError('select(%s)' % self.mailbox, typ, data)
+            raise IMAPError('select(%s)' % account.mailbox, typ, data)
 
+        # Only reported in response to 'select':  keep it for later polls.
+        conn.uidvalidity = self.get_uidvalidity(conn)
+        self.metrics.timing('imap.connect', time.time() - started)
         return conn
 
+    def wait_for_mail(self, conn):
+        if 'IDLE' in conn.capabilities:
+            return self.idle(conn)
+        time.sleep(self.interval)
+        typ, data = conn.noop()
+        if typ != 'OK':
+            raise IMAPError('noop', typ, data)
+
+    def idle(self, conn):
+        # Python 2's imaplib lacks IDLE (RFC 2177), so speak it directly:
+        # wait up to 'interval' seconds for the server to report new mail.
+        tag = conn._new_tag()
+        del conn.tagged_commands[tag]
+        conn.send('%s IDLE\r\n' % tag)
+        line = conn.readline()
+        if not line.startswith('+'):
+            raise IMAPError('idle', 'NO', [line])
+        sock = getattr(conn, 'sslobj', None) or conn.sock
+        sock.settimeout(self.interval)
+        try:
+            try:
+                while not line.rstrip().endswith(('EXISTS', 'RECENT')):
+                    line = conn.readline()
+            except socket.timeout:
+                pass
+            except ssl.SSLError, e:
+                # Python 2's SSL sockets time out with an SSLError.
+                if 'timed out' not in str(e):
+                    raise
+        finally:
+            sock.settimeout(None)
+        conn.send('DONE\r\n')
+        line = conn.readline()
+        while not line.startswith(tag):
+            line = conn.readline()
+        typ = line.split(' ', 2)[1]
+        if typ != 'OK':
+            raise IMAPError('idle', typ, [line])
+
     def format_seqnums(self, seqnums):
         # Format a list of message sequence numbers into a form acceptable
         # to 'fetch' and other IMAP commands.
         if len(seqnums) == 1:
-            return seqnums[0]
+            return str(seqnums[0])
         ranges = []
         i = 0
         start = int(seqnums[0])
@@ -215,69 +719,359 @@ class Pollster:
             i = i + 1
         return ','.join(['%s:%s' % (start, end) for (start, end) in ranges])
 
-    def fetch_next(self):
-        conn = self.connect_to_imap()
-        typ, data = conn.search(None, 'ALL')
+    def get_uidvalidity(self, conn):
+        typ, data = conn.response('UIDVALIDITY')
+        if not data or data[0] is None:
+            return None
+        return int(data[0])
+
+    def fetch_next(self, conn, account, state=None, sink=None):
+        # Fetch by UID, which (unlike sequence numbers) stays stable as
+        # earlier chunks are expunged.  If 'state' is not None, fetch only
+        # messages newer than the last UID it records.  With 'skip_known',
+        # skip messages whose IDs 'sink' already knows.  Yield the message
+        # ID, the message and None;  or, for messages streamed to disk, the
+        # message ID, the headers and the path of the file.
+        uidvalidity = conn.uidvalidity
+        if state is None or uidvalidity is None:
+            state = last_uid = None
+            typ, data = conn.uid('SEARCH', None, 'ALL')
+        else:
+            last_uid = state.getLastUID(account.state_key, uidvalidity)
+            typ, data = conn.uid('SEARCH', None,
+                                 'UID', '%d:*' % (last_uid + 1))
         if typ != 'OK':
-            raise IMAPError('search(ALL)', typ, data)
-        seqnums = self.format_seqnums(data[0].split(' '))
-        if seqnums:
-            typ, data = conn.fetch(seqnums, '(RFC822)')
-            if typ != 'OK':
-                raise IMAPError('fetch', typ, data)
-            drained = []
-            count = 0
-            for d in data:
-                if type(d) is tuple: # message body
-                    message = email.message_from_string(d[1])
-                    message_id = message['Message-ID']
-                    yield message_id, message
-                    drained.append(d[0])
-                    count += 1
-                    if self.limit and count > self.limit:
+            raise IMAPError('search', typ, data)
+        # RFC 3501 doesn't promise the results in order.
+        uids = sorted([int(x) for x in data[0].split()])
+        if last_uid:
+            # 'n:*' always matches the newest message, even if below 'n'.
+            uids = [uid for uid in uids if uid > last_uid]
+        if self.limit:
+            uids = uids[:self.limit]
+        chunk_size = self.chunk_size or len(uids) or 1
+        complete = True
+        for start in range(0, len(uids), chunk_size):
+            chunk = uids[start:start + chunk_size]
+            sizes = {}
+            if self.skip_known:
+                wanted, sizes = self.select_unknown(conn, chunk, sink)
+                fetched = [uid for uid in chunk if uid not in wanted]
+            else:
+                wanted = chunk
+                fetched = []
+                if self.stream_threshold:
+                    sizes = self.fetch_sizes(conn, chunk)
+            large = [uid for uid in wanted
+                     if self.stream_threshold
+                        and sizes.get(uid, 0) > self.stream_threshold]
+            small = [uid for uid in wanted if uid not in large]
+            for uid, message in self.fetch_messages(conn, small):
+                yield message['Message-ID'], message, None
+                fetched.append(uid)
+            for uid in large:
+                path = self.stream_message(conn, uid, sink.tmpdir())
+                headers = _readHeaders(path)
+                yield headers['Message-ID'], headers, path
+                fetched.append(uid)
+            # Our caller has stored the whole chunk by the time we resume;
+            # make sure it is queued, too, before deleting it.
+            if sink is not None:
+                sink.flush()
+            fetched.sort()
+            self.delete_messages(conn, fetched)
+            if state is not None and not self.dry_run and complete:
+                # Advance the mark only over UIDs handled, so that a message
+                # the server didn't return is fetched by the next poll.
+                handled = set(fetched)
+                mark = None
+                for uid in chunk:
+                    if uid not in handled:
+                        complete = False
                         break
-            if self.delete and not self.dry_run:
-                typ, data = conn.store(drained, '+FLAGS', '\\Deleted')
-                if typ != 'OK':
-                    raise IMAPError('store(Deleted)', typ, data)
-                typ, data = conn.expunge()
-                if typ != 'OK':
-                    raise IMAPError('expunge', typ, data)
+                    mark = uid
+                if mark is not None:
+                    state.setLastUID(account.state_key, uidvalidity, mark)
 
-    def do_poll(self):
+    def fetch_sizes(self, conn, uids):
+        # Return a mapping of 'uids' to the sizes of their messages.
+        typ, data = conn.uid('FETCH', self.format_seqnums(uids),
+                             '(RFC822.SIZE)')
+        if typ != 'OK':
+            raise IMAPError('fetch(size)', typ, data)
+        sizes = {}
+        uids = set(uids)
+        for uid, text, literal in _parseFetch(data):
+            match = _SIZE.search(text)
+            if match is not None and uid in uids:
+                sizes[uid] = int(match.group(1))
+        return sizes
+
+    def stream_message(self, conn, uid, tmpdir):
+        # Fetch the message for 'uid' in pieces into a new file in 'tmpdir',
+        # returning its path.
+        started = time.time()
+        path, f = _createFile(tmpdir)
+        try:
+            try:
+                offset = 0
+                while True:
+                    typ, data = conn.uid('FETCH', str(uid),
+                                         '(BODY.PEEK[]<%d.%d>)'
+                                            % (offset, self.stream_piece_size))
+                    if typ != 'OK':
+                        raise IMAPError('fetch(partial)', typ, data)
+                    # Skip unsolicited responses for other messages.
+                    piece = ''.join([literal for x, text, literal
+                                        in _parseFetch(data)
+                                        if x == uid and literal is not None])
+                    f.write(piece)
+                    offset += len(piece)
+                    self.metrics.increment('imap.fetch_bytes', len(piece))
+                    if len(piece) < self.stream_piece_size:
+                        break
+            finally:
+                f.close()
+        except:
+            _removeFile(path)
+            raise
+        self.metrics.timing('imap.stream', time.time() - started)
+        return path
+
+    def select_unknown(self, conn, uids, sink):
+        # Fetch just the headers we need for 'uids', returning the set of
+        # those which are neither known to 'sink' nor repeated in 'uids',
+        # and a mapping of 'uids' to the sizes of their messages.
+        started = time.time()
+        typ, data = conn.uid('FETCH', self.format_seqnums(uids),
+                             '(RFC822.SIZE '
+                             'BODY.PEEK[HEADER.FIELDS (MESSAGE-ID DATE)])')
+        if typ != 'OK':
+            raise IMAPError('fetch(headers)', typ, data)
+        self.metrics.timing('imap.fetch_headers', time.time() - started)
+        message_ids = {}
+        sizes = {}
+        requested = set(uids)
+        for uid, text, literal in _parseFetch(data):
+            if literal is None or uid not in requested:
+                continue
+            match = _SIZE.search(text)
+            if match is not None:
+                sizes[uid] = int(match.group(1))
+            message_ids[uid] = HeaderParser().parsestr(literal)['Message-ID']
+        seen = sink.known([x for x in message_ids.values() if x])
+        wanted = set()
+        skipped = 0
+        for uid in uids:
+            message_id = message_ids.get(uid)
+            if message_id in seen:
+                skipped += sizes.get(uid, 0)
+                continue
+            if message_id is not None:
+                seen.add(message_id)
+            wanted.add(uid)
+        self.metrics.increment('imap.skipped', len(uids) - len(wanted))
+        if self.verbose > 1 and skipped:
+            print ' - skipped %d known or repeated messages (%d bytes)' % (
+                        len(uids) - len(wanted), skipped)
+        return wanted, sizes
+
+    def fetch_messages(self, conn, uids):
+        if not uids:
+            return
+        uids = sorted(uids)
+        started = time.time()
+        typ, data = conn.uid('FETCH', self.format_seqnums(uids), '(RFC822)')
+        if typ != 'OK':
+            raise IMAPError('fetch', typ, data)
+        self.metrics.timing('imap.fetch', time.time() - started)
+        self.metrics.increment('imap.fetch_bytes',
+                               sum([len(d[1]) for d in data
+                                        if type(d) is tuple]))
+        bodies = {}
+        requested = set(uids)
+        for uid, text, literal in _parseFetch(data):
+            if literal is not None and uid in requested:
+                bodies[uid] = literal
+        for uid in uids:
+            if uid in bodies:
+                started = time.time()
+                message = email.message_from_string(bodies[uid])
+                self.metrics.timing('imap.parse', time.time() - started)
+                yield uid, message
+
+    def delete_messages(self, conn, uids):
+        if uids and self.delete and not self.dry_run:
+            started = time.time()
+            typ, data = conn.uid('STORE', self.format_seqnums(uids),
+                                 '+FLAGS', '(\\Deleted)')
+            if typ != 'OK':
+                raise IMAPError('store(Deleted)', typ, data)
+            typ, data = conn.expunge()
+            if typ != 'OK':
+                raise IMAPError('expunge', typ, data)
+            self.metrics.timing('imap.delete', time.time() - started)
+
+    def open_stores(self):
         if self.pending_queue is not None:
-            pq = PendingQueue(self.pending_queue)
+            pq = PendingQueue(self.pending_queue, metrics=self.metrics,
+                              profile=self.sqlite_profile,
+                              group_commit_size=self.group_commit)
         else:
-            pq = PendingQueue()
+            pq = PendingQueue(metrics=self.metrics,
+                              group_commit_size=self.group_commit)
 
-        md = MaildirStore(self.maildir_path)
-        for message_id, message in self.fetch_next():
-            if not self.dry_run:
-                md[message_id] = message
-                pq.push(message_id)
-            if self.verbose > 1:
-                print ' -', message_id
+        md = MaildirStore(self.maildir_path, metrics=self.metrics,
+                          profile=self.sqlite_profile)
+        return md, pq
+
+    def open_state(self):
+        if self.full:
+            return None
+        return PollsterState(self.maildir_path, profile=self.sqlite_profile)
+
+    def poll(self, conn, account, state, sink):
+        started = time.time()
+        for message_id, message, path in self.fetch_next(conn, account,
+                                                         state, sink):
+            sink.store(message_id, message, path)
+        self.metrics.timing('pollster.poll', time.time() - started)
+        sink.report()
+
+    def poll_account(self, account, sink, connections):
+        # Poll 'account' once, using one of the 'connections' semaphore's
+        # slots for its server.
+        state = self.open_state()
+        connections.acquire()
+        try:
+            conn = self.connect_to_imap(account)
+            try:
+                self.poll(conn, account, state, sink)
+            finally:
+                conn.logout()
+        finally:
+            connections.release()
+
+    def daemon_account(self, account, sink, connections):
+        # Reuse one connection across polls of 'account'.
+        state = self.open_state()
+        backoff = self.min_backoff
+        while True:
+            try:
+                connections.acquire()
+                try:
+                    conn = self.connect_to_imap(account)
+                    try:
+                        while True:
+                            self.poll(conn, account, state, sink)
+                            backoff = self.min_backoff
+                            self.wait_for_mail(conn)
+                    finally:
+                        try:
+                            conn.logout()
+                        except (imaplib.IMAP4.error, socket.error):
+                            pass
+                finally:
+                    connections.release()
+            except (IMAPError, imaplib.IMAP4.error, socket.error,
+                    sqlite3.Error, EnvironmentError), e:
+                # Storage errors, e.g. a database locked by 'draino' or a
+                # full disk, are retried like connection errors.
+                self.metrics.increment('pollster.errors')
+                if self.verbose:
+                    print '%s: error: %s;  reconnecting in %d seconds' % (
+                                account, e, backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    def do_poll(self):
+        md, pq = self.open_stores()
+        sink = MessageSink(md, pq, self.dry_run, self.verbose, self.metrics)
+        if self.daemon:
+            poll_account = self.daemon_account
+        else:
+            poll_account = self.poll_account
+        if len(self.accounts) == 1:
+            poll_account(self.accounts[0], sink, threading.Semaphore(1))
+            return True
+        return self.poll_concurrently(poll_account, sink)
+
+    def do_poll_profiled(self):
+        profiler = Profiler(self.profile)
+        profiler.phases.wrapped = self.metrics
+        self.metrics = profiler.phases
+        try:
+            return profiler.runcall(self.do_poll)
+        finally:
+            self.metrics = profiler.phases.wrapped
+            profiler.write()
+            if self.verbose:
+                print 'Profile written  : ', self.profile
+
+    def poll_concurrently(self, poll_account, sink):
+        # Poll each account in its own thread, relaying their calls to
+        # 'sink' to this one.
+        relay = RelaySink(Queue.Queue())
+        connections = {}
+        for host in self.countAccountsByHost():
+            connections[host] = threading.Semaphore(self.max_connections)
+        errors = []
+
+        def worker(account):
+            try:
+                try:
+                    host = (account.imap_host, account.imap_port)
+                    poll_account(account, relay, connections[host])
+                except Exception, e:
+                    self.metrics.increment('pollster.errors')
+                    errors.append(account)
+                    print '%s: error: %s' % (account, e)
+            finally:
+                relay.requests.put(None)
+
+        for account in self.accounts:
+            thread = threading.Thread(target=worker, args=(account,))
+            thread.setDaemon(True) # don't outlive an interrupted main thread
+            thread.start()
+
+        relay.serve(sink, len(self.accounts))
+        return not errors
 
     def run(self):
         if self.verbose:
             print '=' * 78
-            print 'IMAP server:port : ', '%s:%s' % (self.imap_host,
-                                                    self.imap_port)
-            print 'Account          : ', self.account
+            for account in self.accounts:
+                print 'IMAP server:port : ', '%s:%s' % (account.imap_host,
+                                                        account.imap_port)
+                print 'Account          : ', account.account
+                print 'Mailbox          : ', account.mailbox
+                print 'Use SSL?         : ', account.use_ssl
             print 'Target mailbox   : ', self.maildir_path
             print '=' * 78
 
             print 'Dry-run?         : ', self.dry_run
-            print 'Mailbox          : ', self.mailbox
-            print 'Use SSL?         : ', self.use_ssl
             print 'Delete?          : ', self.delete
             print 'Pending queue    : ', self.pending_queue
+            print 'Chunk size       : ', self.chunk_size
+            print 'Stream threshold : ', self.stream_threshold
+            print 'Skip known?      : ', self.skip_known
+            print 'Full poll?       : ', self.full
+            print 'Daemon?          : ', self.daemon
+            print 'Profile          : ', self.profile
+            if self.config is not None:
+                print 'Max connections  : ', self.max_connections
 
-        self.do_poll()
+        if self.profile is not None:
+            ok = self.do_poll_profiled()
+        else:
+            ok = self.do_poll()
 
         if self.verbose:
             print
 
+        if not ok:
+            sys.exit(1)
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
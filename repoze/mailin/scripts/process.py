@@ -0,0 +1,241 @@
+""" mailin-process [OPTIONS] maildir_path filter [filter ...]
+
+Process the messages in the pending queue for the maildir at
+'maildir_path', running each through the chain of message filters.
+
+'filter'
+    the dotted name of an IMessageFilter, e.g. 'mypackage.filters:spam'
+    or 'mypackage.filters.spam'.  If the name is that of a class, it
+    is called with no arguments to create the filter.
+
+OPTIONS can include:
+
+ --pending-queue, -p    Directory of the SQLite database for the 'pending
+                        queue':  default, 'maildir_path'.
+
+ --limit, -l            Limit the number of messages processed.
+
+ --batch-size, -b       Claim messages from the pending queue in batches of
+                        this size:  default, 100.
+
+ --lease, -L            Seconds for which each batch is leased, before
+                        messages not yet processed are returned to the
+                        queue:  default, 300.
+
+ --blackboard-factory, -B
+                        The dotted name of an IBlackboardFactory:  by
+                        default, each message gets an empty dict.
+
+ --commit, -c           The dotted name of a function to call (with no
+                        arguments) after processing each message, e.g.
+                        'transaction.commit'.
+
+ --abort, -a            The dotted name of a function to call (with no
+                        arguments) after processing of a message is
+                        cancelled or fails, e.g. 'transaction.abort'.
+
+ --workers, -w          Run the filter chains in a pool of this many worker
+                        processes, each opening its own message store;
+                        this process still updates the pending queue.
+                        Filters, hooks, and the blackboard factory must
+                        be usable in (forked) worker processes.
+
+ --sqlite-profile, -P   Tune the SQLite databases according to this profile:
+                        'default' (SQLite's defaults), 'wal' or 'fast' (see
+                        'repoze.mailin.database').  Under 'wal', processing
+                        never blocks 'draino' or 'pollster'.
+
+ --verbose, -v          Be noisier (can be repeated).
+
+ --quiet, -q            Don't emit any inessential output.
+
+ --help, -h, -?         Print this message and exit.
+"""
+from functools import partial
+import getopt
+import os
+import sys
+
+from repoze.mailin.database import getProfile
+from repoze.mailin.dispatcher import Dispatcher
+from repoze.mailin.dispatcher import ParallelDispatcher
+from repoze.mailin.dispatcher import makeFilter
+from repoze.mailin.dispatcher import resolveDottedName
+from repoze.mailin.maildir import MaildirStore
+from repoze.mailin.pending import PendingQueue
+
+class Processor:
+
+    pending_queue = None
+    limit = None
+    batch_size = 100
+    lease_seconds = 300
+    blackboard_factory = None
+    commit = None
+    abort = None
+    workers = 1
+    sqlite_profile = None
+    verbose = 1
+
+    def __init__(self, argv):
+        self.parseOptions(argv)
+
+    def parseOptions(self, argv):
+        pending_queue = None
+        try:
+            options, arguments = getopt.gnu_getopt(argv[1:],
+                                                   'p:l:b:L:B:c:a:w:P:vqh?',
+                                                   ['pending-queue=',
+                                                    'limit=',
+                                                    'batch-size=',
+                                                    'lease=',
+                                                    'blackboard-factory=',
+                                                    'commit=',
+                                                    'abort=',
+                                                    'workers=',
+                                                    'sqlite-profile=',
+                                                    'verbose',
+                                                    'quiet',
+                                                    'help',
+                                                   ])
+        except getopt.GetoptError, e:
+            self.usage(str(e))
+
+        for k, v in options:
+
+            if k in ('-p', '--pending-queue'):
+                pending_queue = v
+
+            elif k in ('-l', '--limit'):
+                try:
+                    self.limit = int(v)
+                except ValueError:
+                    self.usage('Limit must be an integer: %s' % v)
+
+            elif k in ('-b', '--batch-size'):
+                try:
+                    self.batch_size = int(v)
+                except ValueError:
+                    self.usage('Batch size must be an integer: %s' % v)
+
+            elif k in ('-L', '--lease'):
+                try:
+                    self.lease_seconds = int(v)
+                except ValueError:
+                    self.usage('Lease must be an integer: %s' % v)
+
+            elif k in ('-B', '--blackboard-factory'):
+                self.blackboard_factory = self.resolve(v)
+
+            elif k in ('-c', '--commit'):
+                self.commit = self.resolve(v)
+
+            elif k in ('-a', '--abort'):
+                self.abort = self.resolve(v)
+
+            elif k in ('-w', '--workers'):
+                try:
+                    self.workers = int(v)
+                except ValueError:
+                    self.usage('Workers must be an integer: %s' % v)
+
+            elif k in ('-P', '--sqlite-profile'):
+                try:
+                    getProfile(v)
+                except ValueError, e:
+                    self.usage(str(e))
+                self.sqlite_profile = v
+
+            elif k in ('-v', '--verbose'):
+                self.verbose += 1
+
+            elif k in ('-q', '--quiet'):
+                self.verbose = 0
+
+            elif k in ('-h', '-?', '--help'):
+                self.usage(rc=2)
+
+            else:
+                self.usage('Unknown option: %s' % k)
+
+        if len(arguments) < 2:
+            self.usage('Arguments: maildir_path, filter [filter ...]')
+
+        maildir_path = os.path.abspath(arguments[0])
+
+        if not os.path.isdir(maildir_path):
+            self.usage('Invalid maildir_path: %s' % maildir_path)
+
+        self.maildir_path = maildir_path
+        self.filter_names = arguments[1:]
+        self.filters = [self.resolve(x, makeFilter)
+                            for x in self.filter_names]
+
+        if pending_queue is None:
+            pending_queue = maildir_path
+        pending_queue = os.path.abspath(pending_queue)
+        if not os.path.isdir(pending_queue):
+            self.usage('Invalid directory for pending queue: %s'
+                            % pending_queue)
+
+        self.pending_queue = pending_queue
+
+    def resolve(self, name, resolver=resolveDottedName):
+        try:
+            return resolver(name)
+        except (ImportError, AttributeError), e:
+            self.usage('Cannot resolve %s: %s' % (name, e))
+
+    def usage(self, message=None, rc=1):
+        print __doc__
+        if message is not None:
+            print message
+            print
+        sys.exit(rc)
+
+    def do_process(self):
+        pq = PendingQueue(self.pending_queue, profile=self.sqlite_profile)
+        options = {'blackboard_factory': self.blackboard_factory,
+                   'batch_size': self.batch_size,
+                   'commit': self.commit,
+                   'abort': self.abort,
+                   'lease_seconds': self.lease_seconds,
+                  }
+        if self.workers > 1:
+            dispatcher = ParallelDispatcher(
+                                partial(MaildirStore, self.maildir_path,
+                                        profile=self.sqlite_profile),
+                                pq, self.filters, self.workers, **options)
+        else:
+            md = MaildirStore(self.maildir_path, profile=self.sqlite_profile)
+            dispatcher = Dispatcher(md, pq, self.filters, **options)
+        for message_id, outcome in dispatcher.run(self.limit):
+            if self.verbose > 1:
+                print ' -', message_id, outcome
+        return dispatcher.stats
+
+    def run(self):
+        if self.verbose:
+            print '=' * 78
+            print 'Processing mailbox : ', self.maildir_path
+            print '=' * 78
+
+            print 'Pending queue      : ', self.pending_queue
+            print 'Batch size         : ', self.batch_size
+            print 'Workers            : ', self.workers
+            print 'Filters            : ', ', '.join(self.filter_names)
+
+        stats = self.do_process()
+
+        if self.verbose:
+            print
+            for line in stats.report():
+                print line
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    Processor(argv).run()
+
+if __name__ == '__main__':
+    main()
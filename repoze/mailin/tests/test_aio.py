@@ -0,0 +1,150 @@
+import unittest
+
+try:
+    import trollius
+except ImportError: # pragma: no cover
+    trollius = None
+
+class _Base(object):
+
+    _tempdir = None
+
+    def setUp(self):
+        self.loop = trollius.new_event_loop()
+        self._closing = []
+
+    def tearDown(self):
+        for proxy in self._closing:
+            proxy.close()
+        self.loop.close()
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getTempdir(self):
+        import tempfile
+        if self._tempdir is None:
+            self._tempdir = tempfile.mkdtemp()
+        return self._tempdir
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+class AsyncPendingQueueTests(_Base, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.aio import AsyncPendingQueue
+        return AsyncPendingQueue
+
+    def _makeOne(self, **kw):
+        from repoze.mailin.pending import PendingQueue
+        queue = self._getTargetClass()(PendingQueue, loop=self.loop, **kw)
+        self._closing.append(queue)
+        return queue
+
+    def test_queue_created_in_its_own_thread(self):
+        import thread
+        queue = self._makeOne()
+        ident = queue.executor.submit(thread.get_ident).result()
+        self.assertNotEqual(ident, thread.get_ident())
+        # The connection would refuse use from another thread.
+        self.assertEqual(self._run(queue.length()), 0)
+
+    def test_push_pop(self):
+        queue = self._makeOne()
+        self._run(queue.push('a'))
+        self._run(queue.push('b'))
+        self.assertEqual(self._run(queue.length()), 2)
+        self.assertEqual(self._run(queue.depth()), 2)
+        self.assertEqual(self._run(queue.pop(None)), ['a', 'b'])
+        self.assertEqual(self._run(queue.pop()), [])
+
+    def test_get_ack(self):
+        queue = self._makeOne()
+        self._run(queue.push('a'))
+        self._run(queue.push('b'))
+        self.assertEqual(self._run(queue.get()), 'a')
+        self.assertEqual(self._run(queue.get()), 'b')
+        self._run(queue.ack('a'))
+        self._run(queue.nack('b'))
+        self.assertEqual(self._run(queue.pop(None)), ['b'])
+
+    def test_get_waits_for_push(self):
+        queue = self._makeOne(poll_interval=60)
+        getter = trollius.async(queue.get(), loop=self.loop)
+        self._run(trollius.sleep(0.01, loop=self.loop))
+        self.failIf(getter.done())
+        self._run(queue.push('a'))
+        self.assertEqual(self._run(trollius.wait_for(getter, 5,
+                                                     loop=self.loop)), 'a')
+
+    def test_get_polls(self):
+        from functools import partial
+        from repoze.mailin.pending import PendingQueue
+        tempdir = self._getTempdir()
+        queue = self._getTargetClass()(partial(PendingQueue, tempdir),
+                                       loop=self.loop, poll_interval=0.01)
+        self._closing.append(queue)
+        getter = trollius.async(queue.get(), loop=self.loop)
+        self._run(trollius.sleep(0.02, loop=self.loop))
+        self.failIf(getter.done())
+        # Pushed by another writer, so only polling can see it.
+        PendingQueue(tempdir).push('a')
+        self.assertEqual(self._run(trollius.wait_for(getter, 5,
+                                                     loop=self.loop)), 'a')
+
+    def test_get_applies_backpressure(self):
+        queue = self._makeOne(max_outstanding=1)
+        self._run(queue.push('a'))
+        self._run(queue.push('b'))
+        self.assertEqual(self._run(queue.get()), 'a')
+        getter = trollius.async(queue.get(), loop=self.loop)
+        self._run(trollius.sleep(0.01, loop=self.loop))
+        self.failIf(getter.done())
+        self._run(queue.quarantine('a', 'bad'))
+        self.assertEqual(self._run(trollius.wait_for(getter, 5,
+                                                     loop=self.loop)), 'b')
+
+    def test_ack_unknown_does_not_release(self):
+        queue = self._makeOne(max_outstanding=1)
+        self._run(queue.push('a'))
+        self.assertEqual(self._run(queue.claim()), ['a'])
+        self._run(queue.ack('a'))
+        self.assertRaises(KeyError, self._run, queue.ack('a'))
+        self.failIf(queue._gotten)
+
+class AsyncMaildirStoreTests(_Base, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.aio import AsyncMaildirStore
+        return AsyncMaildirStore
+
+    def _makeOne(self):
+        from functools import partial
+        from repoze.mailin.maildir import MaildirStore
+        store = self._getTargetClass()(partial(MaildirStore,
+                                               self._getTempdir()),
+                                       loop=self.loop)
+        self._closing.append(store)
+        return store
+
+    def test_set_get(self):
+        from email import message_from_string
+        store = self._makeOne()
+        message = message_from_string('Date: Thu, 01 Oct 2009 10:00:00 -0000'
+                                      '\nMessage-Id: <a@example.com>\n\nHi')
+        self._run(store.set('<a@example.com>', message))
+        found = self._run(store.get('<a@example.com>'))
+        self.assertEqual(found.get_payload(), 'Hi')
+        self.assertEqual(self._run(store.knownMessageIds(
+                            iter(['<a@example.com>', '<b@example.com>']))),
+                         set(['<a@example.com>']))
+
+    def test_get_nonesuch(self):
+        store = self._makeOne()
+        self.assertRaises(KeyError, self._run, store.get('nonesuch'))
+
+if trollius is None: # pragma: no cover
+    # The tests need trollius:  don't collect them without it.
+    del AsyncPendingQueueTests
+    del AsyncMaildirStoreTests
@@ -0,0 +1,201 @@
+import unittest
+
+class PercentileTests(unittest.TestCase):
+
+    def _callFUT(self, values, fraction):
+        from repoze.mailin.benchmarks import percentile
+        return percentile(values, fraction)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([], 0.5), None)
+
+    def test_nearest_rank(self):
+        values = [4, 1, 3, 2]
+        self.assertEqual(self._callFUT(values, 0), 1)
+        self.assertEqual(self._callFUT(values, 0.5), 2)
+        self.assertEqual(self._callFUT(values, 0.51), 3)
+        self.assertEqual(self._callFUT(values, 0.99), 4)
+        self.assertEqual(self._callFUT(values, 1), 4)
+
+class MeasurementTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.benchmarks import Measurement
+        return Measurement
+
+    def _makeOne(self, name='testing', **params):
+        return self._getTargetClass()(name, **params)
+
+    def test_summary_empty(self):
+        measurement = self._makeOne()
+        summary = measurement.summary()
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['per_second'], None)
+        self.assertEqual(summary['latency_ms'],
+                         {'p50': None, 'p90': None, 'p99': None, 'max': None})
+
+    def test_summary(self):
+        measurement = self._makeOne(depth=10)
+        measurement.start()
+        measurement.tick()
+        measurement.tick(3)
+        measurement.stop()
+        summary = measurement.summary()
+        self.assertEqual(summary['name'], 'testing')
+        self.assertEqual(summary['params'], {'depth': 10})
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(len(measurement.latencies), 2)
+        self.failUnless(summary['seconds'] >= 0)
+        self.failUnless(summary['latency_ms']['max']
+                            >= summary['latency_ms']['p50'])
+        self.failUnless(summary['peak_rss_kb'] > 0)
+
+class MakeMessageTextTests(unittest.TestCase):
+
+    def _callFUT(self, n, size=1024):
+        from repoze.mailin.benchmarks import makeMessageText
+        return makeMessageText(n, size)
+
+    def test_parseable(self):
+        from email import message_from_string
+        message = message_from_string(self._callFUT(7, 100))
+        self.assertEqual(message['Message-Id'], '<7.bench@example.com>')
+        self.assertEqual(len(message.get_payload()), 100)
+
+class DrainInboxTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _callFUT(self, count, batch_size):
+        import tempfile
+        from repoze.mailin.benchmarks.cases import drainInbox
+        self._tempdir = tempfile.mkdtemp()
+        return drainInbox(self._tempdir, count, 10, batch_size)
+
+    def test_wo_batches(self):
+        measurement = self._callFUT(5, None)
+        self.assertEqual(measurement.count, 5)
+        self.assertEqual(len(measurement.latencies), 5)
+
+    def test_w_batches_ticks_per_batch(self):
+        measurement = self._callFUT(5, 2)
+        self.assertEqual(measurement.count, 5)
+        self.assertEqual(len(measurement.latencies), 3)
+
+class RunBenchmarkTests(unittest.TestCase):
+
+    def _callFUT(self, name, count=3, **kw):
+        from repoze.mailin.benchmarks.runner import runBenchmark
+        return runBenchmark(name, count, **kw)
+
+    def _checkSummary(self, summary, name, count=3):
+        self.assertEqual(summary['name'], name)
+        self.assertEqual(summary['count'], count)
+        self.failUnless(summary['per_second'] > 0)
+
+    def test_unknown(self):
+        self.assertRaises(KeyError, self._callFUT, 'nonesuch')
+
+    def test_store(self):
+        self._checkSummary(self._callFUT('store_set', size=10), 'store_set')
+        self._checkSummary(self._callFUT('store_get', size=10), 'store_get')
+
+    def test_drain(self):
+        self._checkSummary(self._callFUT('drain', batch_size=2), 'drain')
+        self._checkSummary(self._callFUT('drain_headers_only', batch_size=2),
+                           'drain_headers_only')
+
+    def test_queue(self):
+        summary = self._callFUT('queue_push', depth=5)
+        self._checkSummary(summary, 'queue_push')
+        self.assertEqual(summary['params'], {'depth': 5})
+        self._checkSummary(self._callFUT('queue_pop', depth=5), 'queue_pop')
+        summary = self._callFUT('queue_push_grouped', depth=5, batch_size=2)
+        self._checkSummary(summary, 'queue_push_grouped')
+        self.assertEqual(summary['params'], {'depth': 5, 'batch_size': 2})
+
+    def test_pollster(self):
+        summary = self._callFUT('pollster', batch_size=2)
+        self._checkSummary(summary, 'pollster')
+        self.assertEqual(summary['params'], {'size': 1024, 'batch_size': 2})
+
+    def test_w_profile(self):
+        summary = self._callFUT('queue_push', depth=1, profile='wal')
+        self._checkSummary(summary, 'queue_push')
+        self.assertEqual(summary['params'], {'depth': 1, 'profile': 'wal'})
+
+    def test_removes_scratch_directory(self):
+        import os
+        import shutil
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        try:
+            self._callFUT('queue_push', tempdir=tempdir)
+            self.assertEqual(os.listdir(tempdir), [])
+        finally:
+            shutil.rmtree(tempdir)
+
+class BenchmarkRunnerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.benchmarks.runner import BenchmarkRunner
+        return BenchmarkRunner
+
+    def _makeOne(self, *args):
+        return self._getTargetClass()(['mailin-benchmark'] + list(args))
+
+    def test_plan_expands_depths(self):
+        runner = self._makeOne('-n', '5', '-d', '0,10', 'queue_pop', 'drain')
+        plan = runner.plan()
+        self.assertEqual([(name, kw.get('depth')) for name, c, t, kw in plan],
+                         [('drain', None),
+                          ('queue_pop', 0),
+                          ('queue_pop', 10),
+                         ])
+        self.assertEqual(plan[0][1], 5)
+
+    def test_plan_w_sqlite_profile(self):
+        runner = self._makeOne('-P', 'wal', 'store_set')
+        [(name, count, tempdir, kw)] = runner.plan()
+        self.assertEqual(kw['profile'], 'wal')
+
+    def test_unknown_sqlite_profile(self):
+        import sys
+        from StringIO import StringIO
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertRaises(SystemExit, self._makeOne, '-P', 'nonesuch')
+        finally:
+            sys.stdout = stdout
+
+    def test_unknown_benchmark(self):
+        import sys
+        from StringIO import StringIO
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertRaises(SystemExit, self._makeOne, 'nonesuch')
+        finally:
+            sys.stdout = stdout
+
+    def test_run_writes_json(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(tempdir, 'results.json')
+            runner = self._makeOne('-n', '2', '-d', '1', '-I', '-q',
+                                   '-o', output, 'queue_push', 'queue_pop')
+            runner.run()
+            document = json.load(open(output))
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(document['count'], 2)
+        self.assertEqual([r['name'] for r in document['results']],
+                         ['queue_push', 'queue_pop'])
@@ -0,0 +1,152 @@
+import unittest
+
+class GetProfileTests(unittest.TestCase):
+
+    def _callFUT(self, profile=None):
+        from repoze.mailin.database import getProfile
+        return getProfile(profile)
+
+    def test_default(self):
+        from repoze.mailin.database import PROFILES
+        self.assertEqual(self._callFUT(), PROFILES['default'])
+
+    def test_named_is_copy(self):
+        from repoze.mailin.database import PROFILES
+        profile = self._callFUT('wal')
+        self.assertEqual(profile, PROFILES['wal'])
+        profile['synchronous'] = 'full'
+        self.assertEqual(PROFILES['wal']['synchronous'], 'normal')
+
+    def test_mapping(self):
+        self.assertEqual(self._callFUT({'synchronous': 'off'}),
+                         {'synchronous': 'off'})
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self._callFUT, 'nonesuch')
+
+class ConnectTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _callFUT(self, profile=None, **kw):
+        import os
+        import tempfile
+        from repoze.mailin.database import connect
+        if self._tempdir is None:
+            self._tempdir = tempfile.mkdtemp()
+        return connect(os.path.join(self._tempdir, 'test.db'), profile, **kw)
+
+    def _pragma(self, sql, name):
+        return sql.execute('pragma %s' % name).fetchone()[0]
+
+    def test_default(self):
+        sql = self._callFUT()
+        self.assertEqual(sql.isolation_level, None)
+        self.assertEqual(self._pragma(sql, 'journal_mode'), 'delete')
+        self.assertEqual(self._pragma(sql, 'synchronous'), 2)
+
+    def test_wal(self):
+        sql = self._callFUT('wal')
+        self.assertEqual(self._pragma(sql, 'journal_mode'), 'wal')
+        self.assertEqual(self._pragma(sql, 'synchronous'), 1)
+
+    def test_fast(self):
+        from repoze.mailin.database import PROFILES
+        sql = self._callFUT('fast')
+        self.assertEqual(self._pragma(sql, 'journal_mode'), 'wal')
+        self.assertEqual(self._pragma(sql, 'cache_size'),
+                         PROFILES['fast']['cache_size'])
+
+    def test_settings_override_profile(self):
+        sql = self._callFUT('wal', synchronous='full', journal_mode=None)
+        self.assertEqual(self._pragma(sql, 'journal_mode'), 'wal')
+        self.assertEqual(self._pragma(sql, 'synchronous'), 2)
+
+    def test_readers_dont_block_writer(self):
+        writer = self._callFUT('wal', timeout=0)
+        writer.execute('create table t(a)')
+        reader = self._callFUT('wal', timeout=0)
+        reader.execute('begin')
+        self.assertEqual(reader.execute('select count(*) from t'
+                                       ).fetchone()[0], 0)
+        writer.execute('insert into t values(1)')
+        self.assertEqual(reader.execute('select count(*) from t'
+                                       ).fetchone()[0], 0)
+        reader.execute('commit')
+        self.assertEqual(reader.execute('select count(*) from t'
+                                       ).fetchone()[0], 1)
+
+    def test_busy_timeout(self):
+        import sqlite3
+        import time
+        locker = self._callFUT()
+        locker.execute('create table t(a)')
+        locker.execute('begin exclusive')
+        other = self._callFUT(timeout=0.2)
+        started = time.time()
+        self.assertRaises(sqlite3.OperationalError,
+                          other.execute, 'select * from t')
+        self.failUnless(time.time() - started >= 0.15)
+
+    def test_invalid_setting(self):
+        self.assertRaises(ValueError, self._callFUT, synchronous='x')
+        self.assertRaises(TypeError, self._callFUT, nonesuch=1)
+
+class SetPragmasTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _callFUT(self, sql, **kw):
+        from repoze.mailin.database import setPragmas
+        return setPragmas(sql, **kw)
+
+    def _connect(self):
+        import os
+        import sqlite3
+        import tempfile
+        self._tempdir = tempfile.mkdtemp()
+        return sqlite3.connect(os.path.join(self._tempdir, 'test.db'),
+                               isolation_level=None)
+
+    def test_defaults_unchanged(self):
+        sql = self._connect()
+        self._callFUT(sql)
+        self.assertEqual(sql.execute('pragma journal_mode').fetchone()[0],
+                         'delete')
+        self.assertEqual(sql.execute('pragma synchronous').fetchone()[0], 2)
+
+    def test_wal_normal(self):
+        sql = self._connect()
+        self._callFUT(sql, journal_mode='WAL', synchronous='normal')
+        self.assertEqual(sql.execute('pragma journal_mode').fetchone()[0],
+                         'wal')
+        self.assertEqual(sql.execute('pragma synchronous').fetchone()[0], 1)
+
+    def test_synchronous_by_number(self):
+        sql = self._connect()
+        self._callFUT(sql, synchronous=0)
+        self.assertEqual(sql.execute('pragma synchronous').fetchone()[0], 0)
+
+    def test_invalid(self):
+        sql = self._connect()
+        self.assertRaises(ValueError, self._callFUT, sql, journal_mode='x')
+        self.assertRaises(ValueError, self._callFUT, sql, synchronous='4')
+        self.assertRaises(ValueError, self._callFUT, sql,
+                          synchronous='normal; drop table x')
+        self.assertRaises(ValueError, self._callFUT, sql, mmap_size='1; x')
+
+    def test_mmap_and_cache_size(self):
+        sql = self._connect()
+        self._callFUT(sql, mmap_size=1024 * 1024, cache_size=-1024)
+        self.assertEqual(sql.execute('pragma cache_size').fetchone()[0],
+                         -1024)
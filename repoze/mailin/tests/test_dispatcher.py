@@ -0,0 +1,281 @@
+import unittest
+
+class ResolveDottedNameTests(unittest.TestCase):
+
+    def _callFUT(self, name):
+        from repoze.mailin.dispatcher import resolveDottedName
+        return resolveDottedName(name)
+
+    def test_module(self):
+        import repoze.mailin.dispatcher
+        self.failUnless(self._callFUT('repoze.mailin.dispatcher')
+                            is repoze.mailin.dispatcher)
+
+    def test_dotted_attr(self):
+        from repoze.mailin.dispatcher import Dispatcher
+        self.failUnless(self._callFUT('repoze.mailin.dispatcher.Dispatcher')
+                            is Dispatcher)
+
+    def test_colon_attr(self):
+        from repoze.mailin.dispatcher import DispatchStats
+        self.failUnless(self._callFUT('repoze.mailin.dispatcher:'
+                                      'DispatchStats.record')
+                            == DispatchStats.record)
+
+    def test_nonesuch(self):
+        self.assertRaises(ImportError, self._callFUT,
+                          'repoze.mailin.nonesuch')
+        self.assertRaises(AttributeError, self._callFUT,
+                          'repoze.mailin.dispatcher:nonesuch')
+
+class MakeFilterTests(unittest.TestCase):
+
+    def _callFUT(self, name):
+        from repoze.mailin.dispatcher import makeFilter
+        return makeFilter(name)
+
+    def test_class_is_instantiated(self):
+        from repoze.mailin.dispatcher import DispatchStats
+        self.failUnless(isinstance(
+                self._callFUT('repoze.mailin.dispatcher.DispatchStats'),
+                DispatchStats))
+
+    def test_function_is_returned(self):
+        from repoze.mailin.dispatcher import resolveDottedName
+        self.failUnless(self._callFUT('repoze.mailin.dispatcher:'
+                                      'resolveDottedName')
+                            is resolveDottedName)
+
+class DispatchStatsTests(unittest.TestCase):
+
+    def _makeOne(self):
+        from repoze.mailin.dispatcher import DispatchStats
+        return DispatchStats()
+
+    def test_record_accumulates_in_order(self):
+        stats = self._makeOne()
+        stats.record('load', 0.5)
+        stats.record('claim', 1.0, 10)
+        stats.record('load', 0.5)
+        self.assertEqual(stats.stages, ['load', 'claim'])
+        self.assertEqual(stats.timings['load'], [2, 1.0])
+        self.assertEqual(stats.timings['claim'], [10, 1.0])
+
+    def test_report(self):
+        stats = self._makeOne()
+        stats.record('claim', 2.0, 10)
+        stats.record('load', 0.0)
+        stats.count('processed')
+        stats.count('processed')
+        lines = stats.report()
+        self.assertEqual(len(lines), 3)
+        self.failUnless(lines[0].startswith('claim'))
+        self.failUnless('(5.0/sec)' in lines[0])
+        self.failUnless('(n/a)' in lines[1])
+        self.assertEqual(lines[2].split(), ['processed', '2'])
+
+class DispatcherTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.dispatcher import Dispatcher
+        return Dispatcher
+
+    def _makeOne(self, filters=(), messages=None, **kw):
+        from repoze.mailin.pending import PendingQueue
+        if messages is None:
+            messages = {'a': DummyMessage('a'), 'b': DummyMessage('b')}
+        store = DummyStore(messages)
+        pq = PendingQueue()
+        for message_id in sorted(messages):
+            pq.push(message_id)
+        return self._getTargetClass()(store, pq, filters, **kw)
+
+    def test_run_empty(self):
+        dispatcher = self._makeOne(messages={})
+        self.assertEqual(list(dispatcher.run()), [])
+
+    def test_run_processes_and_acks(self):
+        seen = []
+        def _filter(message, blackboard):
+            seen.append((message.message_id, blackboard))
+        hooks = []
+        dispatcher = self._makeOne([_filter],
+                                   commit=lambda: hooks.append('commit'),
+                                   abort=lambda: hooks.append('abort'))
+        self.assertEqual(list(dispatcher.run()),
+                         [('a', 'processed'), ('b', 'processed')])
+        self.assertEqual(seen, [('a', {}), ('b', {})])
+        self.assertEqual(hooks, ['commit', 'commit'])
+        self.failIf(dispatcher.pending_queue)
+        self.assertEqual(dispatcher.stats.outcomes, {'processed': 2})
+        self.assertEqual(dispatcher.stats.stages,
+                         ['claim', 'load', '0:_filter', 'commit', 'total',
+                          'ack'])
+
+    def test_run_in_batches_w_limit(self):
+        messages = dict([(x, DummyMessage(x)) for x in 'abcde'])
+        dispatcher = self._makeOne(messages=messages, batch_size=2)
+        self.assertEqual([x[0] for x in dispatcher.run(3)], ['a', 'b', 'c'])
+        self.assertEqual(dispatcher.stats.timings['claim'][0], 3)
+        self.assertEqual(len(dispatcher.pending_queue), 2)
+
+    def test_blackboard_factory_shared_across_filters(self):
+        def _first(message, blackboard):
+            blackboard['first'] = message.message_id
+        def _second(message, blackboard):
+            blackboard['second'] = blackboard['first']
+        boards = []
+        def _factory(message):
+            board = {'message': message.message_id}
+            boards.append(board)
+            return board
+        dispatcher = self._makeOne([_first, _second],
+                                   blackboard_factory=_factory)
+        list(dispatcher.run())
+        self.assertEqual(boards,
+                         [{'message': 'a', 'first': 'a', 'second': 'a'},
+                          {'message': 'b', 'first': 'b', 'second': 'b'},
+                         ])
+
+    def test_stop_processing_skips_rest_and_commits(self):
+        from repoze.mailin.interfaces import StopProcessing
+        def _stop(message, blackboard):
+            raise StopProcessing()
+        def _never(message, blackboard):
+            self.fail('called after StopProcessing')
+        hooks = []
+        dispatcher = self._makeOne([_stop, _never],
+                                   commit=lambda: hooks.append('commit'),
+                                   abort=lambda: hooks.append('abort'))
+        self.assertEqual([x[1] for x in dispatcher.run()],
+                         ['stopped', 'stopped'])
+        self.assertEqual(hooks, ['commit', 'commit'])
+        self.failIf(dispatcher.pending_queue)
+
+    def test_cancel_processing_skips_rest_and_aborts(self):
+        from repoze.mailin.interfaces import CancelProcessing
+        def _cancel(message, blackboard):
+            raise CancelProcessing()
+        def _never(message, blackboard):
+            self.fail('called after CancelProcessing')
+        hooks = []
+        dispatcher = self._makeOne([_cancel, _never],
+                                   commit=lambda: hooks.append('commit'),
+                                   abort=lambda: hooks.append('abort'))
+        self.assertEqual([x[1] for x in dispatcher.run()],
+                         ['cancelled', 'cancelled'])
+        self.assertEqual(hooks, ['abort', 'abort'])
+        self.failIf(dispatcher.pending_queue)
+        self.assertEqual(list(dispatcher.pending_queue.iter_quarantine()),
+                         [])
+
+    def test_filter_error_quarantines_and_aborts(self):
+        def _explode(message, blackboard):
+            if message.message_id == 'a':
+                raise ValueError('bad message')
+        hooks = []
+        logger = DummyLogger()
+        dispatcher = self._makeOne([_explode],
+                                   commit=lambda: hooks.append('commit'),
+                                   abort=lambda: hooks.append('abort'),
+                                   logger=logger)
+        self.assertEqual(list(dispatcher.run()),
+                         [('a', 'quarantined'), ('b', 'processed')])
+        self.assertEqual(hooks, ['abort', 'commit'])
+        pq = dispatcher.pending_queue
+        self.assertEqual(list(pq.iter_quarantine()), ['a'])
+        self.assertEqual(pq.get_error_message('a'), 'ValueError: bad message')
+        self.assertEqual(len(logger.logged), 1)
+        self.failIf(pq)
+
+    def test_missing_message_quarantined(self):
+        dispatcher = self._makeOne()
+        del dispatcher.store.messages['a']
+        self.assertEqual(list(dispatcher.run()),
+                         [('a', 'quarantined'), ('b', 'processed')])
+        self.assertEqual(list(dispatcher.pending_queue.iter_quarantine()),
+                         ['a'])
+
+    def test_commit_error_quarantines(self):
+        hooks = []
+        def _commit():
+            raise ValueError('conflict')
+        dispatcher = self._makeOne(commit=_commit,
+                                   abort=lambda: hooks.append('abort'))
+        self.assertEqual([x[1] for x in dispatcher.run()],
+                         ['quarantined', 'quarantined'])
+        self.assertEqual(hooks, ['abort', 'abort'])
+
+class ParallelDispatcherTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.dispatcher import ParallelDispatcher
+        return ParallelDispatcher
+
+    def _makeOne(self, filters=(), message_ids='abcde', **kw):
+        from repoze.mailin.pending import PendingQueue
+        pq = PendingQueue()
+        for message_id in message_ids:
+            pq.push(message_id)
+        return self._getTargetClass()(_makeStore, pq, filters, workers=2,
+                                      **kw)
+
+    def test_ctor_defaults_workers_to_cpu_count(self):
+        import multiprocessing
+        from repoze.mailin.pending import PendingQueue
+        dispatcher = self._getTargetClass()(_makeStore, PendingQueue(), ())
+        self.assertEqual(dispatcher.workers, multiprocessing.cpu_count())
+        self.assertEqual(dispatcher.store, None)
+
+    def test_run_processes_in_workers(self):
+        dispatcher = self._makeOne([_checkInWorker], batch_size=2)
+        self.assertEqual(list(dispatcher.run()),
+                         [(x, 'processed') for x in 'abcde'])
+        self.failIf(dispatcher.pending_queue)
+        self.assertEqual(dispatcher.stats.outcomes, {'processed': 5})
+        self.assertEqual(dispatcher.stats.timings['0:_checkInWorker'][0], 5)
+        self.assertEqual(dispatcher.stats.timings['ack'][0], 5)
+
+    def test_run_w_limit(self):
+        dispatcher = self._makeOne(batch_size=2)
+        self.assertEqual([x[0] for x in dispatcher.run(3)], ['a', 'b', 'c'])
+        self.assertEqual(len(dispatcher.pending_queue), 2)
+
+    def test_run_quarantines_in_parent(self):
+        dispatcher = self._makeOne([_checkInWorker], message_ids='abz')
+        self.assertEqual(list(dispatcher.run()),
+                         [('a', 'processed'), ('b', 'processed'),
+                          ('z', 'quarantined')])
+        pq = dispatcher.pending_queue
+        self.assertEqual(list(pq.iter_quarantine()), ['z'])
+        self.assertEqual(pq.get_error_message('z'), "KeyError: 'z'")
+
+def _makeStore():
+    return DummyStore(dict([(x, DummyMessage(x)) for x in 'abcde']))
+
+def _checkInWorker(message, blackboard):
+    import os
+    from repoze.mailin.dispatcher import _worker
+    assert _worker is not None
+    blackboard['pid'] = os.getpid()
+
+class DummyMessage:
+
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+class DummyStore:
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __getitem__(self, message_id):
+        return self.messages[message_id]
+
+class DummyLogger:
+
+    def __init__(self):
+        self.logged = []
+
+    def log(self, level, message):
+        self.logged.append((level, message))
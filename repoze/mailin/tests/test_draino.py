@@ -0,0 +1,150 @@
+import unittest
+
+class Test_splitLimit(unittest.TestCase):
+
+    def _callFUT(self, limit, workers):
+        from repoze.mailin.scripts.draino import splitLimit
+        return splitLimit(limit, workers)
+
+    def test_no_limit(self):
+        self.assertEqual(self._callFUT(None, 3), [None, None, None])
+
+    def test_even(self):
+        self.assertEqual(self._callFUT(6, 3), [2, 2, 2])
+
+    def test_uneven(self):
+        self.assertEqual(self._callFUT(7, 3), [3, 2, 2])
+
+    def test_fewer_than_workers(self):
+        self.assertEqual(self._callFUT(1, 4), [1, 0, 0, 0])
+
+class DrainoTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getTempdir(self):
+        import tempfile
+        if self._tempdir is None:
+            self._tempdir = tempfile.mkdtemp()
+        return self._tempdir
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.draino import Draino
+        return Draino
+
+    def _makeOne(self, *args):
+        argv = ['draino', '--quiet'] + list(args) + [self._getTempdir()]
+        return self._getTargetClass()(argv)
+
+    def _populateClaimed(self, message_ids, claim):
+        from repoze.mailin.maildir import MaildirStore
+        md = MaildirStore(self._getTempdir())
+        root = md._getMaildir()
+        for message_id in message_ids:
+            root.add('Date: Thu, 01 Oct 2009 10:00:00 -0000\r\n'
+                     'Message-Id: %s\r\n\r\nBody.' % message_id)
+        md._claimMessages(root, md._getClaimMaildir(claim),
+                          iter(sorted(root.iterkeys())), len(message_ids))
+        return md
+
+    def test_do_drain_leaves_claims(self):
+        md = self._populateClaimed(['<abc@example.com>'], 'worker-1')
+        self._makeOne().do_drain()
+        self.assertEqual(list(md.iterkeys()), [])
+        self.assertEqual(len(md._getClaimMaildir('worker-1')), 1)
+
+    def test_do_drain_w_release_claims(self):
+        md = self._populateClaimed(['<abc@example.com>'], 'worker-1')
+        self._makeOne('--release-claims').do_drain()
+        self.assertEqual(list(md.iterkeys()), ['<abc@example.com>'])
+        self.assertEqual(len(md._getClaimMaildir('worker-1')), 0)
+
+    def test_release_claims_w_dry_run(self):
+        import sys
+        from StringIO import StringIO
+        _saved, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertRaises(SystemExit,
+                              self._makeOne, '--release-claims', '--dry-run')
+        finally:
+            sys.stdout = _saved
+
+    def test_negative_batch_size(self):
+        import sys
+        from StringIO import StringIO
+        _saved, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertRaises(SystemExit,
+                              self._makeOne, '--batch-size', '-1')
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = _saved
+        self.failUnless('Batch size must not be negative' in printed)
+
+class DrainoWatchTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.draino import Draino
+        return Draino
+
+    def _makeOne(self):
+        import tempfile
+        self._tempdir = tempfile.mkdtemp()
+        return self._getTargetClass()(['draino', '--quiet', '--watch',
+                                       self._tempdir])
+
+    def test_watch_inbox_backs_off_after_errors(self):
+        from repoze.mailin.maildir import MaildirStore
+        from repoze.mailin.scripts import draino as draino_module
+        draino = self._makeOne()
+        draino.max_backoff = 3
+        md = MaildirStore(self._tempdir)
+        md.metrics = DummyMetrics()
+        # Fail three times, drain the limit, fail once more, then stop.
+        outcomes = [ValueError('bad'), ValueError('bad'), ValueError('bad'),
+                    1, ValueError('bad'), KeyboardInterrupt()]
+        def drain():
+            outcome = outcomes.pop(0)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            return outcome
+        clock = DummyTime()
+        _saved, draino_module.time = draino_module.time, clock
+        try:
+            self.assertRaises(KeyboardInterrupt,
+                              draino.watch_inbox, md, drain, 1)
+        finally:
+            draino_module.time = _saved
+        self.assertEqual(clock.slept, [1, 2, 3, 1])
+        self.assertEqual(md.metrics.counters, {'draino.errors': 4})
+
+
+class DummyMetrics:
+    def __init__(self):
+        self.counters = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+class DummyTime:
+    def __init__(self):
+        self.slept = []
+
+    def time(self):
+        import time
+        return time.time()
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
@@ -17,6 +17,45 @@ class _Base(object):
         return self._tempdir
 
 
+class Test_readHeaders(_Base, unittest.TestCase):
+
+    def _callFUT(self, path):
+        from repoze.mailin.maildir import _readHeaders
+        return _readHeaders(path)
+
+    def test_stops_at_blank_line(self):
+        import os
+        path = os.path.join(self._getTempdir(), 'message')
+        f = open(path, 'wb')
+        f.write('Message-Id: <abc@example.com>\r\n'
+                'Subject: Hi\r\n'
+                '\r\n'
+                'X-Not-A-Header: body\r\n')
+        f.close()
+        headers = self._callFUT(path)
+        self.assertEqual(headers['Message-Id'], '<abc@example.com>')
+        self.assertEqual(headers['Subject'], 'Hi')
+        self.assertEqual(headers['X-Not-A-Header'], None)
+
+
+class Test_removeFile(_Base, unittest.TestCase):
+
+    def _callFUT(self, path):
+        from repoze.mailin.maildir import _removeFile
+        return _removeFile(path)
+
+    def test_existing(self):
+        import os
+        path = os.path.join(self._getTempdir(), 'file')
+        open(path, 'w').close()
+        self._callFUT(path)
+        self.failIf(os.path.exists(path))
+
+    def test_missing(self):
+        import os
+        self._callFUT(os.path.join(self._getTempdir(), 'nonesuch'))
+
+
 class SaneFilenameMaildirTests(_Base, unittest.TestCase):
 
     def setUp(self):
@@ -42,6 +81,102 @@ class SaneFilenameMaildirTests(_Base, unittest.TestCase):
         md = self._makeOne()
         self.failUnless(isinstance(md, Maildir))
 
+    def _touch(self, md, subpath):
+        import os
+        open(os.path.join(md._path, subpath), 'w').close()
+
+    def test_iterDelivered_empty(self):
+        md = self._makeOne()
+        self.assertEqual(list(md.iterDelivered()), [])
+
+    def test_iterDelivered_orders_by_timestamp(self):
+        md = self._makeOne()
+        self._touch(md, 'new/1000000000.M2P1Q1.example.com')
+        self._touch(md, 'new/999999999.M1P1Q1.example.com')
+        self._touch(md, 'new/1000000000.M1P1Q1.example.com')
+        self._touch(md, 'new/nonesuch')
+        self.assertEqual(list(md.iterDelivered()),
+                         ['999999999.M1P1Q1.example.com',
+                          '1000000000.M1P1Q1.example.com',
+                          '1000000000.M2P1Q1.example.com',
+                          'nonesuch',
+                         ])
+
+    def test_iterDelivered_includes_cur_skips_dirs_and_dotfiles(self):
+        import os
+        md = self._makeOne()
+        self._touch(md, 'cur/1000000001.M1P1Q1.example.com:2,S')
+        self._touch(md, 'new/1000000000.M1P1Q1.example.com')
+        self._touch(md, 'new/.hidden')
+        os.mkdir(os.path.join(md._path, 'new', '1000000002.subdir'))
+        self.assertEqual(list(md.iterDelivered()),
+                         ['1000000000.M1P1Q1.example.com',
+                          '1000000001.M1P1Q1.example.com',
+                         ])
+
+    def test_iterDelivered_fills_toc_lazily(self):
+        md = self._makeOne()
+        self._touch(md, 'new/1000000000.M1P1Q1.example.com')
+        self._touch(md, 'cur/1000000001.M1P1Q1.example.com:2,S')
+        keys = md.iterDelivered()
+        self.assertEqual(keys.next(), '1000000000.M1P1Q1.example.com')
+        self.assertEqual(md._toc,
+                         {'1000000000.M1P1Q1.example.com':
+                            'new/1000000000.M1P1Q1.example.com'})
+        self.assertEqual(keys.next(), '1000000001.M1P1Q1.example.com')
+        self.assertEqual(md._toc['1000000001.M1P1Q1.example.com'],
+                         'cur/1000000001.M1P1Q1.example.com:2,S')
+
+    def test_forget(self):
+        md = self._makeOne()
+        self._touch(md, 'new/1000000000.M1P1Q1.example.com')
+        list(md.iterDelivered())
+        md.forget('1000000000.M1P1Q1.example.com')
+        md.forget('nonesuch')
+        self.assertEqual(md._toc, {})
+
+
+class FolderCacheTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.maildir import FolderCache
+        return FolderCache
+
+    def _makeOne(self, maxsize=2):
+        return self._getTargetClass()(maxsize)
+
+    def test_get_miss(self):
+        cache = self._makeOne()
+        self.assertEqual(cache.get('nonesuch'), None)
+
+    def test_put_then_get(self):
+        cache = self._makeOne()
+        md = object()
+        cache.put('2009.06.23', md)
+        self.failUnless(cache.get('2009.06.23') is md)
+        self.failUnless('2009.06.23' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_evicts_least_recently_used(self):
+        cache = self._makeOne()
+        first, second, third = object(), object(), object()
+        cache.put('first', first)
+        cache.put('second', second)
+        cache.get('first')
+        cache.put('third', third)
+        self.assertEqual(len(cache), 2)
+        self.failUnless(cache.get('first') is first)
+        self.assertEqual(cache.get('second'), None)
+        self.failUnless(cache.get('third') is third)
+
+    def test_put_replaces_existing(self):
+        cache = self._makeOne()
+        old, new = object(), object()
+        cache.put('name', old)
+        cache.put('name', new)
+        self.assertEqual(len(cache), 1)
+        self.failUnless(cache.get('name') is new)
+
 
 class MaildirStoreTests(_Base, unittest.TestCase):
 
@@ -105,6 +240,39 @@ class MaildirStoreTests(_Base, unittest.TestCase):
                              ).fetchall())
         self.assertEqual(md.sql.isolation_level, None)
 
+    def test_ctor_creates_date_index(self):
+        md = self._makeOne()
+        self.failUnless(md.sql.execute(
+                             'select * from sqlite_master '
+                             'where type = "index" and name = "messages_date"'
+                             ).fetchall())
+
+    def test_ctor_migrates_unversioned_database(self):
+        import os
+        import sqlite3
+        path = self._getTempdir()
+        dbfile = os.path.join(path, 'metadata.db')
+        sql = sqlite3.connect(dbfile)
+        sql.execute('create table messages'
+                    '( id integer primary key'
+                    ', message_id varchar(1024) unique'
+                    ', year integer not null'
+                    ', month integer not null'
+                    ', day integer not null'
+                    ', maildir_key varchar(1024) not null unique'
+                    ')')
+        sql.execute('insert into messages'
+                    '(message_id, year, month, day, maildir_key)'
+                    ' values("ABC", 2009, 6, 23, "ABC")')
+        sql.commit()
+        sql.close()
+        md = self._makeOne(path, dbfile=None)
+        self.assertEqual(list(md.iterkeys()), [u'ABC'])
+        self.failUnless(md.sql.execute(
+                             'select * from sqlite_master '
+                             'where type = "index" and name = "messages_date"'
+                             ).fetchall())
+
     def test_ctor_w_dbfile(self):
         import os
         path = self._getTempdir()
@@ -115,6 +283,50 @@ class MaildirStoreTests(_Base, unittest.TestCase):
         md = self._makeOne(isolation_level='DEFERRED')
         self.assertEqual(md.sql.isolation_level, 'DEFERRED')
 
+    def test_ctor_w_folder_cache_size(self):
+        md = self._getTargetClass()(self._getTempdir(), ':memory:',
+                                    folder_cache_size=5)
+        self.assertEqual(md.folders.maxsize, 5)
+
+    def test__getMaildir_reuses_handles(self):
+        md = self._makeOne()
+        root = md._getMaildir()
+        folder = md._getMaildir('2009.06.23')
+        self.failUnless(md._getMaildir() is root)
+        self.failUnless(md._getMaildir('2009.06.23') is folder)
+        self.failUnless('2009.06.23' in md.folders)
+
+    def test__getMaildir_wo_create_nonesuch(self):
+        md = self._makeOne()
+        md._getMaildir()
+        self.assertRaises(KeyError, md._getMaildir, '2009.06.23',
+                          create=False)
+        self.failIf('2009.06.23' in md.folders)
+
+    def test__getMaildir_finds_folder_created_externally(self):
+        import os
+        import mailbox
+        path = self._getTempdir()
+        md = self._makeOne(path)
+        md._getMaildir()
+        root = mailbox.Maildir(os.path.join(path, 'Maildir'),
+                               factory=None, create=False)
+        root.add_folder('2009.06.23')
+        folder = md._getMaildir('2009.06.23', create=False)
+        self.assertEqual(len(folder), 0)
+
+    def test_ctor_w_timeout(self):
+        import os
+        path = self._getTempdir()
+        md = self._getTargetClass()(path, timeout=0.5)
+        self.failUnless(os.path.exists(os.path.join(md.path, 'metadata.db')))
+
+    def test_ctor_w_profile(self):
+        path = self._getTempdir()
+        md = self._getTargetClass()(path, profile='fast')
+        self.assertEqual(md.sql.execute('pragma journal_mode').fetchone()[0],
+                         'wal')
+
     def test_iterkeys_empty(self):
         md = self._makeOne()
         self.assertEqual(len(list(md.iterkeys())), 0)
@@ -128,6 +340,19 @@ class MaildirStoreTests(_Base, unittest.TestCase):
         md = self._makeOne()
         self.assertEqual(len(list(md.iterkeys())), 0)
 
+    def test_knownMessageIds_empty(self):
+        md = self._makeOne()
+        self.assertEqual(md.knownMessageIds([]), set())
+        self.assertEqual(md.knownMessageIds(['<abcdef@example.com>']), set())
+
+    def test_knownMessageIds_many(self):
+        md = self._makeOne()
+        md['<known@example.com>'] = self._makeMessage('<known@example.com>')
+        message_ids = ['<%d@example.com>' % i for i in range(1200)]
+        message_ids.insert(1000, '<known@example.com>')
+        self.assertEqual(md.knownMessageIds(iter(message_ids)),
+                         set(['<known@example.com>']))
+
     def test___getitem___nonesuch(self):
         md = self._makeOne()
         self.assertRaises(KeyError, lambda: md['nonesuch'])
@@ -194,6 +419,14 @@ class MaildirStoreTests(_Base, unittest.TestCase):
         self.assertEqual(len(keys), 1)
 
 
+    def test___setitem___message_id_w_quotes(self):
+        MESSAGE_ID ='<"quoted"@example.com>'
+        md = self._makeOne()
+        message = self._makeMessage(message_id=MESSAGE_ID)
+        md[MESSAGE_ID] = message
+        found = md[MESSAGE_ID]
+        self.assertEqual(found['Message-Id'], MESSAGE_ID)
+
     def test___setitem___message_object(self):
         MESSAGE_ID ='<defghi@example.com>'
         md = self._makeOne()
@@ -204,6 +437,108 @@ class MaildirStoreTests(_Base, unittest.TestCase):
         self.assertEqual(found['Message-Id'], message['Message-Id'])
         self.failUnless(MESSAGE_ID in list(md.iterkeys()))
 
+    def _writeMessageFile(self, message_id='<abc123@example.com>',
+                          when=None):
+        import os
+        path = os.path.join(self._getTempdir(), 'incoming.eml')
+        f = open(path, 'wb')
+        f.write(self._makeMessageText(message_id, when))
+        f.close()
+        return path
+
+    def test_setitem_getitem_metrics(self):
+        md = self._makeOne()
+        md.metrics = metrics = DummyMetrics()
+        md['<abc@example.com>'] = self._makeMessage('<abc@example.com>')
+        md['<abc@example.com>']
+        self.assertEqual(metrics.counters, {'store.stored': 1})
+        self.assertEqual(len(metrics.timings['store.write']), 1)
+        self.assertEqual(len(metrics.timings['store.load']), 1)
+
+    def test_storeFile(self):
+        import calendar
+        import os
+        import time
+        MESSAGE_ID ='<defghi@example.com>'
+        WHEN = time.strptime('2008-10-03T14:00:00-GMT',
+                             '%Y-%m-%dT%H:%M:%S-%Z')
+        path = self._writeMessageFile(MESSAGE_ID, calendar.timegm(WHEN))
+        text = open(path, 'rb').read()
+        md = self._makeOne()
+
+        key = md.storeFile(MESSAGE_ID, path)
+
+        self.failIf(os.path.exists(path))
+        folder = md._getMaildir('2008.10.03', create=False)
+        self.assertEqual(list(folder.iterkeys()), [key])
+        stored = os.path.join(folder._path, 'new', key)
+        self.assertEqual(open(stored, 'rb').read(), text)
+        self.assertEqual(md[MESSAGE_ID]['Message-Id'], MESSAGE_ID)
+
+    def test_storeFile_w_key_and_headers(self):
+        import os
+        from email import message_from_string
+        MESSAGE_ID ='<defghi@example.com>'
+        path = self._writeMessageFile(MESSAGE_ID)
+        headers = message_from_string(open(path).read())
+        md = self._makeOne()
+
+        key = md.storeFile(MESSAGE_ID, path, 'KEY', headers)
+
+        self.assertEqual(key, 'KEY')
+        self.failIf(os.path.exists(path))
+        self.assertEqual(md[MESSAGE_ID]['Message-Id'], MESSAGE_ID)
+
+    def test_storeFile_duplicate_leaves_file(self):
+        import os
+        import sqlite3
+        MESSAGE_ID ='<defghi@example.com>'
+        md = self._makeOne()
+        md.storeFile(MESSAGE_ID, self._writeMessageFile(MESSAGE_ID))
+        path = self._writeMessageFile(MESSAGE_ID)
+
+        self.assertRaises(sqlite3.IntegrityError,
+                          md.storeFile, MESSAGE_ID, path)
+
+        self.failUnless(os.path.exists(path))
+        folder_name, = md._getMaildir().list_folders()
+        self.assertEqual(len(md._getMaildir(folder_name)), 1)
+
+    def test_storeFile_duplicate_of_interrupted_link_keeps_it(self):
+        import os
+        import sqlite3
+        MESSAGE_ID ='<defghi@example.com>'
+        md = self._makeOne()
+        key = md.storeFile('<other@example.com>',
+                           self._writeMessageFile('<other@example.com>'))
+        folder_name, = md._getMaildir().list_folders()
+        stored = os.path.join(md._getMaildir(folder_name)._path, 'new', key)
+        path = os.path.join(self._getTempdir(), 'relinked.eml')
+        os.link(stored, path)
+
+        self.assertRaises(sqlite3.IntegrityError,
+                          md.storeFile, MESSAGE_ID, path, key)
+
+        self.failUnless(os.path.exists(stored))
+        self.failUnless(os.path.exists(path))
+
+    def test_storeFile_wo_hard_links(self):
+        import errno
+        import os
+        MESSAGE_ID ='<defghi@example.com>'
+        path = self._writeMessageFile(MESSAGE_ID)
+        md = self._makeOne()
+        def _link(src, dst):
+            raise OSError(errno.EPERM, 'Operation not permitted')
+        _saved, os.link = os.link, _link
+        try:
+            md.storeFile(MESSAGE_ID, path)
+        finally:
+            os.link = _saved
+
+        self.failIf(os.path.exists(path))
+        self.assertEqual(md[MESSAGE_ID]['Message-Id'], MESSAGE_ID)
+
     def test_drainInbox_empty_wo_pq(self):
         md = self._makeOne()
         root = md._getMaildir()
@@ -298,6 +633,54 @@ class MaildirStoreTests(_Base, unittest.TestCase):
         self.assertEqual(len(root), 1)
         self.assertEqual(pq._pushed, MESSAGE_IDS[:2])
 
+    def test_drainInbox_does_not_rebuild_toc(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        def _refresh():
+            raise AssertionError('TOC rebuilt')
+        root._refresh = _refresh
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, batch_size=1))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(pq._pushed, MESSAGE_IDS)
+
+    def test_drainInbox_forgets_drained_keys(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        md = self._makeOne()
+        root = md._getMaildir()
+        for kw in ({}, {'batch_size': 2}, {'claim': 'worker-0'}):
+            self._populateInbox(MESSAGE_IDS)
+            list(md.drainInbox(**kw))
+            md.sql.execute('delete from messages')
+            self.assertEqual(root._toc, {})
+
+    def test_drainInbox_w_batch_size_metrics(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        md.metrics = metrics = DummyMetrics()
+        list(md.drainInbox(batch_size=5))
+
+        self.assertEqual(metrics.counters,
+                         {'store.stored': 2, 'store.duplicates': 1})
+        self.assertEqual(len(metrics.timings['store.parse']), 3)
+        self.assertEqual(len(metrics.timings['store.write']), 2)
+        self.assertEqual(len(metrics.timings['store.commit']), 1)
+
     def test_drainInbox_not_empty_w_pq_dup_ids(self):
         MESSAGE_IDS = ['<abcdef@example.com>',
                        '<defghi@example.com>',
@@ -316,6 +699,512 @@ class MaildirStoreTests(_Base, unittest.TestCase):
         self.assertEqual(len(root), 0)
         self.assertEqual(pq._pushed, MESSAGE_IDS[:2])
 
+    def test_drainInbox_not_empty_w_pq_w_batch_size(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, batch_size=2))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(list(md.iterkeys())), len(MESSAGE_IDS))
+        self.assertEqual(len(root), 0)
+        self.assertEqual(pq._pushed, MESSAGE_IDS)
+
+    def test_drainInbox_w_batch_size_w_push_many(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+
+        pq = DummyPQManyPushes()
+        drained = list(md.drainInbox(pq, batch_size=2))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(pq._pushed, [MESSAGE_IDS[:2], MESSAGE_IDS[2:]])
+
+    def test_drainInbox_w_batch_size_w_limit(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, limit=2, batch_size=5))
+
+        self.assertEqual(drained, MESSAGE_IDS[:2])
+        self.assertEqual(len(list(md.iterkeys())), 2)
+        self.assertEqual(len(root), 1)
+        self.assertEqual(pq._pushed, MESSAGE_IDS[:2])
+
+    def test_drainInbox_w_batch_size_dup_ids(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<defghi@example.com>',
+                       '<abcdef@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, batch_size=3))
+
+        self.assertEqual(drained, MESSAGE_IDS[:2])
+        self.assertEqual(len(list(md.iterkeys())), 2)
+        self.assertEqual(len(root), 0)
+        self.assertEqual(pq._pushed, MESSAGE_IDS[:2])
+
+    def test_drainInbox_w_batch_size_dry_run(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        drained = list(md.drainInbox(dry_run=True, batch_size=2))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(list(md.iterkeys())), 0)
+        self.assertEqual(len(root), len(MESSAGE_IDS))
+
+    def test_drainInbox_w_batch_size_failure_rolls_back(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        md.sql.execute('create trigger no_defghi before insert on messages '
+                       'when new.message_id = "<defghi@example.com>" '
+                       'begin select raise(abort, "nope"); end')
+
+        import sqlite3
+        self.assertRaises(sqlite3.IntegrityError,
+                          list, md.drainInbox(batch_size=2))
+
+        self.assertEqual(len(list(md.iterkeys())), 0)
+        self.assertEqual(len(root), len(MESSAGE_IDS))
+        for name in root.list_folders():
+            self.assertEqual(len(root.get_folder(name)), 0)
+
+    def _populateInboxWithBadDate(self, message_ids, bad_message_id):
+        import os
+        from repoze.mailin.maildir import SaneFilenameMaildir
+        md_name = os.path.join(self._getTempdir(), 'Maildir')
+        md = SaneFilenameMaildir(md_name, factory=None, create=True)
+        for message_id in message_ids:
+            text = self._makeMessageText(message_id)
+            if message_id == bad_message_id:
+                text = text.replace('Date: ', 'Date: not a date; was ')
+            md.add(text)
+
+    def test_drainInbox_w_bad_date_sets_aside(self):
+        import os
+        from repoze.mailin.maildir import SaneFilenameMaildir
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInboxWithBadDate(MESSAGE_IDS, MESSAGE_IDS[0])
+
+        md = self._makeOne()
+        md.metrics = metrics = DummyMetrics()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        self.assertRaises(TypeError, list, md.drainInbox(pq))
+        self.assertEqual(len(root), 1)
+        failed = SaneFilenameMaildir(os.path.join(md.mdpath, 'failed'))
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(metrics.counters, {'store.failed': 1})
+
+        drained = list(md.drainInbox(pq))
+        self.assertEqual(drained, MESSAGE_IDS[1:])
+        self.assertEqual(len(root), 0)
+
+    def test_drainInbox_w_storage_error_leaves_message_in_inbox(self):
+        import errno
+        import os
+        from repoze.mailin.maildir import SaneFilenameMaildir
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                      ]
+        self._populateInboxWithBadDate(MESSAGE_IDS, None)
+
+        md = self._makeOne()
+        md.metrics = metrics = DummyMetrics()
+        root = md._getMaildir()
+        _getMaildir = md._getMaildir
+        def _full(folder=None, create=True):
+            if folder is not None:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            return _getMaildir(folder, create)
+        md._getMaildir = _full
+
+        pq = DummyPQ()
+        self.assertRaises(OSError, list, md.drainInbox(pq))
+        self.assertEqual(len(root), 1)
+        failed = os.path.join(md.mdpath, 'failed')
+        self.failIf(os.path.exists(failed) and
+                    len(SaneFilenameMaildir(failed)))
+        self.failIf('store.failed' in metrics.counters)
+
+        md._getMaildir = _getMaildir
+        drained = list(md.drainInbox(pq))
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(root), 0)
+
+    def test_drainInbox_w_batch_size_w_bad_date_stores_rest(self):
+        import os
+        from repoze.mailin.maildir import SaneFilenameMaildir
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                       '<jklmno@example.com>',
+                      ]
+        self._populateInboxWithBadDate(MESSAGE_IDS, MESSAGE_IDS[1])
+
+        md = self._makeOne()
+        md.metrics = metrics = DummyMetrics()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        drained = []
+        def _drain():
+            for message_id in md.drainInbox(pq, batch_size=3):
+                drained.append(message_id)
+        self.assertRaises(TypeError, _drain)
+
+        # The rest of the bad message's batch is stored;  the bad message
+        # is set aside, so the next drain gets past it.
+        good = [MESSAGE_IDS[0], MESSAGE_IDS[2]]
+        self.assertEqual(drained, good)
+        self.assertEqual(sorted(md.iterkeys()), good)
+        self.assertEqual(pq._pushed, good)
+        self.assertEqual(len(root), 1)
+        failed = SaneFilenameMaildir(os.path.join(md.mdpath, 'failed'))
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(metrics.counters['store.failed'], 1)
+
+        drained = list(md.drainInbox(pq, batch_size=3))
+        self.assertEqual(drained, MESSAGE_IDS[3:])
+        self.assertEqual(len(root), 0)
+
+    def test_drainInbox_w_claim_dry_run_raises(self):
+        md = self._makeOne()
+        self.assertRaises(ValueError,
+                          list, md.drainInbox(dry_run=True, claim='worker-0'))
+
+    def test_drainInbox_w_claim(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, claim='worker-0'))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(list(md.iterkeys())), len(MESSAGE_IDS))
+        self.assertEqual(len(root), 0)
+        self.assertEqual(pq._pushed, MESSAGE_IDS)
+        claimed = md._getClaimMaildir('worker-0')
+        self.assertEqual(len(claimed), 0)
+        self.assertEqual(root.list_folders(), [md._getFolderName(
+                            *md._getMessageDate(md[MESSAGE_IDS[0]]))])
+
+    def test_drainInbox_w_claim_w_batch_size_w_limit(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, limit=2, batch_size=5,
+                                     claim='worker-0'))
+
+        self.assertEqual(drained, MESSAGE_IDS[:2])
+        self.assertEqual(len(root), 1)
+        self.assertEqual(len(md._getClaimMaildir('worker-0')), 0)
+
+    def test_drainInbox_w_claim_drains_leftovers_first(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        claimed = md._getClaimMaildir('worker-0')
+        keys = sorted(root.iterkeys())
+        md._claimMessages(root, claimed, iter(keys[1:]), 1)
+
+        drained = list(md.drainInbox(limit=1, claim='worker-0'))
+
+        self.assertEqual(drained, MESSAGE_IDS[1:])
+        self.assertEqual(len(root), 1)
+
+    def test_drainInbox_wo_claim_leaves_claims(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        keys = sorted(root.iterkeys())
+        claimed = md._getClaimMaildir('worker-3')
+        md._claimMessages(root, claimed, iter(keys[:2]), 2)
+
+        drained = list(md.drainInbox())
+
+        self.assertEqual(drained, MESSAGE_IDS[2:])
+        self.assertEqual(len(root), 0)
+        self.assertEqual(len(claimed), 2)
+
+        self.assertEqual(md.releaseClaims(), 2)
+        drained = list(md.drainInbox())
+
+        self.assertEqual(drained, MESSAGE_IDS[:2])
+        self.assertEqual(len(claimed), 0)
+
+    def test_releaseClaims_wo_claims(self):
+        md = self._makeOne()
+        self.assertEqual(md.releaseClaims(), 0)
+
+    def test_releaseClaims_w_keep(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        keys = sorted(root.iterkeys())
+        mine = md._getClaimMaildir('worker-0')
+        md._claimMessages(root, mine, iter(keys[:1]), 1)
+        orphan = md._getClaimMaildir('worker-2')
+        md._claimMessages(root, orphan, iter(keys[1:]), 2)
+
+        self.assertEqual(md.releaseClaims(keep=['worker-0', 'worker-1']), 2)
+
+        self.assertEqual(sorted(root.iterkeys()), keys[1:])
+        self.assertEqual(sorted(mine.iterkeys()), keys[:1])
+        self.assertEqual(len(orphan), 0)
+
+        drained = list(md.drainInbox(claim='worker-0'))
+        self.assertEqual(drained, MESSAGE_IDS)
+
+    def test__claimMessages_skips_messages_claimed_elsewhere(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        keys = sorted(root.iterkeys())
+        other = md._getClaimMaildir('worker-1')
+        self.assertEqual(md._claimMessages(root, other, iter(keys), 1), 1)
+
+        mine = md._getClaimMaildir('worker-0')
+        self.assertEqual(md._claimMessages(root, mine, iter(keys), 5), 2)
+
+        self.assertEqual(sorted(other.iterkeys()), keys[:1])
+        self.assertEqual(sorted(mine.iterkeys()), keys[1:])
+        self.assertEqual(len(root), 0)
+
+    def _inboxFiles(self, root):
+        import os
+        result = {}
+        for key in root.iterkeys():
+            path = os.path.join(root._path, root._lookup(key))
+            result[key] = (open(path, 'rb').read(), os.stat(path).st_ino)
+        return result
+
+    def test_drainInbox_w_headers_only(self):
+        import os
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        inbox = self._inboxFiles(root)
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, headers_only=True))
+
+        self.assertEqual(drained, MESSAGE_IDS[:2])
+        self.assertEqual(pq._pushed, MESSAGE_IDS[:2])
+        self.assertEqual(len(root), 0)
+        for message_id in MESSAGE_IDS[:2]:
+            yy, mm, dd, key = md.sql.execute(
+                'select year, month, day, maildir_key from messages '
+                'where message_id = ?', (message_id,)).fetchone()
+            folder = md._getMaildir(md._getFolderName(yy, mm, dd))
+            path = os.path.join(folder._path, folder._lookup(key))
+            # Same bytes, same inode:  linked, not re-written.
+            self.assertEqual((open(path, 'rb').read(), os.stat(path).st_ino),
+                             inbox[key])
+            self.assertEqual(md[message_id]['Message-Id'], message_id)
+
+    def _linkAsInterrupted(self, md, root, key, message_id, insert=True):
+        # Leave 'key' as a drain interrupted after linking it into its
+        # folder (and, if 'insert', after committing its row).
+        import os
+        from repoze.mailin.maildir import _readHeaders
+        path = os.path.join(root._path, root._lookup(key))
+        date = md._getMessageDate(_readHeaders(path))
+        folder = md._getMaildir(md._getFolderName(*date))
+        os.link(path, os.path.join(folder._path, 'new', key))
+        if insert:
+            md.sql.execute('insert into messages'
+                           '(message_id, year, month, day, maildir_key) '
+                           'values(?, ?, ?, ?, ?)', (message_id,) + date +
+                                                    (key,))
+
+    def test_drainInbox_w_headers_only_resumes_interrupted(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        keys = sorted(root.iterkeys())
+        self._linkAsInterrupted(md, root, keys[0], MESSAGE_IDS[0])
+
+        pq = DummyPQ()
+        drained = list(md.drainInbox(pq, headers_only=True))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(pq._pushed, MESSAGE_IDS)
+        self.assertEqual(len(root), 0)
+        for message_id in MESSAGE_IDS:
+            self.assertEqual(md[message_id]['Message-Id'], message_id)
+
+    def test_drainInbox_w_headers_only_linked_wo_row(self):
+        self._populateInbox(['<abcdef@example.com>'])
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        key, = root.keys()
+        self._linkAsInterrupted(md, root, key, '<abcdef@example.com>',
+                                insert=False)
+
+        drained = list(md.drainInbox(headers_only=True))
+
+        self.assertEqual(drained, ['<abcdef@example.com>'])
+        self.assertEqual(len(root), 0)
+        self.assertEqual(md['<abcdef@example.com>']['Message-Id'],
+                         '<abcdef@example.com>')
+
+    def test_drainInbox_w_headers_only_w_batch_size_resumes_interrupted(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        keys = sorted(root.iterkeys())
+        self._linkAsInterrupted(md, root, keys[0], MESSAGE_IDS[0])
+
+        list(md.drainInbox(batch_size=2, headers_only=True))
+
+        self.assertEqual(len(root), 0)
+        for message_id in MESSAGE_IDS:
+            self.assertEqual(md[message_id]['Message-Id'], message_id)
+
+    def test_drainInbox_w_headers_only_w_batch_size(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+        keys = sorted(root.iterkeys())
+
+        drained = list(md.drainInbox(batch_size=2, headers_only=True))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(root), 0)
+        self.assertEqual(sorted([row[0] for row in md.sql.execute(
+                            'select maildir_key from messages')]), keys)
+
+    def test_drainInbox_w_headers_only_dry_run(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        drained = list(md.drainInbox(dry_run=True, headers_only=True))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(list(md.iterkeys())), 0)
+        self.assertEqual(len(root), len(MESSAGE_IDS))
+
+    def test_drainInbox_w_headers_only_w_claim(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        self._populateInbox(MESSAGE_IDS)
+
+        md = self._makeOne()
+        root = md._getMaildir()
+
+        drained = list(md.drainInbox(claim='worker-0', headers_only=True))
+
+        self.assertEqual(drained, MESSAGE_IDS)
+        self.assertEqual(len(root), 0)
+        self.assertEqual(len(md._getClaimMaildir('worker-0')), 0)
+        self.assertEqual(md[MESSAGE_IDS[1]]['Message-Id'], MESSAGE_IDS[1])
+
+    def test__loadMessage_w_headers_only(self):
+        self._populateInbox(['<abcdef@example.com>'])
+        md = self._makeOne()
+        root = md._getMaildir()
+        key, = root.keys()
+        headers = md._loadMessage(root, key, True)
+        self.assertEqual(headers['Message-Id'], '<abcdef@example.com>')
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.failIf(headers.get_payload())
+
 
 class DummyPQ:
     def __init__(self):
@@ -323,3 +1212,25 @@ class DummyPQ:
 
     def push(self, message_id):
         self._pushed.append(message_id)
+
+class DummyPQManyPushes(DummyPQ):
+    def push_many(self, message_ids):
+        self._pushed.append(list(message_ids))
+
+class DummyMetrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def flush(self):
+        pass
@@ -0,0 +1,190 @@
+import unittest
+
+class NullMetricsTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.metrics import NullMetrics
+        return NullMetrics
+
+    def test_class_conforms_to_IMetrics(self):
+        from zope.interface.verify import verifyClass
+        from repoze.mailin.interfaces import IMetrics
+        verifyClass(IMetrics, self._getTargetClass())
+
+    def test_discards(self):
+        metrics = self._getTargetClass()()
+        metrics.increment('a')
+        metrics.gauge('b', 1)
+        metrics.timing('c', 0.5)
+        metrics.flush()
+
+class PrometheusTextfileMetricsTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getTargetClass(self):
+        from repoze.mailin.metrics import PrometheusTextfileMetrics
+        return PrometheusTextfileMetrics
+
+    def _makeOne(self, **kw):
+        import os
+        import tempfile
+        self._tempdir = tempfile.mkdtemp()
+        path = os.path.join(self._tempdir, 'mailin.prom')
+        kw.setdefault('interval', 3600)
+        return self._getTargetClass()(path, **kw)
+
+    def test_class_conforms_to_IMetrics(self):
+        from zope.interface.verify import verifyClass
+        from repoze.mailin.interfaces import IMetrics
+        verifyClass(IMetrics, self._getTargetClass())
+
+    def test_render_empty(self):
+        metrics = self._makeOne()
+        self.assertEqual(metrics.render(), '\n')
+
+    def test_render_counter_and_gauge(self):
+        metrics = self._makeOne()
+        metrics.increment('store.stored')
+        metrics.increment('store.stored', 2)
+        metrics.gauge('queue.depth', 5)
+        metrics.gauge('queue.depth', 4)
+        self.assertEqual(metrics.render().splitlines(),
+                         ['# TYPE mailin_store_stored_total counter',
+                          'mailin_store_stored_total 3',
+                          '# TYPE mailin_queue_depth gauge',
+                          'mailin_queue_depth 4',
+                         ])
+
+    def test_render_timer(self):
+        metrics = self._makeOne(buckets=(0.1, 1.0))
+        metrics.timing('imap.fetch', 0.05)
+        metrics.timing('imap.fetch', 0.5)
+        metrics.timing('imap.fetch', 2.0)
+        self.assertEqual(metrics.render().splitlines(),
+                         ['# TYPE mailin_imap_fetch_seconds histogram',
+                          'mailin_imap_fetch_seconds_bucket{le="0.1"} 1',
+                          'mailin_imap_fetch_seconds_bucket{le="1.0"} 2',
+                          'mailin_imap_fetch_seconds_bucket{le="+Inf"} 3',
+                          'mailin_imap_fetch_seconds_sum 2.55',
+                          'mailin_imap_fetch_seconds_count 3',
+                         ])
+
+    def test_render_w_labels(self):
+        metrics = self._makeOne(buckets=(1.0,), labels={'worker': 'w-0'})
+        metrics.increment('draino.drained')
+        metrics.timing('draino.drain', 0.5)
+        lines = metrics.render().splitlines()
+        self.failUnless('mailin_draino_drained_total{worker="w-0"} 1'
+                            in lines)
+        self.failUnless('mailin_draino_drain_seconds_bucket'
+                        '{worker="w-0",le="1.0"} 1' in lines)
+        self.failUnless('mailin_draino_drain_seconds_count{worker="w-0"} 1'
+                            in lines)
+
+    def test_flush_writes_file(self):
+        import os
+        metrics = self._makeOne()
+        metrics.increment('a')
+        self.failIf(os.path.exists(metrics.path))
+        metrics.flush()
+        self.assertEqual(open(metrics.path).read(), metrics.render())
+        self.assertEqual(os.listdir(self._tempdir), ['mailin.prom'])
+
+    def test_flushes_after_interval(self):
+        import os
+        metrics = self._makeOne(interval=0)
+        metrics.increment('a')
+        self.failUnless(os.path.exists(metrics.path))
+
+class StatsDMetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        import socket
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+
+    def tearDown(self):
+        self.server.close()
+
+    def _getTargetClass(self):
+        from repoze.mailin.metrics import StatsDMetrics
+        return StatsDMetrics
+
+    def _makeOne(self, **kw):
+        host, port = self.server.getsockname()
+        return self._getTargetClass()(host, port, **kw)
+
+    def _received(self):
+        return self.server.recv(1024)
+
+    def test_class_conforms_to_IMetrics(self):
+        from zope.interface.verify import verifyClass
+        from repoze.mailin.interfaces import IMetrics
+        verifyClass(IMetrics, self._getTargetClass())
+
+    def test_increment(self):
+        metrics = self._makeOne()
+        metrics.increment('store.stored')
+        self.assertEqual(self._received(), 'mailin.store.stored:1|c')
+        metrics.increment('store.stored', 3)
+        self.assertEqual(self._received(), 'mailin.store.stored:3|c')
+
+    def test_gauge(self):
+        metrics = self._makeOne(prefix='')
+        metrics.gauge('queue.depth', 7)
+        self.assertEqual(self._received(), 'queue.depth:7|g')
+
+    def test_timing_in_milliseconds(self):
+        metrics = self._makeOne()
+        metrics.timing('imap.fetch', 0.25)
+        self.assertEqual(self._received(), 'mailin.imap.fetch:250.000|ms')
+
+    def test_send_errors_ignored(self):
+        import socket
+        metrics = self._makeOne()
+        metrics.socket.close()
+        metrics.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        metrics.address = ('255.255.255.255', 8125) # broadcast:  refused
+        metrics.increment('a')
+
+class MakeMetricsTests(unittest.TestCase):
+
+    def _callFUT(self, spec, worker=None):
+        from repoze.mailin.metrics import makeMetrics
+        return makeMetrics(spec, worker)
+
+    def test_statsd(self):
+        from repoze.mailin.metrics import StatsDMetrics
+        metrics = self._callFUT('statsd:localhost:9125')
+        self.failUnless(isinstance(metrics, StatsDMetrics))
+        self.assertEqual(metrics.address, ('localhost', 9125))
+
+    def test_statsd_defaults(self):
+        metrics = self._callFUT('statsd:')
+        self.assertEqual(metrics.address, ('127.0.0.1', 8125))
+
+    def test_statsd_bad_port(self):
+        self.assertRaises(ValueError, self._callFUT, 'statsd:localhost:x')
+
+    def test_textfile(self):
+        from repoze.mailin.metrics import PrometheusTextfileMetrics
+        metrics = self._callFUT('textfile:/var/lib/prom/mailin.prom')
+        self.failUnless(isinstance(metrics, PrometheusTextfileMetrics))
+        self.assertEqual(metrics.path, '/var/lib/prom/mailin.prom')
+        self.assertEqual(metrics.labels, [])
+
+    def test_textfile_w_worker(self):
+        metrics = self._callFUT('textfile:/var/lib/prom/mailin.prom', 'w-1')
+        self.assertEqual(metrics.path, '/var/lib/prom/mailin-w-1.prom')
+        self.assertEqual(metrics.labels, [('worker', 'w-1')])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._callFUT, 'nonesuch')
+        self.assertRaises(ValueError, self._callFUT, 'textfile:')
@@ -55,6 +55,12 @@ class PendingQueueTests(unittest.TestCase):
         self.assertEqual(pq.path, tempdir)
         self.failUnless(os.path.isfile(os.path.join(tempdir, 'pending.db')))
 
+    def test_ctor_creates_quarantined_index(self):
+        pq = self._makeOne()
+        self.failUnless(pq.sql.execute(
+                      'select * from sqlite_master where type = "index" '
+                      'and name = "pending_quarantined"').fetchall())
+
     def test_ctor_w_isolation_level(self):
         pq = self._makeOne(isolation_level='DEFERRED')
         self.assertEqual(pq.sql.isolation_level, 'DEFERRED')
@@ -78,6 +84,101 @@ class PendingQueueTests(unittest.TestCase):
         pq = self._makeOne()
         self.failIf(pq)
 
+    def test___len___empty(self):
+        pq = self._makeOne()
+        self.assertEqual(len(pq), 0)
+
+    def test___len___tracks_push_pop_remove(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeOne()
+        for message_id in MESSAGE_IDS:
+            pq.push(message_id)
+        self.assertEqual(len(pq), 3)
+        pq.pop()
+        self.assertEqual(len(pq), 2)
+        pq.remove(MESSAGE_IDS[2])
+        self.assertEqual(len(pq), 1)
+
+    def test___len___excludes_quarantined_and_claimed(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeOne()
+        for message_id in MESSAGE_IDS:
+            pq.push(message_id)
+        pq.quarantine(MESSAGE_IDS[0])
+        pq.quarantine(MESSAGE_IDS[0])
+        pq.quarantine('<other@example.com>')
+        self.assertEqual(len(pq), 2)
+        pq.claim()
+        self.assertEqual(len(pq), 1)
+        pq.clear_quarantine()
+        self.assertEqual(len(pq), 3)
+        pq.ack(MESSAGE_IDS[1])
+        self.assertEqual(len(pq), 3)
+
+    def test___len___agrees_with___nonzero__(self):
+        pq = self._makeOne()
+        pq.push('<abcdef@example.com>')
+        pq.claim()
+        self.assertEqual(len(pq), 0)
+        self.failIf(pq)
+        pq.nack('<abcdef@example.com>')
+        self.assertEqual(len(pq), 1)
+        self.failUnless(pq)
+
+    def test___len___counts_expired_leases(self):
+        pq = self._makeOne()
+        pq.push('<abcdef@example.com>')
+        pq.claim(lease_seconds=-1)
+        self.assertEqual(len(pq), 1)
+        self.failUnless(pq)
+
+    def test_depth_includes_claimed(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeOne()
+        for message_id in MESSAGE_IDS:
+            pq.push(message_id)
+        pq.quarantine(MESSAGE_IDS[0])
+        self.assertEqual(pq.depth(), 2)
+        pq.claim()
+        self.assertEqual(pq.depth(), 2)
+        pq.ack(MESSAGE_IDS[1])
+        self.assertEqual(pq.depth(), 1)
+        pq.clear_quarantine()
+        self.assertEqual(pq.depth(), 2)
+
+    def test___len___migrated_database(self):
+        import os
+        import sqlite3
+        import tempfile
+        tempdir = self._tempdir = tempfile.mkdtemp()
+        sql = sqlite3.connect(os.path.join(tempdir, 'pending.db'))
+        sql.execute('create table pending'
+                    '( id integer primary key'
+                    ', message_id varchar(1024) unique'
+                    ', quarantined boolean'
+                    ', error_msg'
+                    ')')
+        sql.executemany('insert into pending(message_id, quarantined) '
+                        'values(?, ?)', [('<a@example.com>', False),
+                                         ('<b@example.com>', True),
+                                         ('<c@example.com>', False),
+                                        ])
+        sql.commit()
+        sql.close()
+        pq = self._makeOne(tempdir, None)
+        self.assertEqual(len(pq), 2)
+        self.assertEqual(pq.pop(None), ['<a@example.com>', '<c@example.com>'])
+        self.assertEqual(len(pq), 0)
+
     def test___iter___empty(self):
         pq = self._makeOne()
         self.failIf(list(pq))
@@ -144,6 +245,37 @@ class PendingQueueTests(unittest.TestCase):
         self.assertEqual(len(found), 1)
         self.assertEqual(found[0], MESSAGE_ID)
 
+    def test_metrics(self):
+        metrics = DummyMetrics()
+        pq = self._getTargetClass()(dbfile=':memory:', metrics=metrics)
+        pq.push('a')
+        pq.push('b')
+        pq.push('c')
+        self.assertEqual(pq.claim(2), ['a', 'b'])
+        pq.ack('a')
+        pq.nack('b')
+        pq.quarantine('b', 'bad')
+        self.assertEqual(pq.pop(2), ['c'])
+        self.assertEqual(metrics.counters,
+                         {'queue.pushed': 3,
+                          'queue.claimed': 2,
+                          'queue.acked': 1,
+                          'queue.nacked': 1,
+                          'queue.quarantined': 1,
+                          'queue.popped': 1,
+                          'queue.underflow': 1,
+                         })
+        self.assertEqual(len(metrics.timings['queue.push']), 3)
+        self.assertEqual(len(metrics.timings['queue.claim']), 1)
+        self.assertEqual(len(metrics.timings['queue.pop']), 1)
+
+    def test_push_then_remove_w_quotes(self):
+        MESSAGE_ID ='<"quoted"@example.com>'
+        pq = self._makeOne()
+        pq.push(MESSAGE_ID)
+        pq.remove(MESSAGE_ID)
+        self.failIf(pq)
+
     def test_push_then_remove(self):
         MESSAGE_ID ='<defghi@example.com>'
         pq = self._makeOne()
@@ -185,6 +317,193 @@ class PendingQueueTests(unittest.TestCase):
         self.assertEqual(logger._logged[0],
                          (('Queue underflow: requested 5, popped 3',), {}))
 
+    def test_pop_w_isolation_level(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeOne(isolation_level='DEFERRED')
+        for message_id in MESSAGE_IDS:
+            pq.push(message_id)
+        self.assertEqual(pq.pop(2), MESSAGE_IDS[:2])
+        pq.sql.commit()
+        self.assertEqual(pq.pop(None), MESSAGE_IDS[2:])
+
+    def test_pop_wo_returning(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                       '<jklmno@example.com>',
+                      ]
+        logger = DummyLogger()
+        pq = self._makeOne(logger=logger)
+        pq._returning = False
+        for message_id in MESSAGE_IDS:
+            pq.push(message_id)
+        pq.quarantine(MESSAGE_IDS[1])
+        self.assertEqual(pq.pop(2), [MESSAGE_IDS[0], MESSAGE_IDS[2]])
+        self.assertEqual(pq.pop(None), MESSAGE_IDS[3:])
+        self.assertEqual(pq.pop(), [])
+        self.assertEqual(logger._logged,
+                         [(('Queue underflow: requested 1, popped 0',), {})])
+        self.assertEqual(list(pq.iter_quarantine()), MESSAGE_IDS[1:2])
+
+    def test_pop_wo_returning_w_isolation_level(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        pq = self._makeOne(isolation_level='DEFERRED')
+        pq._returning = False
+        for message_id in MESSAGE_IDS:
+            pq.push(message_id)
+        self.assertEqual(pq.pop(), MESSAGE_IDS[:1])
+        pq.sql.commit()
+        self.assertEqual(pq.pop(5), MESSAGE_IDS[1:])
+
+    def test_pop_wo_returning_failure_rolls_back(self):
+        import sqlite3
+        MESSAGE_ID ='<defghi@example.com>'
+        pq = self._makeOne()
+        pq._returning = False
+        pq.push(MESSAGE_ID)
+        pq.sql.execute('create trigger no_delete before delete on pending '
+                       'begin select raise(abort, "nope"); end')
+        self.assertRaises(sqlite3.IntegrityError, pq.pop)
+        self.assertEqual([row[1] for row in pq], [MESSAGE_ID])
+
+    def test_pop_concurrent_consumers_dont_overlap(self):
+        import tempfile
+        tempdir = self._tempdir = tempfile.mkdtemp()
+        first = self._makeOne(tempdir, None)
+        second = self._makeOne(tempdir, None)
+        message_ids = ['<%03d@example.com>' % i for i in range(100)]
+        for message_id in message_ids:
+            first.push(message_id)
+        popped = []
+        while first or second:
+            popped.extend(first.pop(7))
+            popped.extend(second.pop(11))
+        self.assertEqual(sorted(popped), message_ids)
+
+    def _makeFilled(self, message_ids, **kw):
+        pq = self._makeOne(**kw)
+        for message_id in message_ids:
+            pq.push(message_id)
+        return pq
+
+    def test_claim_empty(self):
+        pq = self._makeOne()
+        self.assertEqual(pq.claim(), [])
+
+    def test_claim_leases_in_order(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        self.assertEqual(pq.claim(2), MESSAGE_IDS[:2])
+        self.assertEqual(pq.claim(2), MESSAGE_IDS[2:])
+        self.assertEqual(pq.claim(2), [])
+        self.failIf(pq)
+        self.assertEqual(list(pq), [])
+        for message_id in MESSAGE_IDS:
+            self.failUnless(message_id in pq)
+
+    def test_claim_w_None(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        self.assertEqual(pq.claim(None), MESSAGE_IDS)
+
+    def test_claim_skips_quarantined(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        pq.quarantine(MESSAGE_IDS[0])
+        self.assertEqual(pq.claim(5), MESSAGE_IDS[1:])
+
+    def test_pop_skips_claimed(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        pq.claim()
+        self.assertEqual(pq.pop(None), MESSAGE_IDS[1:])
+        self.failUnless(MESSAGE_IDS[0] in pq)
+
+    def test_claim_expired_lease_returns_to_queue(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        self.assertEqual(pq.claim(lease_seconds=-1), MESSAGE_IDS[:1])
+        self.failUnless(pq)
+        self.assertEqual(pq.claim(2), MESSAGE_IDS)
+
+    def test_ack(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        claimed, = pq.claim()
+        pq.ack(claimed)
+        self.failIf(claimed in pq)
+        self.assertEqual(pq.pop(None), MESSAGE_IDS[1:])
+
+    def test_ack_nonesuch_raises_KeyError(self):
+        pq = self._makeOne()
+        self.assertRaises(KeyError, pq.ack, 'nonesuch')
+
+    def test_nack(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        claimed, = pq.claim()
+        pq.nack(claimed)
+        self.assertEqual(pq.claim(None), MESSAGE_IDS)
+
+    def test_nack_nonesuch_raises_KeyError(self):
+        pq = self._makeOne()
+        self.assertRaises(KeyError, pq.nack, 'nonesuch')
+
+    def test_quarantine_claimed_then_clear(self):
+        MESSAGE_ID = '<abcdef@example.com>'
+        pq = self._makeFilled([MESSAGE_ID])
+        pq.claim()
+        pq.quarantine(MESSAGE_ID, 'Error message')
+        self.assertEqual(list(pq.iter_quarantine()), [MESSAGE_ID])
+        pq.clear_quarantine()
+        self.assertEqual(pq.claim(), [MESSAGE_ID])
+
+    def test_claim_wo_returning(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        pq = self._makeFilled(MESSAGE_IDS)
+        pq._returning = False
+        self.assertEqual(pq.claim(2), MESSAGE_IDS[:2])
+        self.assertEqual(pq.pop(None), MESSAGE_IDS[2:])
+        self.assertEqual(pq.claim(), [])
+
+    def test_claim_concurrent_consumers_dont_overlap(self):
+        import tempfile
+        tempdir = self._tempdir = tempfile.mkdtemp()
+        first = self._makeOne(tempdir, None)
+        second = self._makeOne(tempdir, None)
+        message_ids = ['<%03d@example.com>' % i for i in range(100)]
+        for message_id in message_ids:
+            first.push(message_id)
+        claimed = []
+        while first or second:
+            claimed.extend(first.claim(7))
+            claimed.extend(second.claim(11))
+        self.assertEqual(sorted(claimed), message_ids)
+
     def test_pop_nonunicode_message_id(self):
         # Message-Id is actual message id encountered in field,
         # which caused mail-in to break.
@@ -314,6 +633,130 @@ class PendingQueueTests(unittest.TestCase):
         self.assertEqual(found[0], '<abcdef@example.com>')
         self.assertEqual(found[1], '<ghijkl@example.com>')
 
+    def test_ctor_w_pragmas(self):
+        import tempfile
+        tempdir = self._tempdir = tempfile.mkdtemp()
+        pq = self._getTargetClass()(tempdir, journal_mode='wal',
+                                    synchronous='normal')
+        self.assertEqual(pq.sql.execute('pragma journal_mode').fetchone()[0],
+                         'wal')
+        self.assertEqual(pq.sql.execute('pragma synchronous').fetchone()[0],
+                         1)
+
+    def test_ctor_w_profile(self):
+        import tempfile
+        tempdir = self._tempdir = tempfile.mkdtemp()
+        pq = self._getTargetClass()(tempdir, profile='wal',
+                                    synchronous='full')
+        self.assertEqual(pq.sql.execute('pragma journal_mode').fetchone()[0],
+                         'wal')
+        self.assertEqual(pq.sql.execute('pragma synchronous').fetchone()[0],
+                         2)
+
+    def test_ctor_w_unknown_profile(self):
+        self.assertRaises(ValueError, self._getTargetClass(),
+                          dbfile=':memory:', profile='nonesuch')
+
+    def test_ctor_w_invalid_pragma(self):
+        self.assertRaises(ValueError, self._getTargetClass(),
+                          dbfile=':memory:', synchronous='sometimes')
+
+    def test_push_many(self):
+        MESSAGE_IDS = ['<abcdef@example.com>',
+                       '<defghi@example.com>',
+                       '<ghijkl@example.com>',
+                      ]
+        metrics = DummyMetrics()
+        pq = self._getTargetClass()(dbfile=':memory:', metrics=metrics)
+        pq.push_many(iter(MESSAGE_IDS))
+        pq.push_many([])
+        self.assertEqual(pq.pop(None), MESSAGE_IDS)
+        self.assertEqual(metrics.counters['queue.pushed'], 3)
+        self.assertEqual(len(metrics.timings['queue.push']), 1)
+
+    def test_push_many_duplicate_rolls_back(self):
+        import sqlite3
+        pq = self._makeOne()
+        pq.push('<abcdef@example.com>')
+        self.assertRaises(sqlite3.IntegrityError, pq.push_many,
+                          ['<defghi@example.com>', '<abcdef@example.com>'])
+        self.assertEqual(pq.pop(None), ['<abcdef@example.com>'])
+
+    def test_push_many_w_isolation_level(self):
+        pq = self._makeOne(isolation_level='DEFERRED')
+        pq.push_many(['<abcdef@example.com>', '<defghi@example.com>'])
+        pq.sql.rollback()
+        self.assertEqual(len(pq), 0)
+
+    def test_push_buffered_by_size(self):
+        pq = self._getTargetClass()(dbfile=':memory:', group_commit_size=2)
+        pq.push('<abcdef@example.com>')
+        self.assertEqual(pq._buffer, ['<abcdef@example.com>'])
+        self.assertEqual(pq.sql.execute('select count(*) from pending'
+                                       ).fetchone()[0], 0)
+        pq.push('<defghi@example.com>')
+        self.assertEqual(pq._buffer, [])
+        self.assertEqual(pq.sql.execute('select count(*) from pending'
+                                       ).fetchone()[0], 2)
+
+    def test_push_buffered_by_ms(self):
+        pq = self._getTargetClass()(dbfile=':memory:', group_commit_ms=1000)
+        pq.push('<abcdef@example.com>')
+        pq.push('<defghi@example.com>')
+        self.assertEqual(len(pq._buffer), 2)
+        pq._buffered_at -= 1 # a second ago
+        pq.push('<ghijkl@example.com>')
+        self.assertEqual(pq._buffer, [])
+        self.assertEqual(pq.sql.execute('select count(*) from pending'
+                                       ).fetchone()[0], 3)
+
+    def test_reads_flush_buffer(self):
+        pq = self._getTargetClass()(dbfile=':memory:', group_commit_size=100)
+        pq.push('<abcdef@example.com>')
+        self.failUnless('<abcdef@example.com>' in pq)
+        pq.push('<defghi@example.com>')
+        self.assertEqual(len(pq), 2)
+        pq.push('<ghijkl@example.com>')
+        self.assertEqual(pq.pop(None), ['<abcdef@example.com>',
+                                        '<defghi@example.com>',
+                                        '<ghijkl@example.com>',
+                                       ])
+
+    def test_flush_skips_duplicates(self):
+        metrics = DummyMetrics()
+        pq = self._getTargetClass()(dbfile=':memory:', metrics=metrics,
+                                    group_commit_size=100)
+        pq.push_many(['<abcdef@example.com>'])
+        pq.push('<defghi@example.com>')
+        pq.push('<abcdef@example.com>')
+        pq.push('<ghijkl@example.com>')
+        pq.flush()
+        self.assertEqual(pq._buffer, [])
+        self.assertEqual(pq.pop(None), ['<abcdef@example.com>',
+                                        '<defghi@example.com>',
+                                        '<ghijkl@example.com>',
+                                       ])
+        self.assertEqual(metrics.counters['queue.duplicates'], 1)
+
+    def test_flush_failure_keeps_buffer(self):
+        import sqlite3
+        pq = self._getTargetClass()(dbfile=':memory:', group_commit_size=100)
+        pq.push('<abcdef@example.com>')
+        pq.sql.execute('drop table pending')
+        self.assertRaises(sqlite3.OperationalError, pq.flush)
+        self.assertEqual(pq._buffer, ['<abcdef@example.com>'])
+        pq._buffer = []
+
+    def test_flush_on_evict(self):
+        import os
+        import tempfile
+        tempdir = self._tempdir = tempfile.mkdtemp()
+        pq = self._getTargetClass()(tempdir, group_commit_size=100)
+        pq.push('<abcdef@example.com>')
+        pq = None
+        pq = self._getTargetClass()(tempdir)
+        self.assertEqual(pq.pop(None), ['<abcdef@example.com>'])
+
 class DummySql(object):
     closed = False
 
@@ -326,3 +769,21 @@ class DummyLogger:
 
     def log(self, *args, **kw):
         self._logged.append((args, kw))
+
+class DummyMetrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def flush(self):
+        pass
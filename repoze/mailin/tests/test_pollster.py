@@ -0,0 +1,804 @@
+import unittest
+
+class _Base:
+
+    _tempdir = None
+    _server = None
+
+    def tearDown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getTempdir(self):
+        import tempfile
+        if self._tempdir is None:
+            self._tempdir = tempfile.mkdtemp()
+        return self._tempdir
+
+    def _makeMessageText(self, message_id, body='Body text here.'):
+        lines = ['Date: Thu, 01 Oct 2009 10:00:00 -0000',
+                 'Message-Id: %s' % message_id,
+                 'Content-Type: text/plain',
+                 '',
+                 body,
+                ]
+        return '\r\n'.join(lines)
+
+    def _makeMailbox(self, message_ids=(), uidvalidity=1):
+        from repoze.mailin.benchmarks.fakeimap import FakeMailbox
+        mailbox = FakeMailbox(uidvalidity)
+        for message_id in message_ids:
+            mailbox.append(self._makeMessageText(message_id))
+        return mailbox
+
+    def _startServer(self, mailboxes, idle=False, use_ssl=False):
+        import os
+        from repoze.mailin.benchmarks.fakeimap import FakeIMAPServer
+        certfile = None
+        if use_ssl:
+            certfile = os.path.join(os.path.dirname(__file__),
+                                    'fakeimap.pem')
+        server = self._server = FakeIMAPServer(mailboxes, idle, certfile)
+        server.start()
+        return server
+
+    def _openStores(self):
+        from repoze.mailin.maildir import MaildirStore
+        from repoze.mailin.pending import PendingQueue
+        return (MaildirStore(self._getTempdir()),
+                PendingQueue(self._getTempdir()))
+
+class MessageSinkTests(_Base, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.pollster import MessageSink
+        return MessageSink
+
+    def _makeOne(self, dry_run=False):
+        md, pq = self._openStores()
+        return self._getTargetClass()(md, pq, dry_run, 0, DummyMetrics())
+
+    def _makeMessage(self, message_id):
+        from email import message_from_string
+        return message_from_string(self._makeMessageText(message_id))
+
+    def test_store(self):
+        sink = self._makeOne()
+        sink.store('<abc@example.com>', self._makeMessage('<abc@example.com>'))
+        self.assertEqual(sink.md['<abc@example.com>']['Message-Id'],
+                         '<abc@example.com>')
+        self.assertEqual(sink.pq.pop(None), ['<abc@example.com>'])
+        self.assertEqual(sink.metrics.counters, {'pollster.stored': 1})
+
+    def test_store_dry_run(self):
+        sink = self._makeOne(dry_run=True)
+        sink.store('<abc@example.com>', self._makeMessage('<abc@example.com>'))
+        self.assertEqual(list(sink.md.iterkeys()), [])
+        self.assertEqual(len(sink.pq), 0)
+
+    def test_store_duplicate_skipped(self):
+        sink = self._makeOne()
+        sink.store('<abc@example.com>', self._makeMessage('<abc@example.com>'))
+        sink.pq.pop()
+        sink.store('<abc@example.com>', self._makeMessage('<abc@example.com>'))
+        self.assertEqual(len(sink.pq), 0)
+        self.assertEqual(sink.metrics.counters,
+                         {'pollster.stored': 1, 'pollster.duplicates': 1})
+
+    def test_store_file_duplicate_removes_file(self):
+        import os
+        from repoze.mailin.maildir import _readHeaders
+        sink = self._makeOne()
+        sink.store('<abc@example.com>', self._makeMessage('<abc@example.com>'))
+        path = os.path.join(sink.tmpdir(), 'streamed')
+        f = open(path, 'wb')
+        f.write(self._makeMessageText('<abc@example.com>'))
+        f.close()
+        sink.store('<abc@example.com>', _readHeaders(path), path)
+        self.failIf(os.path.exists(path))
+        self.assertEqual(sink.metrics.counters['pollster.duplicates'], 1)
+
+    def test_store_bad_date_set_aside(self):
+        import os
+        from email import message_from_string
+        sink = self._makeOne()
+        message = message_from_string('Date: garbage\r\n'
+                                      'Message-Id: <abc@example.com>\r\n'
+                                      '\r\nBody text here.')
+        sink.store('<abc@example.com>', message)
+        self.assertEqual(list(sink.md.iterkeys()), [])
+        self.assertEqual(len(sink.pq), 0)
+        failed = os.path.join(self._getTempdir(), 'Maildir', 'failed', 'new')
+        self.assertEqual(len(os.listdir(failed)), 1)
+        self.assertEqual(sink.metrics.counters, {'pollster.failed': 1})
+
+    def test_store_file_bad_date_set_aside(self):
+        import os
+        from repoze.mailin.maildir import _readHeaders
+        sink = self._makeOne()
+        path = os.path.join(sink.tmpdir(), 'streamed')
+        f = open(path, 'wb')
+        f.write('Message-Id: <abc@example.com>\r\n\r\nBody text here.')
+        f.close()
+        sink.store('<abc@example.com>', _readHeaders(path), path)
+        self.failIf(os.path.exists(path))
+        failed = os.path.join(self._getTempdir(), 'Maildir', 'failed', 'new')
+        name, = os.listdir(failed)
+        f = open(os.path.join(failed, name), 'rb')
+        try:
+            self.failUnless(f.read().endswith('Body text here.'))
+        finally:
+            f.close()
+        self.assertEqual(sink.metrics.counters, {'pollster.failed': 1})
+
+class PollsterConfigTests(_Base, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.pollster import Pollster
+        return Pollster
+
+    def _writeConfig(self, text):
+        import os
+        path = os.path.join(self._getTempdir(), 'pollster.ini')
+        f = open(path, 'w')
+        f.write(text)
+        f.close()
+        return path
+
+    def _makeOne(self, *args):
+        return self._getTargetClass()(['pollster', '--quiet'] + list(args))
+
+    def test_readConfig_password_w_percent(self):
+        config = self._writeConfig('[phred]\n'
+                                   'host = imap.example.com:993\n'
+                                   'credentials = phred:100%secret\n'
+                                   'mailbox = Archive\n')
+        pollster = self._makeOne('--config', config, self._getTempdir())
+        account, = pollster.accounts
+        self.assertEqual(account.password, '100%secret')
+        self.assertEqual(account.mailbox, 'Archive')
+        self.assertEqual(account.use_ssl, True)
+
+    def test_duplicate_across_accounts(self):
+        import os
+        server = self._startServer({
+            'INBOX': self._makeMailbox(['<abc@example.com>',
+                                        '<def@example.com>']),
+            'Other': self._makeMailbox(['<abc@example.com>',
+                                        '<ghi@example.com>']),
+            })
+        config = self._writeConfig('[one]\n'
+                                   'host = 127.0.0.1:%d\n'
+                                   'credentials = one:secret\n'
+                                   '[two]\n'
+                                   'host = 127.0.0.1:%d\n'
+                                   'credentials = two:secret\n'
+                                   'mailbox = Other\n'
+                                       % (server.port, server.port))
+        tempdir = self._getTempdir()
+        pollster = self._makeOne('--config', config,
+                                 '--pending-queue', tempdir, tempdir)
+
+        self.failUnless(pollster.do_poll())
+
+        for mailbox in server.mailboxes.values():
+            self.assertEqual(mailbox.messages, [])
+        md, pq = self._openStores()
+        self.assertEqual(sorted(md.iterkeys()), ['<abc@example.com>',
+                                                 '<def@example.com>',
+                                                 '<ghi@example.com>',
+                                                ])
+        self.assertEqual(sorted(pq.pop(None)), sorted(md.iterkeys()))
+        state = pollster.open_state()
+        for account in pollster.accounts:
+            self.assertEqual(state.getLastUID(account.state_key, 1), 2)
+
+    def test_negative_chunk_size(self):
+        import sys
+        from StringIO import StringIO
+        _saved, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.assertRaises(SystemExit, self._makeOne,
+                              '--chunk-size', '-1', self._getTempdir(),
+                              'imap.example.com', 'phred:secret')
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = _saved
+        self.failUnless('Chunk size must not be negative' in printed)
+
+    def test_do_poll_w_failing_account(self):
+        server = self._startServer({
+            'INBOX': self._makeMailbox(['<abc@example.com>']),
+            })
+        config = self._writeConfig('[one]\n'
+                                   'host = 127.0.0.1:%d\n'
+                                   'credentials = one:secret\n'
+                                   '[two]\n'
+                                   'host = 127.0.0.1:%d\n'
+                                   'credentials = two:secret\n'
+                                   'mailbox = Nonesuch\n'
+                                       % (server.port, server.port))
+        tempdir = self._getTempdir()
+        pollster = self._makeOne('--config', config, tempdir)
+        pollster.metrics = DummyMetrics()
+
+        import sys
+        from StringIO import StringIO
+        _saved, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.failIf(pollster.do_poll())
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = _saved
+        self.failUnless(printed.startswith('two@127.0.0.1'))
+        self.failUnless('NONEXISTENT' in printed)
+
+        self.assertEqual(server.mailboxes['INBOX'].messages, [])
+        md, pq = self._openStores()
+        self.assertEqual(list(md.iterkeys()), ['<abc@example.com>'])
+        self.assertEqual(pollster.metrics.counters['pollster.errors'], 1)
+
+
+class RelaySinkTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.pollster import RelaySink
+        return RelaySink
+
+    def _makeOne(self):
+        import Queue
+        return self._getTargetClass()(Queue.Queue())
+
+    def _serveFrom(self, relay, sink, *calls):
+        # Make 'calls' on 'relay' from another thread, served by this one;
+        # return the results, or the exceptions raised.
+        import threading
+        results = []
+        def worker():
+            try:
+                for name, args in calls:
+                    try:
+                        results.append(getattr(relay, name)(*args))
+                    except Exception, e:
+                        results.append(e)
+            finally:
+                relay.requests.put(None)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        relay.serve(sink, 1)
+        thread.join()
+        return results
+
+    def test_relays_calls(self):
+        relay = self._makeOne()
+        sink = DummySink()
+        results = self._serveFrom(relay, sink,
+                                  ('store', ('<abc@example.com>', 'M')),
+                                  ('known', (['<abc@example.com>'],)),
+                                  ('tmpdir', ()),
+                                  ('flush', ()),
+                                  ('report', ()),
+                                 )
+        self.assertEqual(results,
+                         [None, set(['<abc@example.com>']), '/tmp', None,
+                          None])
+        self.assertEqual(sink._calls,
+                         [('store', '<abc@example.com>', 'M', None),
+                          ('known', ['<abc@example.com>']),
+                          ('flush',), ('report',)])
+
+    def test_relays_exceptions(self):
+        relay = self._makeOne()
+        sink = DummySink(ValueError('nope'))
+        error, known = self._serveFrom(relay, sink,
+                                       ('store', ('<abc@example.com>', 'M')),
+                                       ('known', ([],)),
+                                      )
+        self.failUnless(isinstance(error, ValueError))
+        self.assertEqual(known, set())
+
+
+class PollsterPollTests(_Base, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.pollster import Pollster
+        return Pollster
+
+    def _makeOne(self, server, *args):
+        tempdir = self._getTempdir()
+        argv = (['pollster', '--quiet', '--pending-queue', tempdir]
+                + list(args)
+                + [tempdir, '127.0.0.1:%d' % server.port, 'phred:secret'])
+        pollster = self._getTargetClass()(argv)
+        pollster.metrics = DummyMetrics()
+        return pollster
+
+    def _recordDeletes(self, pollster):
+        deleted = []
+        _delete = pollster.delete_messages
+        def delete_messages(conn, uids):
+            deleted.append(list(uids))
+            _delete(conn, uids)
+        pollster.delete_messages = delete_messages
+        return deleted
+
+    def test_do_poll_chunked_fetch_and_delete(self):
+        MESSAGE_IDS = ['<%d@example.com>' % i for i in range(5)]
+        mailbox = self._makeMailbox(MESSAGE_IDS)
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server, '--chunk-size', '2')
+        deleted = self._recordDeletes(pollster)
+
+        self.failUnless(pollster.do_poll())
+
+        self.assertEqual(deleted, [[1, 2], [3, 4], [5]])
+        self.assertEqual(mailbox.messages, [])
+        md, pq = self._openStores()
+        self.assertEqual(sorted(md.iterkeys()), sorted(MESSAGE_IDS))
+        self.assertEqual(pq.pop(None), MESSAGE_IDS)
+        self.assertEqual(pollster.metrics.counters['pollster.stored'], 5)
+
+    def test_do_poll_wo_delete_fetches_only_newer_uids(self):
+        mailbox = self._makeMailbox(['<abc@example.com>',
+                                     '<def@example.com>'])
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server, '--no-delete')
+
+        pollster.do_poll()
+        mailbox.append(self._makeMessageText('<ghi@example.com>'))
+        pollster.do_poll()
+
+        self.assertEqual(len(mailbox.messages), 3)
+        counters = pollster.metrics.counters
+        self.assertEqual(counters['pollster.stored'], 3)
+        self.failIf('pollster.duplicates' in counters)
+        state = pollster.open_state()
+        account, = pollster.accounts
+        self.assertEqual(state.getLastUID(account.state_key, 1), 3)
+
+    def test_do_poll_w_full_fetches_all(self):
+        mailbox = self._makeMailbox(['<abc@example.com>'])
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server, '--no-delete', '--full')
+
+        pollster.do_poll()
+        pollster.do_poll()
+
+        counters = pollster.metrics.counters
+        self.assertEqual(counters['pollster.stored'], 1)
+        self.assertEqual(counters['pollster.duplicates'], 1)
+
+    def test_do_poll_after_uidvalidity_reset(self):
+        mailbox = self._makeMailbox(['<abc@example.com>',
+                                     '<def@example.com>'])
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server, '--no-delete')
+        pollster.do_poll()
+
+        # The server renumbers the mailbox:  UID 1 is now a new message,
+        # which the high-water mark for the old UIDVALIDITY would skip.
+        server.mailboxes['INBOX'] = self._makeMailbox(['<ghi@example.com>'],
+                                                      uidvalidity=2)
+        pollster.do_poll()
+
+        md, pq = self._openStores()
+        self.assertEqual(sorted(md.iterkeys()), ['<abc@example.com>',
+                                                 '<def@example.com>',
+                                                 '<ghi@example.com>',
+                                                ])
+        state = pollster.open_state()
+        account, = pollster.accounts
+        self.assertEqual(state.getLastUID(account.state_key, 1), 0)
+        self.assertEqual(state.getLastUID(account.state_key, 2), 1)
+
+    def test_do_poll_w_skip_known_streams_large_messages(self):
+        import os
+        big = self._makeMessageText('<big@example.com>', 'x' * 100)
+        mailbox = self._makeMailbox(['<abc@example.com>'])
+        mailbox.append(big)
+        mailbox.append(self._makeMessageText('<def@example.com>'))
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server, '--skip-known',
+                                 '--stream-threshold', str(len(big) - 1))
+        pollster.stream_piece_size = 16
+        md, pq = self._openStores()
+        md['<abc@example.com>'] = self._makeMessage('<abc@example.com>')
+
+        self.failUnless(pollster.do_poll())
+
+        self.assertEqual(mailbox.messages, [])
+        self.assertEqual(pollster.metrics.counters['imap.skipped'], 1)
+        self.assertEqual(pollster.metrics.counters['pollster.stored'], 2)
+        md, pq = self._openStores()
+        # Small messages are fetched together, before those streamed.
+        self.assertEqual(pq.pop(None), ['<def@example.com>',
+                                        '<big@example.com>'])
+        # The streamed message is stored whole, and its file moved out of
+        # the inbox's 'tmp'.
+        self.assertEqual(md['<big@example.com>'].get_payload(), 'x' * 100)
+        self.assertEqual(os.listdir(os.path.join(md.mdpath, 'tmp')), [])
+        self.assertEqual(len(md._getMaildir()), 0)
+
+    def _makeMessage(self, message_id):
+        from email import message_from_string
+        return message_from_string(self._makeMessageText(message_id))
+
+    def test_wait_for_mail_w_idle(self):
+        import threading
+        import time
+        mailbox = self._makeMailbox()
+        server = self._startServer({'INBOX': mailbox}, idle=True)
+        pollster = self._makeOne(server)
+        pollster.interval = 10
+        conn = pollster.connect_to_imap(pollster.accounts[0])
+        try:
+            self.failUnless('IDLE' in conn.capabilities)
+            timer = threading.Timer(0.1, mailbox.append,
+                                    (self._makeMessageText('<a@x>'),))
+            timer.start()
+            started = time.time()
+            pollster.wait_for_mail(conn)
+            self.failUnless(time.time() - started < pollster.interval)
+            timer.join()
+        finally:
+            conn.logout()
+
+    def test_wait_for_mail_w_idle_over_ssl_times_out_quietly(self):
+        import time
+        mailbox = self._makeMailbox()
+        server = self._startServer({'INBOX': mailbox}, idle=True,
+                                   use_ssl=True)
+        pollster = self._makeOne(server, '--ssl')
+        pollster.interval = 0.1
+        conn = pollster.connect_to_imap(pollster.accounts[0])
+        try:
+            self.failUnless('IDLE' in conn.capabilities)
+            started = time.time()
+            pollster.wait_for_mail(conn) # nothing delivered:  times out
+            self.failUnless(time.time() - started >= pollster.interval)
+            # The connection is still usable.
+            typ, data = conn.noop()
+            self.assertEqual(typ, 'OK')
+        finally:
+            conn.logout()
+
+    def test_wait_for_mail_wo_idle_sleeps_then_noops(self):
+        from repoze.mailin.scripts import pollster as pollster_module
+        mailbox = self._makeMailbox()
+        server = self._startServer({'INBOX': mailbox}, idle=False)
+        pollster = self._makeOne(server)
+        conn = pollster.connect_to_imap(pollster.accounts[0])
+        noops = []
+        _noop = conn.noop
+        def noop():
+            noops.append(1)
+            return _noop()
+        conn.noop = noop
+        clock = DummyTime()
+        _saved, pollster_module.time = pollster_module.time, clock
+        try:
+            pollster.wait_for_mail(conn)
+        finally:
+            pollster_module.time = _saved
+            conn.logout()
+        self.failIf('IDLE' in conn.capabilities)
+        self.assertEqual(clock.slept, [pollster.interval])
+        self.assertEqual(noops, [1])
+
+    def test_daemon_account_backs_off_reconnecting(self):
+        import socket
+        import threading
+        from repoze.mailin.scripts import pollster as pollster_module
+        server = self._startServer({'INBOX': self._makeMailbox()})
+        pollster = self._makeOne(server, '--daemon')
+        pollster.max_backoff = 5
+        attempts = []
+        def connect_to_imap(account):
+            attempts.append(account)
+            if len(attempts) > 5:
+                raise ValueError('stop')
+            raise socket.error('refused')
+        pollster.connect_to_imap = connect_to_imap
+        clock = DummyTime()
+        _saved, pollster_module.time = pollster_module.time, clock
+        try:
+            self.assertRaises(ValueError, pollster.daemon_account,
+                              pollster.accounts[0], None,
+                              threading.Semaphore(1))
+        finally:
+            pollster_module.time = _saved
+        self.assertEqual(clock.slept, [1, 2, 4, 5, 5])
+        self.assertEqual(pollster.metrics.counters['pollster.errors'], 5)
+
+    def test_daemon_account_backs_off_on_storage_errors(self):
+        import sqlite3
+        import threading
+        from repoze.mailin.scripts import pollster as pollster_module
+        mailbox = self._makeMailbox(['<abc@example.com>'])
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server, '--daemon')
+        _connect = pollster.connect_to_imap
+        attempts = []
+        def connect_to_imap(account):
+            attempts.append(account)
+            if len(attempts) > 2:
+                raise ValueError('stop')
+            return _connect(account)
+        pollster.connect_to_imap = connect_to_imap
+        sink = DummySink(sqlite3.OperationalError('database is locked'))
+        clock = DummyTime()
+        _saved, pollster_module.time = pollster_module.time, clock
+        try:
+            self.assertRaises(ValueError, pollster.daemon_account,
+                              pollster.accounts[0], sink,
+                              threading.Semaphore(1))
+        finally:
+            pollster_module.time = _saved
+        self.assertEqual(clock.slept, [1, 2])
+        self.assertEqual(pollster.metrics.counters['pollster.errors'], 2)
+        self.assertEqual(len(mailbox.messages), 1)
+
+    def test_do_poll_sets_aside_bad_message(self):
+        mailbox = self._makeMailbox(['<abc@example.com>'])
+        mailbox.append('Date: garbage\r\n'
+                       'Message-Id: <def@example.com>\r\n'
+                       '\r\nBody text here.')
+        mailbox.append(self._makeMessageText('<ghi@example.com>'))
+        server = self._startServer({'INBOX': mailbox})
+        pollster = self._makeOne(server)
+
+        self.failUnless(pollster.do_poll())
+
+        self.assertEqual(mailbox.messages, [])
+        md, pq = self._openStores()
+        self.assertEqual(sorted(md.iterkeys()),
+                         ['<abc@example.com>', '<ghi@example.com>'])
+        counters = pollster.metrics.counters
+        self.assertEqual(counters['pollster.stored'], 2)
+        self.assertEqual(counters['pollster.failed'], 1)
+
+    def test_daemon_account_resets_backoff_after_poll(self):
+        import socket
+        import threading
+        from repoze.mailin.scripts import pollster as pollster_module
+        mailbox = self._makeMailbox(['<abc@example.com>'])
+        server = self._startServer({'INBOX': mailbox}, idle=False)
+        pollster = self._makeOne(server, '--daemon')
+        _connect = pollster.connect_to_imap
+        attempts = []
+        def connect_to_imap(account):
+            attempts.append(account)
+            if len(attempts) in (1, 2, 4):
+                raise socket.error('refused')
+            if len(attempts) > 4:
+                raise ValueError('stop')
+            return _connect(account)
+        pollster.connect_to_imap = connect_to_imap
+        def wait_for_mail(conn):
+            raise socket.error('dropped')
+        pollster.wait_for_mail = wait_for_mail
+        md, pq = self._openStores()
+        from repoze.mailin.scripts.pollster import MessageSink
+        sink = MessageSink(md, pq, metrics=pollster.metrics)
+        clock = DummyTime()
+        _saved, pollster_module.time = pollster_module.time, clock
+        try:
+            self.assertRaises(ValueError, pollster.daemon_account,
+                              pollster.accounts[0], sink,
+                              threading.Semaphore(1))
+        finally:
+            pollster_module.time = _saved
+        # Failed, failed, polled then dropped, failed.
+        self.assertEqual(clock.slept, [1, 2, 1, 2])
+        self.assertEqual(list(md.iterkeys()), ['<abc@example.com>'])
+
+
+class Test_parseFetch(unittest.TestCase):
+
+    def _callFUT(self, data):
+        from repoze.mailin.scripts.pollster import _parseFetch
+        return _parseFetch(data)
+
+    def test_empty(self):
+        self.assertEqual(self._callFUT([None]), [])
+
+    def test_wo_literals(self):
+        self.assertEqual(self._callFUT(['1 (UID 5 RFC822.SIZE 10)',
+                                        '2 (FLAGS (\\Seen))',
+                                        '3 (UID 9 RFC822.SIZE 20)',
+                                       ]),
+                         [(5, '1 (UID 5 RFC822.SIZE 10)', None),
+                          (9, '3 (UID 9 RFC822.SIZE 20)', None),
+                         ])
+
+    def test_w_literals_uid_before_and_after(self):
+        self.assertEqual(self._callFUT([('1 (UID 5 RFC822 {3}', 'abc'),
+                                        ')',
+                                        '2 (FLAGS (\\Seen))',
+                                        ('3 (RFC822 {3}', 'def'),
+                                        ' UID 9)',
+                                       ]),
+                         [(5, '1 (UID 5 RFC822 {3})', 'abc'),
+                          (9, '3 (RFC822 {3} UID 9)', 'def'),
+                         ])
+
+
+class PollsterFetchTests(_Base, unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.scripts.pollster import Pollster
+        return Pollster
+
+    def _makeOne(self):
+        return self._getTargetClass()(['pollster', '--quiet',
+                                       self._getTempdir(),
+                                       'imap.example.com', 'phred:secret'])
+
+    def test_fetch_sizes_skips_unsolicited(self):
+        pollster = self._makeOne()
+        conn = DummyConn(['2 (FLAGS (\\Seen))',
+                          '3 (UID 9 RFC822.SIZE 20)',
+                          '1 (UID 5 RFC822.SIZE 10)',
+                          '4 (UID 12 FLAGS (\\Seen))',
+                         ])
+        self.assertEqual(pollster.fetch_sizes(conn, [5, 9]), {5: 10, 9: 20})
+
+    def test_fetch_messages_keyed_by_uid(self):
+        pollster = self._makeOne()
+        conn = DummyConn([('3 (RFC822 {3}', self._makeMessageText('<b@x>')),
+                          ' UID 9)',
+                          '2 (FLAGS (\\Seen))',
+                          ('1 (UID 5 RFC822 {3}',
+                           self._makeMessageText('<a@x>')),
+                          ')',
+                         ])
+        fetched = [(uid, message['Message-ID'])
+                   for uid, message in pollster.fetch_messages(conn, [9, 5])]
+        self.assertEqual(fetched, [(5, '<a@x>'), (9, '<b@x>')])
+
+    def test_select_unknown_skips_unsolicited(self):
+        pollster = self._makeOne()
+        md, pq = self._openStores()
+        md['<a@x>'] = self._makeMessage('<a@x>')
+        conn = DummyConn(['2 (FLAGS (\\Seen))',
+                          ('1 (UID 5 RFC822.SIZE 10 BODY[HEADER] {3}',
+                           'Message-ID: <a@x>\r\n\r\n'),
+                          ')',
+                          ('3 (RFC822.SIZE 20 BODY[HEADER] {3}',
+                           'Message-ID: <b@x>\r\n\r\n'),
+                          ' UID 9)',
+                         ])
+        from repoze.mailin.scripts.pollster import MessageSink
+        sink = MessageSink(md, pq, metrics=DummyMetrics())
+        wanted, sizes = pollster.select_unknown(conn, [5, 9], sink)
+        self.assertEqual(wanted, set([9]))
+        self.assertEqual(sizes, {5: 10, 9: 20})
+
+    def test_fetch_next_sorts_uids_and_stops_mark_at_missing(self):
+        pollster = self._makeOne()
+        pollster.delete = False
+        state = pollster.open_state()
+        account, = pollster.accounts
+        conn = DummyScriptedConn({
+            'SEARCH': ['12 5 9 7'],
+            'FETCH': [('1 (UID 5 RFC822 {3}', self._makeMessageText('<a@x>')),
+                      ')',
+                      ('3 (UID 9 RFC822 {3}', self._makeMessageText('<c@x>')),
+                      ')',
+                      ('4 (UID 12 RFC822 {3}',
+                       self._makeMessageText('<d@x>')),
+                      ')',
+                     ]})
+        fetched = [message_id for message_id, message, path
+                   in pollster.fetch_next(conn, account, state)]
+        self.assertEqual(fetched, ['<a@x>', '<c@x>', '<d@x>'])
+        self.assertEqual(conn._commands[1][:2], ('FETCH', '5:5,7:7,9:9,12:12'))
+        # UID 7 wasn't returned:  the next poll starts from it.
+        self.assertEqual(state.getLastUID(account.state_key, 1), 5)
+
+    def test_stream_message_keeps_requested_uid_honors_umask(self):
+        import os
+        import stat
+        pollster = self._makeOne()
+        pollster.stream_piece_size = 1000
+        text = self._makeMessageText('<a@x>')
+        conn = DummyScriptedConn({
+            'FETCH': [('1 (UID 5 BODY[]<0> {3}', text),
+                      ')',
+                      ('2 (UID 6 BODY[]<0> {3}', 'Unsolicited'),
+                      ')',
+                     ]})
+        _saved = os.umask(022)
+        try:
+            path = pollster.stream_message(conn, 5, self._getTempdir())
+        finally:
+            os.umask(_saved)
+        f = open(path, 'rb')
+        try:
+            self.assertEqual(f.read(), text)
+        finally:
+            f.close()
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0644)
+
+    def _makeMessage(self, message_id):
+        from email import message_from_string
+        return message_from_string(self._makeMessageText(message_id))
+
+
+class DummyConn:
+    def __init__(self, data, typ='OK'):
+        self._data = data
+        self._typ = typ
+        self._commands = []
+
+    def uid(self, *args):
+        self._commands.append(args)
+        return self._typ, self._data
+
+class DummyScriptedConn:
+    uidvalidity = 1
+
+    def __init__(self, responses):
+        self._responses = responses
+        self._commands = []
+
+    def uid(self, *args):
+        self._commands.append(args)
+        return 'OK', self._responses[args[0]]
+
+class DummySink:
+    def __init__(self, store_error=None):
+        self._store_error = store_error
+        self._calls = []
+
+    def store(self, message_id, message, path=None):
+        if self._store_error is not None:
+            raise self._store_error
+        self._calls.append(('store', message_id, message, path))
+
+    def known(self, message_ids):
+        self._calls.append(('known', message_ids))
+        return set(message_ids)
+
+    def tmpdir(self):
+        return '/tmp'
+
+    def flush(self):
+        self._calls.append(('flush',))
+
+    def report(self):
+        self._calls.append(('report',))
+
+class DummyTime:
+    def __init__(self):
+        self.slept = []
+
+    def time(self):
+        import time
+        return time.time()
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+
+
+class DummyMetrics:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, seconds):
+        self.timings.setdefault(name, []).append(seconds)
+
+    def flush(self):
+        pass
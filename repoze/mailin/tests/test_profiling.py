@@ -0,0 +1,127 @@
+import unittest
+
+class ExpandProfileOptionTests(unittest.TestCase):
+
+    def _callFUT(self, argv, default='script.prof'):
+        from repoze.mailin.profiling import expandProfileOption
+        return expandProfileOption(argv, default)
+
+    def test_absent(self):
+        self.assertEqual(self._callFUT(['script', '-v', 'path']),
+                         ['script', '-v', 'path'])
+
+    def test_bare(self):
+        self.assertEqual(self._callFUT(['script', '--profile', 'path']),
+                         ['script', '--profile=script.prof', 'path'])
+
+    def test_w_value(self):
+        self.assertEqual(self._callFUT(['script', '--profile=/tmp/x', 'path']),
+                         ['script', '--profile=/tmp/x', 'path'])
+
+    def test_after_double_dash(self):
+        self.assertEqual(self._callFUT(['script', '--', '--profile']),
+                         ['script', '--', '--profile'])
+
+class PhaseTimerTests(unittest.TestCase):
+
+    def _getTargetClass(self):
+        from repoze.mailin.profiling import PhaseTimer
+        return PhaseTimer
+
+    def _makeOne(self, wrapped=None):
+        return self._getTargetClass()(wrapped)
+
+    def test_class_conforms_to_IMetrics(self):
+        from zope.interface.verify import verifyClass
+        from repoze.mailin.interfaces import IMetrics
+        verifyClass(IMetrics, self._getTargetClass())
+
+    def test_timing_accumulates(self):
+        timer = self._makeOne()
+        timer.timing('store.parse', 0.5)
+        timer.timing('store.parse', 1.5)
+        self.assertEqual(timer.phases, {'store.parse': [2, 2.0, 1.5]})
+
+    def test_passes_through(self):
+        wrapped = DummyMetrics()
+        timer = self._makeOne(wrapped)
+        timer.increment('a', 2)
+        timer.gauge('b', 3)
+        timer.timing('c', 0.25)
+        timer.flush()
+        self.assertEqual(wrapped._recorded,
+                         [('increment', 'a', 2),
+                          ('gauge', 'b', 3),
+                          ('timing', 'c', 0.25),
+                          ('flush',),
+                         ])
+
+    def test_report(self):
+        timer = self._makeOne()
+        timer.timing('store.parse', 0.5)
+        timer.timing('queue.push', 1.0)
+        timer.timing('queue.push', 1.0)
+        lines = timer.report(4.0).splitlines()
+        self.assertEqual(len(lines), 4)
+        self.failUnless(lines[0].startswith('phase'))
+        self.assertEqual(lines[1].split()[0], 'queue.push')
+        self.assertEqual(lines[1].split()[-1], '50.0')
+        self.assertEqual(lines[2].split()[0], 'store.parse')
+        self.assertEqual(lines[2].split()[-1], '12.5')
+        self.assertEqual(lines[3].split(), ['(run)', 'elapsed', '4.000'])
+
+class ProfilerTests(unittest.TestCase):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getTargetClass(self):
+        from repoze.mailin.profiling import Profiler
+        return Profiler
+
+    def _makeOne(self):
+        import os
+        import tempfile
+        self._tempdir = tempfile.mkdtemp()
+        return self._getTargetClass()(os.path.join(self._tempdir, 'x.prof'))
+
+    def test_runcall_and_write(self):
+        import pstats
+        profiler = self._makeOne()
+        def _work(a, b):
+            profiler.phases.timing('store.parse', 0.001)
+            return a + b
+        self.assertEqual(profiler.runcall(_work, 1, 2), 3)
+        self.failUnless(profiler.elapsed >= 0)
+        profiler.write()
+        stats = pstats.Stats(profiler.path)
+        self.failUnless([x for x in stats.stats if x[2] == '_work'])
+        phases = open(profiler.path + '.phases').read()
+        self.failUnless('store.parse' in phases)
+
+    def test_runcall_records_elapsed_on_error(self):
+        profiler = self._makeOne()
+        def _fail():
+            raise ValueError
+        self.assertRaises(ValueError, profiler.runcall, _fail)
+        self.failUnless(profiler.elapsed >= 0)
+
+class DummyMetrics:
+    def __init__(self):
+        self._recorded = []
+
+    def increment(self, name, value=1):
+        self._recorded.append(('increment', name, value))
+
+    def gauge(self, name, value):
+        self._recorded.append(('gauge', name, value))
+
+    def timing(self, name, seconds):
+        self._recorded.append(('timing', name, seconds))
+
+    def flush(self):
+        self._recorded.append(('flush',))
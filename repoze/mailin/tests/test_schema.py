@@ -0,0 +1,103 @@
+import unittest
+
+STEPS = [
+    ['create table if not exists things(id integer primary key, name)'],
+    ['create index if not exists things_name on things(name)'],
+]
+
+class MigrateTests(unittest.TestCase):
+
+    def _callFUT(self, sql, name='things', steps=STEPS):
+        from repoze.mailin.schema import migrate
+        return migrate(sql, name, steps)
+
+    def _makeSql(self, isolation_level=None):
+        import sqlite3
+        return sqlite3.connect(':memory:', isolation_level=isolation_level)
+
+    def _getNames(self, sql, type):
+        return sorted([row[0] for row in sql.execute(
+                        'select name from sqlite_master where type = ?',
+                        (type,))])
+
+    def test_fresh_database(self):
+        sql = self._makeSql()
+        self.assertEqual(self._callFUT(sql), 2)
+        self.assertEqual(self._getNames(sql, 'table'),
+                         ['schema_versions', 'things'])
+        self.assertEqual(self._getNames(sql, 'index')[-1], 'things_name')
+
+    def test_idempotent(self):
+        sql = self._makeSql()
+        self._callFUT(sql)
+        self.assertEqual(self._callFUT(sql), 2)
+        self.assertEqual(sql.execute('select version from schema_versions '
+                                     'where name = "things"').fetchall(),
+                         [(2,)])
+
+    def test_upgrade_from_earlier_version(self):
+        sql = self._makeSql()
+        self._callFUT(sql, steps=STEPS[:1])
+        self.failIf('things_name' in self._getNames(sql, 'index'))
+        self.assertEqual(self._callFUT(sql), 2)
+        self.failUnless('things_name' in self._getNames(sql, 'index'))
+
+    def test_unversioned_legacy_table(self):
+        sql = self._makeSql()
+        sql.execute('create table things(id integer primary key, name)')
+        sql.execute('insert into things(name) values("legacy")')
+        self.assertEqual(self._callFUT(sql), 2)
+        self.assertEqual(sql.execute('select name from things').fetchall(),
+                         [(u'legacy',)])
+
+    def test_independent_names(self):
+        from repoze.mailin.schema import getVersion
+        sql = self._makeSql()
+        self._callFUT(sql)
+        self._callFUT(sql, 'other', STEPS[:1])
+        self.assertEqual(getVersion(sql, 'things'), 2)
+        self.assertEqual(getVersion(sql, 'other'), 1)
+
+    def test_failed_step_rolls_back(self):
+        import sqlite3
+        from repoze.mailin.schema import getVersion
+        sql = self._makeSql()
+        steps = STEPS + [['create table extra(id)', 'bogus sql']]
+        self.assertRaises(sqlite3.OperationalError, self._callFUT, sql,
+                          'things', steps)
+        self.assertEqual(getVersion(sql, 'things'), 2)
+        self.failIf('extra' in self._getNames(sql, 'table'))
+
+    def test_restores_isolation_level(self):
+        sql = self._makeSql('DEFERRED')
+        self._callFUT(sql)
+        self.assertEqual(sql.isolation_level, 'DEFERRED')
+
+
+class GetVersionTests(unittest.TestCase):
+
+    def _callFUT(self, sql, name='things'):
+        from repoze.mailin.schema import getVersion
+        return getVersion(sql, name)
+
+    def test_no_versions_table(self):
+        import sqlite3
+        self.assertEqual(self._callFUT(sqlite3.connect(':memory:')), 0)
+
+    def test_unknown_name(self):
+        import sqlite3
+        from repoze.mailin.schema import migrate
+        sql = sqlite3.connect(':memory:')
+        migrate(sql, 'other', STEPS)
+        self.assertEqual(self._callFUT(sql), 0)
+
+
+class PartialIndexTests(unittest.TestCase):
+
+    def _callFUT(self, statement, where):
+        from repoze.mailin.schema import partialIndex
+        return partialIndex(statement, where)
+
+    def test_supported(self):
+        self.assertEqual(self._callFUT('create index x on t(a)', 'a = 0'),
+                         'create index x on t(a) where a = 0')
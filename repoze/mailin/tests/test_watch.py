@@ -0,0 +1,168 @@
+import unittest
+
+try:
+    import pyinotify
+except ImportError: # pragma: no cover
+    pyinotify = None
+
+class _Base(object):
+
+    _tempdir = None
+
+    def tearDown(self):
+        if self._tempdir is not None:
+            import shutil
+            shutil.rmtree(self._tempdir)
+
+    def _getMaildir(self):
+        import os
+        import tempfile
+        self._tempdir = tempfile.mkdtemp()
+        for name in ('tmp', 'new', 'cur'):
+            os.mkdir(os.path.join(self._tempdir, name))
+        return self._tempdir
+
+    def _deliver(self, name='1234.M1P1Q1.example.com'):
+        # Deliver as an MTA would:  write into 'tmp', then rename into 'new'.
+        import os
+        tmp = os.path.join(self._tempdir, 'tmp', name)
+        f = open(tmp, 'w')
+        f.write('Message-Id: <%s>\n\nBody' % name)
+        f.close()
+        new = os.path.join(self._tempdir, 'new', name)
+        os.rename(tmp, new)
+        return new
+
+    def _getTargetClass(self):
+        from repoze.mailin.watch import InboxWatcher
+        return InboxWatcher
+
+    def _addNonMessages(self, suffix='1'):
+        # A dotfile (e.g., a delivery agent's temporary name) and a
+        # subdirectory, neither of which is a message.
+        import os
+        new = os.path.join(self._tempdir, 'new')
+        open(os.path.join(new, '.tmp.' + suffix), 'w').close()
+        os.mkdir(os.path.join(new, '1234.subdir.' + suffix))
+
+class InboxWatcherPollingTests(_Base, unittest.TestCase):
+
+    def _makeOne(self, path, interval=0.01):
+        return self._getTargetClass()(path, interval, use_inotify=False)
+
+    def test_wait_empty_times_out(self):
+        import time
+        watcher = self._makeOne(self._getMaildir())
+        started = time.time()
+        self.failIf(watcher.wait(0.05))
+        self.failUnless(time.time() - started >= 0.05)
+
+    def test_wait_already_delivered(self):
+        watcher = self._makeOne(self._getMaildir())
+        self._deliver()
+        self.failUnless(watcher.wait(0))
+
+    def test_wait_until_delivered(self):
+        import threading
+        watcher = self._makeOne(self._getMaildir())
+        self.failIf(watcher.wait(0))
+        timer = threading.Timer(0.05, self._deliver)
+        timer.start()
+        try:
+            self.failUnless(watcher.wait(5))
+        finally:
+            timer.join()
+
+    def test_wait_after_drained(self):
+        import os
+        watcher = self._makeOne(self._getMaildir())
+        path = self._deliver()
+        self.failUnless(watcher.wait(0))
+        os.unlink(path)
+        self.failIf(watcher.wait(0))
+
+    def test_wait_ignores_non_messages(self):
+        watcher = self._makeOne(self._getMaildir())
+        self._addNonMessages()
+        self.failIf(watcher.wait(0))
+        self._deliver()
+        self.failUnless(watcher.wait(0))
+
+    def test_unchanged_directory_not_relisted(self):
+        import os
+        import time
+        watcher = self._makeOne(self._getMaildir())
+        new = os.path.join(self._tempdir, 'new')
+        old = time.time() - 60
+        os.utime(new, (old, old))
+        self.failIf(watcher.wait(0))
+        # Sneak a file in without changing the mtime:  it goes unseen.
+        self._deliver()
+        os.utime(new, (old, old))
+        self.failIf(watcher.wait(0))
+        os.utime(new, None)
+        self.failUnless(watcher.wait(0))
+
+class InboxWatcherInotifyTests(_Base, unittest.TestCase):
+
+    _watcher = None
+
+    def tearDown(self):
+        if self._watcher is not None:
+            self._watcher.close()
+        super(InboxWatcherInotifyTests, self).tearDown()
+
+    def _makeOne(self, path):
+        watcher = self._watcher = self._getTargetClass()(path,
+                                                         use_inotify=True)
+        return watcher
+
+    def test_wait_empty_times_out(self):
+        watcher = self._makeOne(self._getMaildir())
+        self.failIf(watcher.wait(0.05))
+
+    def test_wait_already_delivered(self):
+        watcher = self._makeOne(self._getMaildir())
+        self._deliver()
+        self.failUnless(watcher.wait(0))
+
+    def test_wait_until_delivered(self):
+        import threading
+        watcher = self._makeOne(self._getMaildir())
+        timer = threading.Timer(0.05, self._deliver)
+        timer.start()
+        try:
+            self.failUnless(watcher.wait(5))
+        finally:
+            timer.join()
+
+    def test_wait_ignores_non_messages(self):
+        import threading
+        watcher = self._makeOne(self._getMaildir())
+        self._addNonMessages()
+        self.failIf(watcher.wait(0))
+        timer = threading.Timer(0.05, self._addNonMessages, ('2',))
+        timer.start()
+        try:
+            self.failIf(watcher.wait(0.2))
+        finally:
+            timer.join()
+
+    def test_wait_until_linked(self):
+        import os
+        import threading
+        watcher = self._makeOne(self._getMaildir())
+        tmp = os.path.join(self._tempdir, 'tmp', 'linked')
+        open(tmp, 'w').close()
+        timer = threading.Timer(0.05, os.link,
+                                (tmp, os.path.join(self._tempdir, 'new',
+                                                   'linked')))
+        timer.start()
+        try:
+            self.failUnless(watcher.wait(5))
+        finally:
+            timer.join()
+
+if pyinotify is None: # pragma: no cover
+    # The tests need pyinotify:  don't collect them without it.
+    del InboxWatcherInotifyTests
@@ -0,0 +1,103 @@
+""" Wait for messages to be delivered into a maildir's inbox.
+"""
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError: # pragma: no cover
+    pyinotify = None
+
+from repoze.mailin.maildir import _listFiles
+
+class InboxWatcher:
+    """ Wait for messages to be delivered into the 'new' directory of the
+    ``Maildir`` at 'path'.
+
+    - Uses inotify, via the optional 'pyinotify' package, if available
+      (and unless 'use_inotify' is false).
+
+    - Otherwise, polls every 'interval' seconds:  each poll stats the
+      directory, listing it only if it has changed.
+
+    - As in 'SaneFilenameMaildir.iterDelivered', subdirectories and
+      dotfiles in 'new' are not messages.
+    """
+    def __init__(self, path, interval=1.0, use_inotify=None):
+        self.new = os.path.join(path, 'new')
+        self.interval = interval
+        if use_inotify is None:
+            use_inotify = pyinotify is not None
+        self.use_inotify = use_inotify
+        self._mtime = None
+        self._nonempty = False
+        if use_inotify:
+            self._wm = pyinotify.WatchManager()
+            self._notifier = pyinotify.Notifier(self._wm, _ignoreEvent)
+            # Maildir deliveries link or rename complete files into 'new'.
+            self._wm.add_watch(self.new, pyinotify.IN_CREATE |
+                                         pyinotify.IN_MOVED_TO)
+
+    def wait(self, timeout=None):
+        """ Wait until the inbox has messages, or until 'timeout' seconds
+        have passed (if not None).
+
+        - Return True if the inbox has (or may have) messages.
+        """
+        if self.use_inotify:
+            return self._waitForEvents(timeout)
+        return self._poll(timeout)
+
+    def close(self):
+        if self.use_inotify:
+            self._notifier.stop()
+
+    def _waitForEvents(self, timeout):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            # Messages delivered before we started watching raise no
+            # events;  events for entries other than messages don't count.
+            if _hasDelivered(self.new):
+                return True
+            wait = None
+            if timeout is not None:
+                wait = max(int((deadline - time.time()) * 1000), 0)
+            if not self._notifier.check_events(wait):
+                return False
+            self._notifier.read_events()
+            self._notifier.process_events()
+            if timeout is not None and time.time() >= deadline:
+                return _hasDelivered(self.new)
+
+    def _poll(self, timeout):
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if self._hasMessages():
+                return True
+            delay = self.interval
+            if timeout is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    return False
+            time.sleep(delay)
+
+    def _hasMessages(self):
+        # The directory's mtime changes whenever entries are added to or
+        # removed from it, so list it only if that has changed (or is too
+        # recent to rule out changes within the filesystem's granularity).
+        mtime = os.stat(self.new).st_mtime
+        if mtime != self._mtime or time.time() - mtime < 2:
+            self._mtime = mtime
+            self._nonempty = _hasDelivered(self.new)
+        return self._nonempty
+
+def _hasDelivered(path):
+    for name in _listFiles(path):
+        if not name.startswith('.'):
+            return True
+    return False
+
+def _ignoreEvent(event):
+    pass
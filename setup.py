@@ -60,8 +60,13 @@ setup(name='repoze.mailin',
         [console_scripts]
         draino = repoze.mailin.scripts.draino:main
         pollster = repoze.mailin.scripts.pollster:main
+        mailin-process = repoze.mailin.scripts.process:main
+        mailin-benchmark = repoze.mailin.benchmarks.runner:main
       """,
       extras_require = {
         'testing': testing_extras,
+        'async': ['trollius'],
+        'inotify': ['pyinotify'],
+        'scandir': ['scandir'],
       },
 )